@@ -0,0 +1,69 @@
+import time
+import logging
+import threading
+from log_config import log_event
+from stations import Mac, to_mac
+
+class AdmissionIndex:
+    """In-memory MAC -> (balance, plan, limits) index for admitting new stations.
+
+    Loaded once at startup and refreshed from the database whenever
+    UserManager reports a committed change, so deciding whether a newly
+    associated device gets in is a dict lookup rather than a query. Entries
+    are keyed by Mac, so lookups don't depend on how the address was spelled.
+    """
+
+    def __init__(self, user_manager, network_controller):
+        self.user_manager = user_manager
+        self.network_controller = network_controller
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def load(self):
+        """(Re)build the index from all users; returns how many were loaded"""
+        started = time.monotonic()
+        entries = {}
+        for mac_address, info in self.user_manager.get_all_users().items():
+            mac = to_mac(mac_address)
+            if mac is None:
+                self.logger.warning(f"Skipping user with invalid MAC address {mac_address!r}")
+                continue
+            entries[mac] = self._entry(info)
+        with self.lock:
+            self.entries = entries
+        log_event(self.logger, logging.INFO, 'admission_index_loaded', users=len(entries),
+                  seconds=round(time.monotonic() - started, 2))
+        return len(entries)
+
+    def _entry(self, info):
+        return (info[self.user_manager.balance_column], info['plan'], info['download_limit'], info['upload_limit'])
+
+    def refresh(self, mac_addresses):
+        """UserManager listener: reload the given users' entries"""
+        users = self.user_manager.get_users(mac_addresses)
+        with self.lock:
+            for mac_address in mac_addresses:
+                mac = to_mac(mac_address)
+                if mac is None:
+                    continue
+                if mac_address in users:
+                    self.entries[mac] = self._entry(users[mac_address])
+                else:
+                    self.entries.pop(mac, None)
+
+    def lookup(self, mac_address):
+        """(balance, plan, download_limit, upload_limit), or None for unknown devices"""
+        return self.entries.get(Mac(mac_address))
+
+    def admit(self, mac_address, ip_address=None):
+        """NetworkController admission handler: allow and shape, or block, a new station"""
+        entry = self.lookup(mac_address)
+        if entry is None or entry[0] <= 0:
+            log_event(self.logger, logging.INFO, 'admission_denied', mac=mac_address,
+                      reason='unknown' if entry is None else 'no_balance')
+            return self.network_controller.block_mac(mac_address)
+
+        balance, plan, download, upload = entry
+        log_event(self.logger, logging.INFO, 'admission_allowed', mac=mac_address, balance=balance, plan=plan)
+        return self.network_controller.admit_mac(mac_address, download, upload, ip_address)
@@ -0,0 +1,131 @@
+import copy
+import shlex
+import ipaddress
+
+# Radio settings that can be changed on a running AP
+FIELDS = ('ssid', 'channel', 'hw_mode', 'max_clients', 'dhcp_start', 'dhcp_end')
+
+# Beacons announcing a channel switch before it happens, so stations move along
+CSA_BEACONS = 5
+
+def channel_frequency(channel):
+    """Centre frequency in MHz of a 2.4 or 5 GHz channel number"""
+    if channel == 14:
+        return 2484
+    if 1 <= channel <= 13:
+        return 2407 + 5 * channel
+    if 32 <= channel <= 177:
+        return 5000 + 5 * channel
+    raise ValueError(f"Unknown channel {channel}")
+
+
+class ReconfigPlan:
+    """What changing a radio's settings takes, step by step, before anything is touched.
+
+    Each step is {'action', 'commands', 'disconnects', 'reason'} and may carry
+    a 'fallback' list of commands for when the live path is refused (a driver
+    without channel switch support). `updated` is the radio as it will be.
+    """
+
+    def __init__(self, radio, updated, changes):
+        self.radio = radio
+        self.updated = updated
+        self.changes = changes
+        self.steps = []
+
+    def add(self, action, commands, reason, disconnects=False, fallback=None):
+        step = {'action': action, 'commands': commands, 'disconnects': disconnects, 'reason': reason}
+        if fallback:
+            step['fallback'] = fallback
+        self.steps.append(step)
+
+    @property
+    def disconnects(self):
+        return any(step['disconnects'] for step in self.steps)
+
+    def summary(self):
+        return {
+            'interface': self.radio.interface,
+            'changes': {field: list(values) for field, values in self.changes.items()},
+            'steps': self.steps,
+            'disconnects_clients': self.disconnects,
+        }
+
+
+def _updated_radio(radio, settings):
+    unknown = set(settings) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown setting(s): {', '.join(sorted(unknown))}")
+    updated = copy.copy(radio)
+    for field, value in settings.items():
+        if field in ('channel', 'max_clients'):
+            value = int(value)
+        elif value is not None:
+            value = str(value).strip() or None
+        setattr(updated, field, value)
+
+    if not updated.ssid or len(updated.ssid.encode()) > 32:
+        raise ValueError("ssid must be 1-32 bytes")
+    if updated.hw_mode not in ('a', 'b', 'g'):
+        raise ValueError("hw_mode must be a, b or g")
+    frequency = channel_frequency(updated.channel)
+    if (frequency > 5000) != (updated.hw_mode == 'a'):
+        raise ValueError(f"channel {updated.channel} does not match hw_mode={updated.hw_mode}")
+    if not 1 <= updated.max_clients <= 2007:
+        raise ValueError("max_clients must be between 1 and 2007")
+    if bool(updated.dhcp_start) != bool(updated.dhcp_end):
+        raise ValueError("dhcp_start and dhcp_end go together")
+    if updated.dhcp_start:
+        for address in (updated.dhcp_start, updated.dhcp_end):
+            if not updated.contains(address) or address == updated.ip:
+                raise ValueError(f"{address} is not a client address in {updated.network}")
+        if ipaddress.IPv4Address(updated.dhcp_start) > ipaddress.IPv4Address(updated.dhcp_end):
+            raise ValueError("dhcp_start must not be after dhcp_end")
+    return updated
+
+
+def plan_reconfigure(radio, settings, dnsmasq_conf='/etc/dnsmasq.conf'):
+    """ReconfigPlan moving `radio` to `settings` ({field: value}, fields from FIELDS).
+
+    Prefers the hostapd control interface: max_num_sta is SET in place,
+    channel moves within a band are announced with CHAN_SWITCH, an SSID change
+    is SET and RELOADed on that radio alone. Only a band (hw_mode) change
+    restarts that radio's hostapd. DHCP pool changes restart dnsmasq, which
+    doesn't touch associations: dnsmasq rereads dhcp-range only on start (a
+    SIGHUP covers hosts and option files, not dnsmasq.conf), and leases survive
+    in its lease file. Raises ValueError for invalid settings.
+    """
+    updated = _updated_radio(radio, settings)
+    changes = {field: (getattr(radio, field), getattr(updated, field)) for field in FIELDS
+               if getattr(radio, field) != getattr(updated, field)}
+    plan = ReconfigPlan(radio, updated, changes)
+    if not changes:
+        return plan
+
+    cli = f"hostapd_cli -i {radio.interface}"
+    restart = [f"kill $(cat {radio.pid_file})", "sleep 1", f"hostapd -B -P {radio.pid_file} {radio.hostapd_conf}"]
+    hostapd_fields = {'ssid', 'channel', 'hw_mode', 'max_clients'} & set(changes)
+    if hostapd_fields:
+        plan.add('write_hostapd_config', [radio.hostapd_conf], "Keep the change across restarts")
+
+    if 'hw_mode' in changes:
+        plan.add('restart_hostapd', restart, f"Band change ({radio.hw_mode} -> {updated.hw_mode}) needs "
+                 f"hostapd restarted; stations on {radio.interface} reconnect", disconnects=True)
+    else:
+        if 'channel' in changes:
+            plan.add('chan_switch', [f"{cli} chan_switch {CSA_BEACONS} {channel_frequency(updated.channel)}",
+                                     f"{cli} set channel {updated.channel}"],
+                     f"Channel switch announced over {CSA_BEACONS} beacons; stations follow it",
+                     fallback=restart)
+        if 'max_clients' in changes:
+            plan.add('hostapd_set', [f"{cli} set max_num_sta {updated.max_clients}"],
+                     "Applies to new associations; stations already connected stay")
+        if 'ssid' in changes:
+            plan.add('hostapd_reload', [f"{cli} set ssid {shlex.quote(updated.ssid)}", f"{cli} reload"],
+                     f"Stations on {radio.interface} rejoin under the new name", disconnects=True)
+
+    if radio.dhcp_range() != updated.dhcp_range():
+        plan.add('write_dnsmasq_config', [dnsmasq_conf], "Keep the change across restarts")
+        plan.add('restart_dnsmasq', ["systemctl restart dnsmasq"],
+                 "dhcp-range is only read at start; associations and leases are kept")
+    return plan
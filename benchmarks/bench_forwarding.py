@@ -0,0 +1,164 @@
+"""Benchmark forwarding throughput and CPU cost of the firewall paths.
+
+Builds client -> router -> server network namespaces joined by veth pairs, loads
+the router with the rules NetworkController would install for a unit with
+`--clients` paying devices (one of which is the real client), shapes them all
+with tc and runs iperf3 through it for each mode:
+
+  iptables   per-MAC ACCEPT rules, per-IP ACCEPTs, MASQUERADE, u32 shaping
+  nftables   MAC verdict map, IP mark map, fw shaping
+  flowtable  nftables plus the fast-path flowtable, u32 shaping
+
+Needs root, iproute2, iptables, nft and iperf3.
+
+Usage: sudo python benchmarks/bench_forwarding.py [--clients 200] [--seconds 10] [--streams 4]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from radios import Radio
+from nft_backend import NftBackend
+from network_controller import NetworkController
+
+CLIENT, ROUTER, SERVER = 'pw-bench-client', 'pw-bench-router', 'pw-bench-server'
+CLIENT_MAC = '02:00:00:00:00:0A'
+CLIENT_IP = '192.168.4.10'
+SERVER_IP = '10.99.0.2'
+
+def run(command, ns=None, check=True):
+    if ns:
+        command = f"ip netns exec {ns} {command}"
+    return subprocess.run(command, shell=True, check=check, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True).stdout
+
+def run_batch(command, lines, ns):
+    with tempfile.NamedTemporaryFile('w', suffix='.rules') as f:
+        f.write('\n'.join(lines) + '\n')
+        f.flush()
+        return run(f"{command} {f.name}", ns)
+
+def setup_namespaces():
+    teardown_namespaces()
+    for ns in (CLIENT, ROUTER, SERVER):
+        run(f"ip netns add {ns}")
+        run("ip link set lo up", ns)
+    run(f"ip link add cl0 netns {CLIENT} address {CLIENT_MAC} type veth peer name ap0 netns {ROUTER}")
+    run(f"ip link add up0 netns {ROUTER} type veth peer name sv0 netns {SERVER}")
+    run(f"ip addr add {CLIENT_IP}/24 dev cl0", CLIENT)
+    run("ip link set cl0 up", CLIENT)
+    run("ip route add default via 192.168.4.1", CLIENT)
+    run("ip addr add 192.168.4.1/24 dev ap0", ROUTER)
+    run("ip addr add 10.99.0.1/24 dev up0", ROUTER)
+    run("ip link set ap0 up", ROUTER)
+    run("ip link set up0 up", ROUTER)
+    run("sysctl -qw net.ipv4.ip_forward=1", ROUTER)
+    run(f"ip addr add {SERVER_IP}/24 dev sv0", SERVER)
+    run("ip link set sv0 up", SERVER)
+
+def teardown_namespaces():
+    for ns in (CLIENT, ROUTER, SERVER):
+        run(f"ip netns del {ns}", check=False)
+
+def paying_clients(count):
+    """The real client plus `count - 1` other paying devices, as restore_state gets them"""
+    users, leases = [], {}
+    for i in range(count):
+        mac = CLIENT_MAC if i == 0 else "02:00:00:%02X:%02X:%02X" % (1 + (i >> 16), (i >> 8) & 0xFF, i & 0xFF)
+        ip_address = CLIENT_IP if i == 0 else f"192.168.{4 + (i + 10) // 250}.{(i + 10) % 250 + 2}"
+        users.append({'mac_address': mac, 'download_limit': 1000000, 'upload_limit': 1000000})
+        leases[mac] = {'ip': ip_address}
+    return users, leases
+
+def load_rules(mode, users, leases):
+    """Flush the router and install `mode`'s firewall and shaping for `users`"""
+    run("nft flush ruleset", ROUTER, check=False)
+    run("iptables -F", ROUTER, check=False)
+    run("iptables -t nat -F", ROUTER, check=False)
+    run("iptables -P FORWARD ACCEPT", ROUTER, check=False)
+    run("tc qdisc del dev ap0 root", ROUTER, check=False)
+    run("tc qdisc del dev ap0 ingress", ROUTER, check=False)
+    run_batch("tc -batch", [
+        "qdisc add dev ap0 root handle 1: htb default 10",
+        "class add dev ap0 parent 1: classid 1:1 htb rate 10gbit burst 15k",
+        "class add dev ap0 parent 1:1 classid 1:10 htb rate 2048kbit ceil 2048kbit burst 15k",
+        "qdisc add dev ap0 ingress",
+    ], ROUTER)
+
+    use_marks = mode == 'nftables'
+    iptables_lines, tc_lines = NetworkController.build_restore_batches(
+        users, leases, lambda ip: 'ap0', use_marks=use_marks)
+    if mode == 'iptables':
+        rules = ['*nat', '-A POSTROUTING -o up0 -j MASQUERADE', 'COMMIT', '*filter', ':FORWARD DROP [0:0]',
+                 '-A FORWARD -m state --state ESTABLISHED,RELATED -j ACCEPT',
+                 '-A FORWARD -i ap0 -p udp --dport 53 -j ACCEPT',
+                 '-A FORWARD -i ap0 -p udp --dport 67:68 -j ACCEPT',
+                 '-A FORWARD -i ap0 -d 192.168.4.1 -j ACCEPT',
+                 '-A FORWARD -i ap0 -j DROP', 'COMMIT']
+        run_batch("iptables-restore", rules, ROUTER)
+        run_batch("iptables-restore --noflush", iptables_lines, ROUTER)
+        # set_bandwidth_limit's per-IP ACCEPTs
+        run_batch("iptables-restore --noflush", ['*filter'] + [
+            f"-A FORWARD {flag} {lease['ip']} -j ACCEPT" for lease in leases.values() for flag in ('-s', '-d')
+        ] + ['COMMIT'], ROUTER)
+    else:
+        backend = NftBackend([Radio('ap0', '192.168.4.1', 'bench')], 'up0',
+                             lambda command: run(command, ROUTER), flowtable=mode == 'flowtable')
+        marks = {lease['ip']: NetworkController.class_id_for(mac) for mac, lease in leases.items()} if use_marks else {}
+        backend.apply(backend.ruleset({user['mac_address']: 'allowed' for user in users}, marks))
+    run_batch("tc -force -batch", tc_lines, ROUTER)
+
+def cpu_times():
+    with open('/proc/stat') as f:
+        fields = [int(value) for value in f.readline().split()[1:]]
+    busy = sum(fields[:3]) + fields[5] + fields[6]  # user, nice, system, irq, softirq
+    return busy, sum(fields[:8]), fields[6]
+
+def measure(seconds, streams):
+    busy_before, total_before, softirq_before = cpu_times()
+    output = run(f"iperf3 -c {SERVER_IP} -t {seconds} -P {streams} -J", CLIENT)
+    busy_after, total_after, softirq_after = cpu_times()
+    result = json.loads(output)
+    mbits = result['end']['sum_received']['bits_per_second'] / 1e6
+    cpus = os.cpu_count()
+    elapsed = (total_after - total_before) / cpus  # jiffies per CPU
+    cores_busy = (busy_after - busy_before) / elapsed
+    cores_softirq = (softirq_after - softirq_before) / elapsed
+    return mbits, cores_busy, cores_softirq
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=200, help="Paying devices in the ruleset")
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--modes', default='iptables,nftables,flowtable')
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        sys.exit("Run as root (network namespaces, iptables, nft)")
+
+    users, leases = paying_clients(args.clients)
+    setup_namespaces()
+    server = subprocess.Popen(f"ip netns exec {SERVER} iperf3 -s", shell=True,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        print(f"{args.clients} paying clients, {args.streams} streams, {args.seconds}s per mode")
+        print(f"{'mode':<10} {'Mbit/s':>10} {'cores busy':>11} {'softirq':>9} {'Mbit/s per core':>16}")
+        for mode in args.modes.split(','):
+            load_rules(mode, users, leases)
+            mbits, cores_busy, cores_softirq = measure(args.seconds, args.streams)
+            print(f"{mode:<10} {mbits:>10,.0f} {cores_busy:>11.2f} {cores_softirq:>9.2f} "
+                  f"{mbits / max(cores_busy, 0.01):>16,.0f}")
+    finally:
+        server.terminate()
+        teardown_namespaces()
+
+if __name__ == '__main__':
+    main()
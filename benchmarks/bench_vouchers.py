@@ -0,0 +1,51 @@
+"""Benchmark bulk voucher generation and redemption.
+
+Usage: python benchmarks/bench_vouchers.py [--count 100000] [--db /tmp/bench.db]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_manager import UserManager
+from voucher_manager import VoucherManager
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--db', default=None, help="Database file (default: a temporary file)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), 'bench_vouchers.db')
+    vouchers = VoucherManager(UserManager(db_path=db_path))
+
+    started = time.perf_counter()
+    _, codes = vouchers.generate(args.count, minutes=30, amount=5)
+    elapsed = time.perf_counter() - started
+    print(f"generate: {len(codes)} vouchers in {elapsed:.2f}s ({len(codes) / elapsed:,.0f}/s)")
+
+    # Spread redemptions over many devices, like a busy shop
+    started = time.perf_counter()
+    redeemed = 0
+    for i, code in enumerate(codes):
+        mac = "02:00:00:%02X:%02X:%02X" % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+        if vouchers.redeem(code, mac):
+            redeemed += 1
+    elapsed = time.perf_counter() - started
+    print(f"redeem:   {redeemed} vouchers in {elapsed:.2f}s ({redeemed / elapsed:,.0f}/s, "
+          f"{elapsed / max(redeemed, 1) * 1000:.2f} ms each)")
+
+    started = time.perf_counter()
+    rejected = sum(1 for code in codes[:1000] if vouchers.redeem(code, "02:00:00:00:00:01") is None)
+    elapsed = time.perf_counter() - started
+    print(f"reuse:    {rejected}/1000 already-redeemed codes rejected in {elapsed:.2f}s")
+
+    print(f"database: {db_path} ({os.path.getsize(db_path) / 1024 / 1024:.1f} MB)")
+
+if __name__ == '__main__':
+    main()
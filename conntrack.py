@@ -0,0 +1,199 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import Counter
+from log_config import log_event
+
+class ConnLimits:
+    """Per-plan caps on a client's concurrent connections and new connections per second.
+
+    Configured like the rate table: CONN_LIMITS="default:200:20,premium:500:50"
+    gives each plan "max concurrent:new per second". Plans without an entry use
+    'default'; the 'throttled' plan is what the monitor moves offenders to.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(limits or {})
+
+    @classmethod
+    def from_env(cls):
+        limits = {}
+        for entry in os.getenv('CONN_LIMITS', '').split(','):
+            if entry.strip():
+                plan, concurrent, rate = entry.strip().split(':')
+                limits[plan] = (int(concurrent), int(rate))
+        if limits:
+            limits.setdefault('throttled', (int(os.getenv('CONN_THROTTLED_LIMIT', '50')),
+                                            int(os.getenv('CONN_THROTTLED_RATE', '5'))))
+        return cls(limits)
+
+    def __bool__(self):
+        return bool(self.limits)
+
+    def plan_for(self, plan):
+        """The configured plan whose limits apply to `plan`, or None when unlimited"""
+        if plan in self.limits:
+            return plan
+        return 'default' if 'default' in self.limits else None
+
+    def iptables_rules(self, mac_address, plan, action='-I'):
+        """mangle FORWARD rules capping one client (`action` '-I' adds them, '-D' removes them)"""
+        plan = self.plan_for(plan)
+        if plan is None:
+            return []
+        concurrent, rate = self.limits[plan]
+        position = ' 1' if action == '-I' else ''
+        match = f"-m mac --mac-source {mac_address} -m conntrack --ctstate NEW"
+        return [
+            f"{action} FORWARD{position} {match} -m connlimit --connlimit-above {concurrent} --connlimit-mask 32 -j DROP",
+            f"{action} FORWARD{position} {match} -m hashlimit --hashlimit-above {rate}/sec "
+            f"--hashlimit-burst {rate * 2} --hashlimit-mode srcip --hashlimit-name pw_{plan} -j DROP",
+        ]
+
+    def nft_declarations(self):
+        """nftables sets and chains implementing each plan's caps (jumped to from the mac_limits map)"""
+        lines = []
+        for plan, (concurrent, rate) in sorted(self.limits.items()):
+            lines += [
+                f"\tset conns_{plan} {{",
+                "\t\ttype ipv4_addr",
+                "\t\tsize 65535",
+                "\t\tflags dynamic",
+                "\t}",
+                "",
+                f"\tset rate_{plan} {{",
+                "\t\ttype ipv4_addr",
+                "\t\tsize 65535",
+                "\t\tflags dynamic,timeout",
+                "\t\ttimeout 1m",
+                "\t}",
+                "",
+                f"\tchain limit_{plan} {{",
+                f"\t\tadd @conns_{plan} {{ ip saddr ct count over {concurrent} }} drop",
+                f"\t\tupdate @rate_{plan} {{ ip saddr limit rate over {rate}/second burst {rate * 2} packets }} drop",
+                "\t}",
+                "",
+            ]
+        return lines
+
+
+class ConntrackMonitor:
+    """Samples conntrack table pressure and the clients behind it.
+
+    The global count is read every `interval` seconds. Only when the table is
+    at least `scan_ratio` full is the (much larger) entry list read to find
+    per-client usage. Above `warn_ratio` an alert is logged with the top
+    clients. With `throttle` enabled, each sample above `throttle_ratio` moves
+    the heaviest client to the 'throttled' connection limits; they get their
+    plan's limits back once pressure falls below `warn_ratio`.
+    """
+
+    COUNT_PATH = '/proc/sys/net/netfilter/nf_conntrack_count'
+    MAX_PATH = '/proc/sys/net/netfilter/nf_conntrack_max'
+
+    def __init__(self, network_controller, interval=10, scan_ratio=0.5, warn_ratio=0.8,
+                 throttle=False, throttle_ratio=0.9, top=5):
+        self.network_controller = network_controller
+        self.interval = interval
+        self.scan_ratio = scan_ratio
+        self.warn_ratio = warn_ratio
+        self.throttle = throttle
+        self.throttle_ratio = throttle_ratio
+        self.top = top
+        self.logger = logging.getLogger(__name__)
+        self.throttled = set()
+        self.last_sample = None
+        self.running = False
+        self.thread = None
+
+    @classmethod
+    def from_env(cls, network_controller):
+        return cls(
+            network_controller,
+            interval=int(os.getenv('CONNTRACK_MONITOR_INTERVAL', '10')),
+            warn_ratio=float(os.getenv('CONNTRACK_WARN_RATIO', '0.8')),
+            throttle=os.getenv('CONNTRACK_THROTTLE', '0') == '1',
+            throttle_ratio=float(os.getenv('CONNTRACK_THROTTLE_RATIO', '0.9'))
+        )
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='conntrack-monitor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while self.running:
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.error(f"Error sampling conntrack: {e}")
+            time.sleep(self.interval)
+
+    def _read_int(self, path):
+        with open(path) as f:
+            return int(f.read().strip())
+
+    @staticmethod
+    def count_by_client(entries, is_client):
+        """Connections per client IP from `conntrack -L` output (original-direction source)"""
+        counts = Counter()
+        for line in entries.splitlines():
+            source = re.search(r'\bsrc=(\S+)', line)
+            if source and is_client(source.group(1)):
+                counts[source.group(1)] += 1
+        return counts
+
+    def sample(self):
+        """Take one sample; returns {'count', 'max', 'ratio', 'top', 'throttled'}"""
+        count = self._read_int(self.COUNT_PATH)
+        maximum = self._read_int(self.MAX_PATH)
+        ratio = count / maximum if maximum else 0
+
+        top = []
+        if ratio >= self.scan_ratio:
+            entries = self.network_controller._execute_command("conntrack -L", ignore_errors=True)
+            is_client = lambda ip: any(radio.contains(ip) for radio in self.network_controller.radios)
+            top = self.count_by_client(entries, is_client).most_common(self.top)
+
+        if ratio >= self.warn_ratio:
+            log_event(self.logger, logging.WARNING, 'conntrack_pressure', count=count, max=maximum,
+                      ratio=round(ratio, 2), top=','.join(f"{ip}:{n}" for ip, n in top))
+        if self.throttle:
+            self._update_throttling(ratio, top)
+
+        self.last_sample = {
+            'count': count,
+            'max': maximum,
+            'ratio': round(ratio, 3),
+            'top': [{'ip': ip, 'connections': n} for ip, n in top],
+            'throttled': sorted(str(mac) for mac in self.throttled),
+            'sampled_at': time.time()
+        }
+        return self.last_sample
+
+    def _update_throttling(self, ratio, top):
+        controller = self.network_controller
+        if ratio >= self.throttle_ratio and top:
+            # One client per sample, heaviest first, until pressure drops
+            macs = {lease['ip']: mac for mac, lease in controller._read_dhcp_leases().items()}
+            for ip_address, connections in top:
+                mac_address = macs.get(ip_address)
+                if mac_address is not None and mac_address not in self.throttled:
+                    self.throttled.add(mac_address)
+                    controller.set_connection_plan(mac_address, 'throttled')
+                    log_event(self.logger, logging.WARNING, 'client_throttled', mac=mac_address,
+                              ip=ip_address, connections=connections)
+                    break
+        elif ratio < self.warn_ratio and self.throttled:
+            for mac_address in list(self.throttled):
+                controller.set_connection_plan(mac_address, None)
+                self.throttled.discard(mac_address)
+                log_event(self.logger, logging.INFO, 'client_unthrottled', mac=mac_address)
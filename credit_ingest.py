@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+import urllib.request
+from collections import OrderedDict
+
+class RateTable:
+    """Pesos to minutes pricing.
+
+    Bundles such as "5:30" (5 pesos buys 30 minutes) are applied greedily from
+    the largest price down; whatever is left is priced at the base rate.
+    """
+
+    def __init__(self, bundles=None, minutes_per_peso=1.0):
+        self.bundles = sorted((bundles or {}).items(), reverse=True)
+        self.minutes_per_peso = minutes_per_peso
+
+    @classmethod
+    def from_env(cls):
+        """Build from RATE_TABLE ("1:5,5:30,10:65") and RATE_PESOS_PER_MINUTE.
+
+        With BILLING_MODE=data the units are megabytes instead, priced by
+        DATA_RATE_TABLE ("5:100,10:250") and RATE_PESOS_PER_MB.
+        """
+        if os.getenv('BILLING_MODE', 'time') == 'data':
+            table, pesos_per_unit = os.getenv('DATA_RATE_TABLE', ''), os.getenv('RATE_PESOS_PER_MB', '0.1')
+        else:
+            table, pesos_per_unit = os.getenv('RATE_TABLE', ''), os.getenv('RATE_PESOS_PER_MINUTE', '1')
+        pesos_per_minute = float(pesos_per_unit or 1)
+        bundles = {}
+        for entry in table.split(','):
+            if entry.strip():
+                price, minutes = entry.split(':')
+                bundles[float(price)] = float(minutes)
+        return cls(bundles, 1.0 / pesos_per_minute)
+
+    def minutes_for(self, amount):
+        minutes = 0
+        remaining = amount
+        for price, bundle_minutes in self.bundles:
+            count = int(remaining // price)
+            minutes += count * bundle_minutes
+            remaining -= count * price
+
+        minutes = round(minutes + remaining * self.minutes_per_peso, 2)
+        return int(minutes) if minutes == int(minutes) else minutes
+
+
+class CreditIngestor:
+    """Buffers incoming credits and applies each burst in one database transaction.
+
+    Credits for the same MAC that arrive within `window` seconds of the first
+    pending credit are summed, priced once through the rate table and followed
+    by a single `on_credited(mac_address, amount, minutes)` callback (which the
+    app uses to unblock the device). Retried idempotency keys are ignored.
+    """
+
+    def __init__(self, user_manager, rate_table, on_credited=None, window=0.5, recent_keys=10000):
+        self.logger = logging.getLogger(__name__)
+        self.user_manager = user_manager
+        self.rate_table = rate_table
+        self.on_credited = on_credited
+        self.window = window
+        self.max_recent_keys = recent_keys
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.pending_keys = set()
+        # Recently applied keys, so retries are rejected without a DB round trip
+        self.recent_keys = OrderedDict()
+        self.first_pending_at = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join()
+        self.flush()
+
+    def submit(self, mac_address, amount, idempotency_key=None):
+        """Queue a credit; returns ('accepted' | 'duplicate', idempotency_key)"""
+        if amount <= 0:
+            raise ValueError("Amount must be positive")
+
+        key = idempotency_key or uuid.uuid4().hex
+        with self.condition:
+            if key in self.pending_keys or key in self.recent_keys:
+                return 'duplicate', key
+
+            self.pending.append((key, mac_address.upper(), amount))
+            self.pending_keys.add(key)
+            if self.first_pending_at is None:
+                self.first_pending_at = time.monotonic()
+                self.condition.notify()
+        return 'accepted', key
+
+    def flush(self):
+        """Apply everything pending now; returns {mac_address: (amount, minutes)}"""
+        with self.flush_lock:
+            with self.condition:
+                batch = self.pending
+                self.pending = []
+                self.first_pending_at = None
+
+            if not batch:
+                return {}
+
+            try:
+                credited = self.user_manager.apply_credits(batch, self.rate_table.minutes_for)
+            except Exception as e:
+                self.logger.error(f"Error applying {len(batch)} credits, will retry: {e}")
+                with self.condition:
+                    self.pending[:0] = batch
+                    if self.first_pending_at is None:
+                        self.first_pending_at = time.monotonic()
+                return {}
+
+            with self.condition:
+                for key, _, _ in batch:
+                    self.pending_keys.discard(key)
+                    self.recent_keys[key] = True
+                while len(self.recent_keys) > self.max_recent_keys:
+                    self.recent_keys.popitem(last=False)
+
+        for mac_address, (amount, minutes) in credited.items():
+            self.logger.info(f"Credited {amount} pesos ({minutes} minutes) to {mac_address}")
+            if self.on_credited:
+                try:
+                    self.on_credited(mac_address, amount, minutes)
+                except Exception as e:
+                    self.logger.error(f"Error in credit callback for {mac_address}: {e}")
+        return credited
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                while self.running and self.first_pending_at is None:
+                    self.condition.wait(timeout=1)
+                if not self.running:
+                    return
+                deadline = self.first_pending_at + self.window
+
+            # Let the rest of the burst arrive before committing
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.flush()
+            if self.pending:
+                time.sleep(1)  # Back off after a failed flush
+
+
+class PulseSimulator:
+    """Stand-in for a pulse-counting coin acceptor.
+
+    Emits one credit per pulse through `submit(mac_address, amount, key)` and,
+    like a flaky bridge, re-sends a share of pulses with the same key.
+    """
+
+    def __init__(self, submit, mac_address, pesos_per_pulse=1, retry_rate=0.0, session=None):
+        self.submit = submit
+        self.mac_address = mac_address
+        self.pesos_per_pulse = pesos_per_pulse
+        self.retry_rate = retry_rate
+        self.session = session or uuid.uuid4().hex[:8]
+
+    def run(self, pulses, interval=0.05):
+        """Send `pulses` pulses; returns how many submissions were made"""
+        sent = 0
+        for n in range(pulses):
+            key = f"sim-{self.session}-{n}"
+            self.submit(self.mac_address, self.pesos_per_pulse, key)
+            sent += 1
+            if random.random() < self.retry_rate:
+                self.submit(self.mac_address, self.pesos_per_pulse, key)
+                sent += 1
+            if interval:
+                time.sleep(interval)
+        return sent
+
+
+def http_submitter(url, api_key=None):
+    """Build a submit function that posts credits to a running /api/credit endpoint"""
+    def submit(mac_address, amount, idempotency_key):
+        body = json.dumps({'mac_address': mac_address, 'amount': amount}).encode()
+        request = urllib.request.Request(url, data=body, method='POST', headers={
+            'Content-Type': 'application/json',
+            'Idempotency-Key': idempotency_key
+        })
+        if api_key:
+            request.add_header('X-API-Key', api_key)
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return json.loads(response.read())
+    return submit
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate a coin acceptor posting credits")
+    parser.add_argument('mac_address')
+    parser.add_argument('--url', default='http://127.0.0.1:5000/api/credit')
+    parser.add_argument('--api-key', default=os.getenv('CREDIT_API_KEY'))
+    parser.add_argument('--pulses', type=int, default=10)
+    parser.add_argument('--pesos-per-pulse', type=float, default=1)
+    parser.add_argument('--interval', type=float, default=0.05)
+    parser.add_argument('--retry-rate', type=float, default=0.2)
+    args = parser.parse_args()
+
+    simulator = PulseSimulator(
+        http_submitter(args.url, args.api_key),
+        args.mac_address,
+        pesos_per_pulse=args.pesos_per_pulse,
+        retry_rate=args.retry_rate
+    )
+    sent = simulator.run(args.pulses, args.interval)
+    print(f"Sent {sent} submissions for {args.pulses} pulses (session {simulator.session})")
+    sys.exit(0)
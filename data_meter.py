@@ -0,0 +1,77 @@
+import os
+import time
+import logging
+from log_config import log_event
+from stations import Mac
+
+class DataMeter:
+    """Meters paying devices by the bytes they move, for BILLING_MODE=data.
+
+    Each tick reads every shaped client's kernel byte counters in one call
+    (NetworkController.read_usage_counters) and turns them into per-device
+    usage. Usage is written to the database every `flush_interval` seconds,
+    or straight away for a device whose unbilled usage has reached its
+    balance, so exhausted devices are blocked on the tick that used it up.
+    """
+
+    def __init__(self, user_manager, network_controller, flush_interval=60):
+        self.user_manager = user_manager
+        self.network_controller = network_controller
+        self.flush_interval = flush_interval
+        self.logger = logging.getLogger(__name__)
+        self.counters = {}   # mac -> last (download, upload) counters
+        self.pending = {}    # mac -> bytes used but not yet deducted
+        self.last_flush = time.time()
+
+    @classmethod
+    def from_env(cls, user_manager, network_controller):
+        return cls(user_manager, network_controller,
+                   flush_interval=int(os.getenv('DATA_FLUSH_INTERVAL', '60')))
+
+    def sample(self):
+        """Bytes (download + upload) each shaped client moved since the previous sample"""
+        counters = self.network_controller.read_usage_counters()
+        usage = {}
+        for mac_address, values in counters.items():
+            previous = self.counters.get(mac_address)
+            if previous is not None:
+                # A recreated class starts counting from zero again
+                usage[mac_address] = sum(value if value < last else value - last
+                                         for value, last in zip(values, previous))
+        self.counters = counters
+        return usage
+
+    def meter(self, balances, now=None):
+        """Bill usage for connected paying devices ({mac: data balance}).
+
+        Returns {mac: new data balance} for the devices deducted this tick.
+        Devices are keyed by Mac; the ledger is written with their MAC text.
+        """
+        now = time.time() if now is None else now
+        try:
+            usage = self.sample()
+        except Exception as e:
+            log_event(self.logger, logging.ERROR, 'data_meter_read_failed', error=e)
+            return {}
+
+        for mac_address, used in usage.items():
+            if mac_address in balances and used:
+                self.pending[mac_address] = self.pending.get(mac_address, 0) + used
+
+        due = now - self.last_flush >= self.flush_interval
+        flush = {mac: used for mac, used in self.pending.items()
+                 if due or used >= balances.get(mac, 0)}
+        if not flush:
+            return {}
+
+        balances = self.user_manager.deduct_data({str(mac): used for mac, used in flush.items()})
+        if balances is None:
+            # Keep the usage and retry on the next tick
+            return {}
+        balances = {Mac(mac): balance for mac, balance in balances.items()}
+        for mac_address in flush:
+            self.pending.pop(mac_address, None)
+        if due:
+            self.last_flush = now
+        log_event(self.logger, logging.DEBUG, 'data_metered', devices=len(flush), bytes=sum(flush.values()))
+        return balances
@@ -0,0 +1,96 @@
+import threading
+import logging
+
+class DeviceState:
+    """Versioned snapshot of connected devices, refreshed by the TimeManager tick.
+
+    Every change to a device bumps a global version number. Clients can use the
+    version as an ETag or ask for only the devices that changed since a version.
+    When an event bus is given, each change is also pushed to live subscribers.
+    """
+
+    # Removed devices remembered for delta queries
+    MAX_TOMBSTONES = 1024
+
+    def __init__(self, event_bus=None):
+        self.logger = logging.getLogger(__name__)
+        self.event_bus = event_bus
+        self.lock = threading.Lock()
+        self.version = 0
+        self.devices = {}   # mac -> device dict
+        self.changed = {}   # mac -> version of last change
+        self.removed = {}   # mac -> version of removal
+        # Deltas older than this version can no longer be answered exactly
+        self.min_delta_version = 0
+
+    def replace(self, devices):
+        """Replace the snapshot with the devices seen on the latest tick"""
+        with self.lock:
+            current = {}
+            for device in devices:
+                mac = device['mac_address']
+                current[mac] = device
+                if self.devices.get(mac) != device:
+                    self._mark_changed(mac, dict(device))
+
+            for mac in set(self.devices) - set(current):
+                self._mark_removed(mac)
+
+            return self.version
+
+    def update_device(self, mac_address, **fields):
+        """Merge fields into a connected device, e.g. after an admin action"""
+        with self.lock:
+            device = self.devices.get(mac_address)
+            if device is None:
+                return False
+
+            updated = dict(device)
+            updated.update(fields)
+            if updated != device:
+                self._mark_changed(mac_address, updated)
+            return True
+
+    def get_version(self):
+        with self.lock:
+            return self.version
+
+    def query(self, since=None):
+        """Return (version, devices, removed, full) for a full or delta read"""
+        with self.lock:
+            if since is None or since < self.min_delta_version or since > self.version:
+                devices = [dict(self.devices[mac]) for mac in sorted(self.devices)]
+                return self.version, devices, [], True
+
+            devices = [
+                dict(self.devices[mac])
+                for mac in sorted(self.devices)
+                if self.changed.get(mac, 0) > since
+            ]
+            removed = sorted(mac for mac, v in self.removed.items() if v > since)
+            return self.version, devices, removed, False
+
+    def _mark_changed(self, mac, device):
+        self.version += 1
+        event = 'update' if mac in self.devices else 'connect'
+        self.devices[mac] = device
+        self.changed[mac] = self.version
+        self.removed.pop(mac, None)
+        self._publish(event, dict(device))
+
+    def _mark_removed(self, mac):
+        self.version += 1
+        del self.devices[mac]
+        self.changed.pop(mac, None)
+        self.removed[mac] = self.version
+        self._publish('disconnect', {'mac_address': mac})
+
+        if len(self.removed) > self.MAX_TOMBSTONES:
+            # Forget the oldest tombstone; deltas from before it become full reads
+            oldest = min(self.removed, key=self.removed.get)
+            self.min_delta_version = self.removed.pop(oldest)
+
+    def _publish(self, event, data):
+        if self.event_bus:
+            data['version'] = self.version
+            self.event_bus.publish(event, data, event_id=self.version)
@@ -0,0 +1,86 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+def run_commands(run_command, commands, max_workers=4):
+    """Run named diagnostic commands concurrently and return {name: output}"""
+    def run(item):
+        name, command = item
+        try:
+            return name, run_command(command, ignore_errors=True)
+        except Exception as e:
+            return name, f"Error running '{command}': {e}"
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(run, commands.items()))
+
+
+class DiagnosticsCollector:
+    """Cached, concurrently gathered diagnostics for the debug endpoints.
+
+    Readers always get the last snapshot immediately. When it is older than
+    `ttl` seconds a single background refresh is started; only the very first
+    read waits for the commands to finish.
+    """
+
+    def __init__(self, run_command, commands, ttl=30, max_workers=4):
+        self.logger = logging.getLogger(__name__)
+        self.run_command = run_command
+        self.commands = commands
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.results = None
+        self.collected_at = None
+        self.duration = None
+        self.refreshing = False
+
+    def get_snapshot(self):
+        """Return the cached results with their age, refreshing them if stale"""
+        with self.lock:
+            have_results = self.results is not None
+            stale = not have_results or time.time() - self.collected_at >= self.ttl
+            start_refresh = stale and not self.refreshing
+            if start_refresh:
+                self.refreshing = True
+
+        if not have_results:
+            if start_refresh:
+                self._refresh()
+            else:
+                self._wait_for_first_refresh()
+        elif start_refresh:
+            threading.Thread(target=self._refresh, daemon=True).start()
+
+        with self.lock:
+            return {
+                'collected_at': self.collected_at,
+                'age_seconds': round(time.time() - self.collected_at, 1) if self.collected_at else None,
+                'duration_seconds': self.duration,
+                'refreshing': self.refreshing,
+                'results': dict(self.results or {})
+            }
+
+    def _refresh(self):
+        started = time.monotonic()
+        try:
+            results = run_commands(self.run_command, self.commands, self.max_workers)
+            with self.lock:
+                self.results = results
+                self.collected_at = time.time()
+                self.duration = round(time.monotonic() - started, 3)
+            self.logger.debug(f"Collected diagnostics in {self.duration}s")
+        except Exception as e:
+            self.logger.error(f"Error collecting diagnostics: {e}")
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def _wait_for_first_refresh(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.refreshing:
+                    return
+            time.sleep(0.05)
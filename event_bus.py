@@ -0,0 +1,48 @@
+import queue
+import threading
+import logging
+
+class EventBus:
+    """Fan-out of live events to Server-Sent Events subscribers"""
+
+    def __init__(self, max_queue=256):
+        self.logger = logging.getLogger(__name__)
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self):
+        """Register a subscriber and return its event queue"""
+        subscription = queue.Queue(maxsize=self.max_queue)
+        with self.lock:
+            self.subscribers.add(subscription)
+        self.logger.debug(f"Event subscriber added ({len(self.subscribers)} total)")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+        self.logger.debug(f"Event subscriber removed ({len(self.subscribers)} total)")
+
+    def publish(self, event, data, event_id=None):
+        """Queue an event for every subscriber without blocking the publisher"""
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait((event, data, event_id))
+            except queue.Full:
+                # A stalled client missed events; tell it to resync instead of blocking
+                self._reset(subscription, event_id)
+
+    def _reset(self, subscription, event_id):
+        try:
+            while True:
+                subscription.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            subscription.put_nowait(('resync', {}, event_id))
+        except queue.Full:
+            pass
@@ -0,0 +1,82 @@
+import os
+import time
+import logging
+from log_config import log_event
+
+class StationEvictor:
+    """Deauthenticates stations that only hold an association slot.
+
+    A device blocked for running out of balance gets `grace` seconds (to pay
+    at the portal) before it is sent off; any station whose `inactive time`
+    in the station dump exceeds `idle_timeout` seconds goes too (0 disables
+    that). Each eviction is a strike: a MAC evicted n times can't be evicted
+    again for min(backoff * 2**(n-1), max_backoff) seconds, so clients that
+    reconnect straight away don't churn the radio. Strikes are forgotten after
+    `max_backoff` seconds without an eviction.
+    """
+
+    def __init__(self, network_controller, grace=120, idle_timeout=900, backoff=60, max_backoff=3600):
+        self.network_controller = network_controller
+        self.grace = grace
+        self.idle_timeout = idle_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.logger = logging.getLogger(__name__)
+        self.pending = {}   # Mac -> time a blocked device may be evicted
+        self.strikes = {}   # Mac -> (evictions, time of the last one)
+
+    @classmethod
+    def from_env(cls, network_controller):
+        return cls(
+            network_controller,
+            grace=int(os.getenv('EVICT_GRACE_SECONDS', '120')),
+            idle_timeout=int(os.getenv('EVICT_IDLE_SECONDS', '900')),
+            backoff=int(os.getenv('EVICT_BACKOFF_SECONDS', '60')),
+            max_backoff=int(os.getenv('EVICT_MAX_BACKOFF_SECONDS', '3600'))
+        )
+
+    def blocked(self, mac, now=None):
+        """TimeManager hook: `mac` is blocked for lack of balance; start its grace window"""
+        now = time.time() if now is None else now
+        self.pending.setdefault(mac, now + self.grace)
+
+    def holdoff(self, mac, now):
+        """Seconds until `mac` may be evicted again (0 when it may be now)"""
+        strike = self.strikes.get(mac)
+        if strike is None:
+            return 0
+        count, last = strike
+        return max(last + min(self.backoff * 2 ** (count - 1), self.max_backoff) - now, 0)
+
+    def evict(self, stations, now=None):
+        """Deauthenticate due stations from this tick's station list; returns {Mac: reason}"""
+        now = time.time() if now is None else now
+        present = {station.mac for station in stations}
+        # Grace windows end with the association or when the device is let back in
+        for mac in list(self.pending):
+            if mac not in present or not self.network_controller.is_blocked(mac):
+                del self.pending[mac]
+        for mac, (_, last) in list(self.strikes.items()):
+            if now - last >= self.max_backoff:
+                del self.strikes[mac]
+
+        evicted = {}
+        for station in stations:
+            mac = station.mac
+            if mac in self.pending and now >= self.pending[mac]:
+                reason = 'expired'
+            elif self.idle_timeout and station.inactive_ms is not None \
+                    and station.inactive_ms >= self.idle_timeout * 1000:
+                reason = 'idle'
+            else:
+                continue
+            if self.holdoff(mac, now):
+                continue
+            if self.network_controller.deauthenticate(mac, station.interface):
+                count = self.strikes.get(mac, (0, 0))[0] + 1
+                self.strikes[mac] = (count, now)
+                self.pending.pop(mac, None)
+                evicted[mac] = reason
+                log_event(self.logger, logging.INFO, 'station_evicted', mac=mac, reason=reason,
+                          interface=station.interface, strikes=count)
+        return evicted
@@ -0,0 +1,148 @@
+import io
+import csv
+import json
+import zlib
+import sqlite3
+import logging
+from datetime import datetime, timedelta, timezone
+
+class Exporter:
+    """Streams history tables out as CSV or NDJSON.
+
+    Rows are read in keyset-paginated chunks (WHERE id > last ORDER BY id LIMIT n)
+    on a read-only connection. Each chunk is its own short read, so an export of
+    any size keeps memory flat, never takes a write lock and doesn't pin an old
+    WAL snapshot for its whole duration.
+    """
+
+    TABLES = {
+        'transactions': {
+            'select': '''
+                SELECT t.id, u.mac_address, t.amount, t.minutes, t.data_bytes, t.created_at
+                FROM transactions t LEFT JOIN users u ON u.id = t.user_id
+            ''',
+            'columns': ['id', 'mac_address', 'amount', 'minutes', 'data_bytes', 'created_at'],
+            'id': 't.id',
+            'time': 't.created_at',
+            'mac': 'u.mac_address'
+        },
+        'time_logs': {
+            'select': '''
+                SELECT id, mac_address, minutes_deducted, bytes_deducted, balance_before, balance_after,
+                       deducted_at, deduction_type
+                FROM time_logs
+            ''',
+            'columns': ['id', 'mac_address', 'minutes_deducted', 'bytes_deducted', 'balance_before',
+                        'balance_after', 'deducted_at', 'deduction_type'],
+            'id': 'id',
+            'time': 'deducted_at',
+            'mac': 'mac_address'
+        },
+        'users': {
+            'select': '''
+                SELECT id, mac_address, time_balance, data_balance, status, plan, download_limit,
+                       upload_limit, created_at, last_deduction
+                FROM users
+            ''',
+            'columns': ['id', 'mac_address', 'time_balance', 'data_balance', 'status', 'plan',
+                        'download_limit', 'upload_limit', 'created_at', 'last_deduction'],
+            'id': 'id',
+            'time': 'created_at',
+            'mac': 'mac_address'
+        }
+    }
+    FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+    def __init__(self, db_path, chunk_size=5000):
+        self.db_path = db_path
+        self.chunk_size = chunk_size
+        self.logger = logging.getLogger(__name__)
+
+    def _connect(self):
+        return sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, timeout=30)
+
+    @staticmethod
+    def _utc_bound(day):
+        """Local midnight of an ISO date, as a UTC timestamp string like the stored ones"""
+        local = datetime.strptime(day, '%Y-%m-%d')
+        return local.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    def build_query(self, table, start=None, end=None, mac_address=None):
+        """Validate filters; returns (sql, params) with a trailing keyset placeholder.
+
+        start/end are inclusive local calendar dates (YYYY-MM-DD). Raises ValueError.
+        """
+        spec = self.TABLES.get(table)
+        if spec is None:
+            raise ValueError(f"Unknown table: {table}")
+
+        conditions = [f"{spec['id']} > ?"]
+        params = []
+        if start:
+            conditions.append(f"{spec['time']} >= ?")
+            params.append(self._utc_bound(start))
+        if end:
+            next_day = (datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+            conditions.append(f"{spec['time']} < ?")
+            params.append(self._utc_bound(next_day))
+        if mac_address:
+            conditions.append(f"{spec['mac']} = ?")
+            params.append(mac_address.upper())
+
+        sql = f"{spec['select']} WHERE {' AND '.join(conditions)} ORDER BY {spec['id']} LIMIT ?"
+        return sql, params
+
+    def rows(self, table, start=None, end=None, mac_address=None):
+        """Yield matching rows as tuples, chunk by chunk"""
+        sql, params = self.build_query(table, start, end, mac_address)
+        last_id = 0
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            while True:
+                c.execute(sql, [last_id] + params + [self.chunk_size])
+                chunk = c.fetchall()
+                yield from chunk
+                if len(chunk) < self.chunk_size:
+                    return
+                last_id = chunk[-1][0]
+        finally:
+            conn.close()
+
+    def stream(self, table, fmt='csv', **filters):
+        """Yield the export as text chunks of roughly `chunk_size` rows"""
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Unknown format: {fmt}")
+        columns = self.TABLES[table]['columns'] if table in self.TABLES else []
+        rows = self.rows(table, **filters)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(columns)
+
+        count = 0
+        for row in rows:
+            if writer:
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(columns, row))) + '\n')
+            count += 1
+            if count % self.chunk_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        tail = buffer.getvalue()
+        if tail:
+            yield tail
+        self.logger.info(f"Exported {count} {table} rows as {fmt}")
+
+
+def gzip_stream(chunks, level=6):
+    """Gzip a stream of text chunks incrementally"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,134 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class FirewallWorker:
+    """The only thread that changes iptables and tc state.
+
+    Callers queue the state they want per MAC (access and shaping separately)
+    and get a Future back. Requests for the same MAC and kind that are still
+    pending are coalesced so only the latest one is applied; every coalesced
+    caller's future resolves with that result. Each pass applies all pending
+    access changes in one iptables-restore batch.
+    """
+
+    def __init__(self, network_controller, window=0.05):
+        self.network_controller = network_controller
+        self.window = window
+        self.logger = logging.getLogger(__name__)
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()  # key -> [kind, args, futures]
+        self.sequence = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='firewall-worker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join()
+        self._apply(self._drain())
+
+    def set_access(self, mac_address, state):
+        """Queue 'allowed' or 'blocked' for a MAC"""
+        return self._submit((mac_address, 'access'), 'access', (state,))
+
+    def set_shaping(self, mac_address, download_kbps=None, upload_kbps=None, ip_address=None):
+        """Queue shaping limits for a MAC; no limits means remove its shaping"""
+        return self._submit((mac_address, 'shaping'), 'shaping', (download_kbps, upload_kbps, ip_address))
+
+    def call(self, function, *args):
+        """Queue an arbitrary network change to run in order with the others"""
+        with self.condition:
+            self.sequence += 1
+            key = ('call', self.sequence)
+        return self._submit(key, 'call', (function,) + args)
+
+    def _submit(self, key, kind, args):
+        future = Future()
+        if threading.current_thread() is self.thread or not self.running:
+            # Already on the worker (or not started yet): apply inline
+            self._apply([(key, kind, args, [future])])
+            return future
+
+        with self.condition:
+            if key in self.pending:
+                entry = self.pending.pop(key)
+                entry[1] = args
+                entry[2].append(future)
+            else:
+                entry = [kind, args, [future]]
+            # Re-queue at the end so it still runs after anything submitted before it
+            self.pending[key] = entry
+            self.condition.notify()
+        return future
+
+    def _drain(self):
+        with self.condition:
+            batch = [(key, kind, args, futures) for key, (kind, args, futures) in self.pending.items()]
+            self.pending.clear()
+        return batch
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait(timeout=1)
+                if not self.running:
+                    return
+            # Let concurrent requests pile up so they coalesce and batch
+            time.sleep(self.window)
+            try:
+                self._apply(self._drain())
+            except Exception as e:
+                self.logger.error(f"Error in firewall worker: {e}")
+
+    def _apply(self, batch):
+        """Run a drained batch in order, grouping consecutive access changes"""
+        access = []
+        for item in batch:
+            if item[1] == 'access':
+                access.append(item)
+                continue
+            self._apply_access(access)
+            access = []
+            self._apply_one(item)
+        self._apply_access(access)
+
+    def _apply_access(self, items):
+        if not items:
+            return
+        changes = OrderedDict((key[0], args[0]) for key, _, args, _ in items)
+        try:
+            results = self.network_controller._apply_access(changes)
+        except Exception as e:
+            self.logger.error(f"Error applying {len(changes)} access changes: {e}")
+            results = {}
+        for key, _, _, futures in items:
+            for future in futures:
+                future.set_result(results.get(key[0], False))
+
+    def _apply_one(self, item):
+        key, kind, args, futures = item
+        try:
+            if kind == 'shaping':
+                result = self.network_controller._apply_shaping(key[0], *args)
+            else:
+                function, *call_args = args
+                result = function(*call_args)
+        except Exception as e:
+            self.logger.error(f"Error applying {kind} change: {e}")
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future in futures:
+            future.set_result(result)
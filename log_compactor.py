@@ -0,0 +1,236 @@
+import os
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+
+class LogCompactor:
+    """Rolls raw time_logs up into hourly/daily aggregates and prunes old raw rows.
+
+    Work is done in small batches, each in its own short transaction, tracked by
+    a watermark on time_logs.id, so metering writes are never held up for long
+    and an interrupted run simply continues where it stopped.
+    """
+
+    def __init__(self, db_path, retention_days=30, hourly_retention_days=90,
+                 batch_size=500, pause=0.05, interval=300):
+        self.db_path = db_path
+        self.retention_days = retention_days
+        self.hourly_retention_days = hourly_retention_days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.logger = logging.getLogger(__name__)
+        self.running = False
+        self.thread = None
+        self._init_db()
+
+    @classmethod
+    def from_env(cls, db_path):
+        return cls(
+            db_path,
+            retention_days=int(os.getenv('TIME_LOG_RETENTION_DAYS', '30')),
+            hourly_retention_days=int(os.getenv('HOURLY_RETENTION_DAYS', '90')),
+            batch_size=int(os.getenv('COMPACTION_BATCH_SIZE', '500')),
+            interval=int(os.getenv('COMPACTION_INTERVAL', '300'))
+        )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _init_db(self):
+        """Initialize rollup tables"""
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            for table, period in (('time_logs_hourly', 'hour'), ('time_logs_daily', 'day')):
+                c.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        mac_address TEXT,
+                        {period} TEXT,
+                        user_id INTEGER,
+                        minutes_deducted REAL,
+                        bytes_deducted INTEGER DEFAULT 0,
+                        deductions INTEGER,
+                        PRIMARY KEY (mac_address, {period})
+                    ) WITHOUT ROWID
+                ''')
+                # Columns added after the first release
+                c.execute(f'PRAGMA table_info({table})')
+                if 'bytes_deducted' not in {row[1] for row in c.fetchall()}:
+                    c.execute(f'ALTER TABLE {table} ADD COLUMN bytes_deducted INTEGER DEFAULT 0')
+                c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{period} ON {table} ({period})')
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS compaction_state (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER
+                )
+            ''')
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error initializing rollup tables: {e}")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while self.running:
+            try:
+                self.run_once()
+            except Exception as e:
+                self.logger.error(f"Error compacting time logs: {e}")
+            # Sleep in short steps so stop() stays responsive
+            deadline = time.monotonic() + self.interval
+            while self.running and time.monotonic() < deadline:
+                time.sleep(1)
+
+    def run_once(self):
+        """Roll up and prune until caught up; returns (rolled_up, pruned) row counts"""
+        started = time.monotonic()
+        rolled_up = pruned = 0
+
+        while True:
+            count = self.rollup_batch()
+            rolled_up += count
+            if count < self.batch_size:
+                break
+            time.sleep(self.pause)
+
+        while True:
+            count = self.prune_batch()
+            pruned += count
+            if count < self.batch_size:
+                break
+            time.sleep(self.pause)
+
+        pruned += self.prune_hourly()
+
+        if rolled_up or pruned:
+            self.logger.info(f"Compacted time logs: {rolled_up} rolled up, {pruned} pruned "
+                             f"in {time.monotonic() - started:.1f}s")
+        return rolled_up, pruned
+
+    def get_watermark(self, c):
+        c.execute("SELECT value FROM compaction_state WHERE name = 'time_logs_rolled_up'")
+        row = c.fetchone()
+        return row[0] if row else 0
+
+    def rollup_batch(self):
+        """Aggregate the next batch of raw rows; returns how many were rolled up"""
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            watermark = self.get_watermark(c)
+            c.execute('''
+                SELECT COUNT(*), MAX(id) FROM (
+                    SELECT id FROM time_logs WHERE id > ? ORDER BY id LIMIT ?
+                )
+            ''', (watermark, self.batch_size))
+            count, upper = c.fetchone()
+            if not count:
+                conn.rollback()
+                return 0
+
+            # Periods are local time, like the reports built on them
+            for table, period, fmt in (('time_logs_hourly', 'hour', '%Y-%m-%d %H:00:00'),
+                                       ('time_logs_daily', 'day', '%Y-%m-%d')):
+                c.execute(f'''
+                    INSERT INTO {table} (mac_address, {period}, user_id, minutes_deducted, bytes_deducted, deductions)
+                    SELECT mac_address, strftime('{fmt}', deducted_at, 'localtime'), MAX(user_id),
+                           SUM(minutes_deducted), SUM(COALESCE(bytes_deducted, 0)), COUNT(*)
+                    FROM time_logs
+                    WHERE id > ? AND id <= ?
+                    GROUP BY mac_address, strftime('{fmt}', deducted_at, 'localtime')
+                    ON CONFLICT (mac_address, {period}) DO UPDATE SET
+                        user_id = excluded.user_id,
+                        minutes_deducted = minutes_deducted + excluded.minutes_deducted,
+                        bytes_deducted = bytes_deducted + excluded.bytes_deducted,
+                        deductions = deductions + excluded.deductions
+                ''', (watermark, upper))
+
+            c.execute('''
+                INSERT INTO compaction_state (name, value) VALUES ('time_logs_rolled_up', ?)
+                ON CONFLICT (name) DO UPDATE SET value = excluded.value
+            ''', (upper,))
+            conn.commit()
+            return count
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def prune_batch(self):
+        """Delete one batch of rolled-up raw rows older than the retention period"""
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            watermark = self.get_watermark(c)
+            # Only rows already counted in the rollups may go. Rows are written in
+            # time order, so looking at the oldest batch keeps each pass O(batch)
+            c.execute('''
+                DELETE FROM time_logs
+                WHERE id IN (SELECT id FROM time_logs WHERE id <= ? ORDER BY id LIMIT ?)
+                  AND deducted_at < datetime('now', ?)
+            ''', (watermark, self.batch_size, f'-{self.retention_days} days'))
+            count = c.rowcount
+            conn.commit()
+            return count
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def prune_hourly(self):
+        """Drop hourly rollups past their retention; daily rollups are kept"""
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute("DELETE FROM time_logs_hourly WHERE hour < strftime('%Y-%m-%d %H:00:00', 'now', 'localtime', ?)",
+                      (f'-{self.hourly_retention_days} days',))
+            count = c.rowcount
+            conn.commit()
+            return count
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Roll up and prune time_logs")
+    parser.add_argument('--db', default='config/piso_wifi.db')
+    parser.add_argument('--vacuum', action='store_true',
+                        help="Rebuild the database file afterwards to return freed space (stop the service first)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    compactor = LogCompactor.from_env(args.db)
+    compactor.run_once()
+
+    if args.vacuum:
+        conn = sqlite3.connect(args.db)
+        conn.execute('VACUUM')
+        conn.close()
+        print(f"Vacuumed {args.db}: {os.path.getsize(args.db) / 1024 / 1024:.1f} MB")
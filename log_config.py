@@ -0,0 +1,175 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_ring_buffer = None
+
+
+class StructuredMessage:
+    """Key-value log message that is only rendered when a handler formats it"""
+
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        parts = [self.event]
+        for key, value in self.fields.items():
+            value = str(value)
+            if not value or ' ' in value or '=' in value:
+                value = repr(value)
+            parts.append(f"{key}={value}")
+        return ' '.join(parts)
+
+
+def log_event(logger, level, event, **fields):
+    """Log a structured event, rate-limited per event name and (when given) per device.
+
+    Keying on the `mac` field keeps one chatty device from suppressing the
+    same event, e.g. a credit or a block, for every other device.
+    """
+    if logger.isEnabledFor(level):
+        key = (event, str(fields['mac'])) if 'mac' in fields else event
+        logger.log(level, StructuredMessage(event, fields), extra={'event_key': key}, stacklevel=2)
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the most recent records in memory instead of writing them to disk"""
+
+    def __init__(self, capacity=2000, level=logging.DEBUG):
+        super().__init__(level)
+        self.records = deque(maxlen=capacity)
+        self.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    def emit(self, record):
+        # Records are formatted lazily when the buffer is dumped
+        self.records.append(record)
+
+    def dump(self, limit=None, level=logging.NOTSET):
+        """Return the buffered records, oldest first, as formatted lines"""
+        records = [r for r in list(self.records) if r.levelno >= level]
+        if limit:
+            records = records[-limit:]
+
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception as e:
+                lines.append(f"<unformattable record from {record.name}: {e}>")
+        return lines
+
+    def clear(self):
+        self.records.clear()
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `burst` records per message key through each `interval` seconds.
+
+    The key is the record's `event_key` (set by log_event: the event name, plus
+    the device for events about one) or else its call site.
+    Suppressed records are counted and reported with the next record let through.
+    """
+
+    def __init__(self, interval=60, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.windows = {}  # key -> [window_start, emitted, suppressed]
+
+    def filter(self, record):
+        # The same filter is shared by several handlers; decide once per record
+        decision = getattr(record, '_rate_limit_passed', None)
+        if decision is None:
+            decision = record._rate_limit_passed = self._check(record)
+        return decision
+
+    def _check(self, record):
+        key = getattr(record, 'event_key', None) or (record.pathname, record.lineno)
+        now = time.monotonic()
+
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                if len(self.windows) > 4096:
+                    self._prune(now)
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+
+        if suppressed:
+            record.msg = f"{record.getMessage()} (suppressed {suppressed} similar messages)"
+            record.args = None
+        return True
+
+    def _prune(self, now):
+        expired = [k for k, w in self.windows.items() if now - w[0] >= self.interval]
+        for key in expired:
+            del self.windows[key]
+
+
+def configure_logging():
+    """Set up rate-limited persistent logging plus an in-memory DEBUG ring buffer.
+
+    LOG_LEVEL controls what reaches stderr (and LOG_FILE when set); everything
+    down to DEBUG is kept only in the ring buffer until it is dumped.
+    """
+    global _ring_buffer
+
+    if _ring_buffer is not None:
+        return _ring_buffer
+    root = logging.getLogger()
+
+    level = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+    rate_limit = RateLimitFilter(
+        interval=float(os.getenv('LOG_RATE_INTERVAL', '60')),
+        burst=int(os.getenv('LOG_RATE_BURST', '5'))
+    )
+
+    handlers = [logging.StreamHandler()]
+    log_file = os.getenv('LOG_FILE')
+    if log_file:
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        handlers.append(RotatingFileHandler(log_file, maxBytes=1024 * 1024, backupCount=3))
+
+    for handler in handlers:
+        handler.setLevel(level)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(rate_limit)
+        root.addHandler(handler)
+
+    _ring_buffer = RingBufferHandler(capacity=int(os.getenv('LOG_RING_SIZE', '2000')))
+    root.addHandler(_ring_buffer)
+    root.setLevel(logging.DEBUG)
+
+    # Third-party request logs are noise at DEBUG
+    logging.getLogger('werkzeug').setLevel(logging.INFO)
+    return _ring_buffer
+
+
+def get_ring_buffer():
+    return _ring_buffer
+
+
+def dump_ring_buffer(logger, limit=200):
+    """Write the recent in-memory records to the persistent log, e.g. on failure"""
+    if _ring_buffer is None:
+        return 0
+
+    lines = _ring_buffer.dump(limit=limit)
+    logger.error("=== Recent debug log (%d records) ===\n%s", len(lines), '\n'.join(lines),
+                 extra={'event_key': 'ring_dump'})
+    return len(lines)
@@ -1,11 +1,31 @@
 import logging
 import threading
 import time
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+import json
+import queue
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, flash, session, g
 from datetime import datetime
-from user_manager import UserManager
+from user_manager import UserManager, BYTES_PER_MB
 from network_controller import NetworkController
 from time_manager import TimeManager
+from event_bus import EventBus
+from log_config import configure_logging, get_ring_buffer
+from credit_ingest import CreditIngestor, RateTable
+from voucher_manager import VoucherManager
+from log_compactor import LogCompactor
+from reports import ReportManager
+from exporter import Exporter, gzip_stream
+from user_browser import UserBrowser
+from admission import AdmissionIndex
+from node_sync import NodeSync
+from portal_responder import PortalResponder
+from conntrack import ConntrackMonitor
+from traffic import TrafficAccounting, RESOLUTIONS, sparkline
+from data_meter import DataMeter
+from eviction import StationEvictor
+from profiling import Profiler
+from stations import to_mac
+from ap_config import FIELDS as RADIO_FIELDS
 from dotenv import load_dotenv
 import sqlite3
 import os
@@ -13,11 +33,8 @@ import os
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging (rate-limited output, DEBUG kept in memory)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -28,6 +45,44 @@ app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-here')  # Make sure to
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
 
+# Key required by /api/credit; without one only local clients may post credits
+CREDIT_API_KEY = os.getenv('CREDIT_API_KEY')
+if CREDIT_API_KEY == 'change-me':
+    # The placeholder from older .env.example files is public; don't accept it as a key
+    logger.error("CREDIT_API_KEY is still the 'change-me' placeholder; ignoring it, "
+                 "so only local clients may post credits until a real key is set")
+    CREDIT_API_KEY = None
+
+# Key peers must send to pull balance events; without one only local clients may pull
+SYNC_KEY = os.getenv('SYNC_KEY')
+
+# Pesos -> minutes pricing shared by the admin form and credit ingestion
+rate_table = RateTable.from_env()
+
+# Live dashboard events (device connect/disconnect, balance, plan, block state)
+event_bus = EventBus()
+
+# On-demand profiles and the slow tick/request watchdog
+profiler = Profiler.from_env()
+
+# Long-lived or profiler-facing endpoints that shouldn't count as requests
+UNPROFILED_ENDPOINTS = {'events', 'static', 'debug_profile', 'debug_slow'}
+
+# Per-device traffic time series, fed by the station dump on every tick
+traffic = TrafficAccounting.from_env()
+app.jinja_env.filters['sparkline'] = sparkline
+
+@app.before_request
+def begin_profiled_request():
+    if request.endpoint not in UNPROFILED_ENDPOINTS:
+        g.profiler_section = profiler.begin('request', request.endpoint or request.path)
+
+@app.teardown_request
+def end_profiled_request(exc):
+    section = g.pop('profiler_section', None)
+    if section is not None:
+        profiler.end(section)
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -57,6 +112,11 @@ def init_services():
         # Initialize user manager
         logger.info("Initializing user manager...")
         user_manager = UserManager()
+        voucher_manager = VoucherManager(user_manager)
+        log_compactor = LogCompactor.from_env(user_manager.db_path)
+        report_manager = ReportManager(user_manager.db_path)
+        exporter = Exporter(user_manager.db_path)
+        user_browser = UserBrowser(user_manager.db_path)
         logger.info("User manager initialized")
         
         # Initialize network controller with retry
@@ -75,48 +135,199 @@ def init_services():
                     raise
                 time.sleep(5)  # Wait before retrying
         
+        # Admit newly associated stations from an in-memory index kept in sync with user writes
+        admission = AdmissionIndex(user_manager, network_controller)
+        admission.load()
+        user_manager.add_listener(admission.refresh)
+        network_controller.admission_handler = admission.admit
+        network_controller.plan_lookup = lambda mac: (admission.lookup(mac) or (None, None))[1]
+        network_controller.traffic_handler = traffic.record
+        
+        # Re-admit users that still have time before any traffic is handled
+        logger.info("Restoring access for active users...")
+        network_controller.restore_state(user_manager.get_active_users())
+        
         # Initialize time manager
         logger.info("Initializing time manager...")
-        time_manager = TimeManager()
+        time_manager = TimeManager(
+            user_manager=user_manager,
+            network_controller=network_controller,
+            event_bus=event_bus,
+            data_meter=DataMeter.from_env(user_manager, network_controller)
+                       if user_manager.billing_mode == 'data' else None,
+            profiler=profiler,
+            evictor=StationEvictor.from_env(network_controller)
+                    if os.getenv('STATION_EVICTION', '0') == '1' else None
+        )
         logger.info("Time manager initialized")
         
-        return user_manager, network_controller, time_manager
+        # Cached diagnostics for /debug/connections (the controller's failure dumps share them)
+        diagnostics = network_controller.diagnostics
+        
+        # Burst-grouping, idempotent credit ingestion for coin acceptors
+        credit_ingestor = CreditIngestor(
+            user_manager,
+            rate_table,
+            on_credited=on_credited,
+            window=float(os.getenv('CREDIT_BATCH_WINDOW', '0.5'))
+        )
+        
+        # Balance replication with the other units in the venue (SYNC_PEERS)
+        node_sync = NodeSync.from_env(user_manager, on_merged=on_synced)
+        
+        # Redirects for unpaid clients' HTTP and OS connectivity probes, outside Flask
+        portal_responder = PortalResponder.from_env(mac_lookup=network_controller.mac_for_ip) \
+                           if network_controller.captive_portal else None
+        
+        # NAT table pressure and per-client connection counts
+        conntrack_monitor = ConntrackMonitor.from_env(network_controller)
+        
+        return (user_manager, network_controller, time_manager, diagnostics,
+                credit_ingestor, voucher_manager, log_compactor, report_manager, exporter,
+                user_browser, node_sync, portal_responder, conntrack_monitor)
     except Exception as e:
         logger.error(f"Error initializing services: {e}")
         raise
 
+def on_credited(mac_address, amount, minutes):
+    """Unblock a device once per applied credit burst"""
+    network_controller.unblock_mac(mac_address)
+    refresh_device_state(mac_address)
+
+def on_synced(deltas):
+    """Show balances changed on other units in the live dashboard"""
+    for mac_address in deltas:
+        refresh_device_state(mac_address)
+
+def refresh_device_state(mac_address):
+    """Push a device's latest balance and plan into the shared device snapshot"""
+    try:
+        info = user_manager.get_users([mac_address]).get(mac_address)
+        if info:
+            info['blocked'] = network_controller.is_blocked(mac_address)
+            time_manager.device_state.update_device(mac_address, **info)
+    except Exception as e:
+        logger.error(f"Error refreshing device state for {mac_address}: {e}")
+
+# Fields the JSON device API can return
+API_DEVICE_FIELDS = (
+    'mac_address', 'ip', 'hostname', 'signal', 'time_balance', 'data_balance',
+    'plan', 'download_limit', 'upload_limit', 'upgrade_requested', 'blocked'
+)
+
+def wants_json():
+    """Whether the request came from the dashboard's async form handler"""
+    return request.accept_mimetypes.best == 'application/json'
+
+def action_response(message, category='success', status=200):
+    """Answer an admin action with JSON for async forms, or flash and redirect"""
+    if wants_json():
+        return jsonify({
+            'success': category not in ('error', 'warning'),
+            'message': message,
+            'category': category
+        }), status
+    flash(message, category)
+    return redirect(url_for('index'))
+
+@app.route('/api/devices')
+def api_devices():
+    """Compact JSON view of connected devices with ETag and delta support.
+
+    Served from the snapshot the time manager refreshes every tick, so polling
+    clients never trigger a station scan or per-device database queries.
+    """
+    try:
+        device_state = time_manager.device_state
+        version = device_state.get_version()
+        etag = str(version)
+
+        # The payload for a given URL only changes when the version does
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        fields = API_DEVICE_FIELDS
+        if request.args.get('fields'):
+            fields = [f for f in request.args['fields'].split(',') if f in API_DEVICE_FIELDS]
+            if not fields:
+                return jsonify({'error': 'No valid fields requested'}), 400
+            if 'mac_address' not in fields:
+                fields.insert(0, 'mac_address')
+
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = min(200, max(1, request.args.get('per_page', 50, type=int)))
+        since = request.args.get('since', type=int)
+
+        version, devices, removed, full = device_state.query(since)
+        start = (page - 1) * per_page
+        response = jsonify({
+            'version': version,
+            'full': full,
+            'total': len(devices),
+            'page': page,
+            'per_page': per_page,
+            'devices': [
+                {field: device.get(field) for field in fields}
+                for device in devices[start:start + per_page]
+            ],
+            'removed': removed
+        })
+        response.set_etag(str(version))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        logger.error(f"Error in api_devices route: {e}")
+        return jsonify({'error': 'Internal Server Error'}), 500
+
+@app.route('/events')
+def events():
+    """Server-Sent Events stream of device changes for the live dashboard"""
+    # Reconnecting browsers send the last event id they saw
+    if request.headers.get('Last-Event-ID', '').isdigit():
+        since = int(request.headers['Last-Event-ID'])
+    else:
+        since = request.args.get('since', type=int)
+
+    def stream():
+        subscription = event_bus.subscribe()
+        try:
+            # Catch the client up on anything missed before it subscribed
+            version, devices, removed, full = time_manager.device_state.query(since)
+            yield "retry: 3000\n\n"
+            if since is None or full or devices or removed:
+                snapshot = {'full': full, 'devices': devices, 'removed': removed, 'version': version}
+                yield f"id: {version}\nevent: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            while True:
+                try:
+                    event, data, event_id = subscription.get(timeout=15)
+                except queue.Empty:
+                    # Comment line keeps proxies and the connection alive
+                    yield ": keepalive\n\n"
+                    continue
+                if event_id is not None and event_id <= version:
+                    continue
+                yield f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/')
 def index():
     try:
-        logger.debug("Getting connected devices...")
-        connected_devices = network_controller.get_connected_devices()
-        logger.debug(f"Found devices: {connected_devices}")
-        
-        # Add time balance and bandwidth info to each device
-        for device in connected_devices:
-            mac = device['mac_address']
-            device['time_balance'] = user_manager.check_balance(mac)
-            
-            # Get bandwidth and plan info
-            conn = sqlite3.connect(user_manager.db_path)
-            c = conn.cursor()
-            c.execute('SELECT download_limit, upload_limit, plan, upgrade_requested FROM users WHERE mac_address = ?', (mac,))
-            info = c.fetchone()
-            conn.close()
-            
-            if info:
-                device['download_limit'] = info[0]
-                device['upload_limit'] = info[1]
-                device['plan'] = info[2]
-                device['upgrade_requested'] = info[3]
-            else:
-                device['download_limit'] = network_controller.DEFAULT_DOWNLOAD_SPEED
-                device['upload_limit'] = network_controller.DEFAULT_UPLOAD_SPEED
-                device['plan'] = 'default'
-                device['upgrade_requested'] = False
-        
-        logger.debug(f"Devices with balance: {connected_devices}")
-        return render_template('index.html', devices=connected_devices, is_admin=session.get('is_admin', False))
+        # Render from the time manager's snapshot instead of re-scanning stations
+        version, devices, _, _ = time_manager.device_state.query()
+        return render_template(
+            'index.html',
+            devices=devices,
+            version=version,
+            is_admin=session.get('is_admin', False)
+        )
     except Exception as e:
         logger.error(f"Error in index route: {e}")
         return "Internal Server Error", 500
@@ -126,74 +337,414 @@ def add_time():
     try:
         mac_address = request.form.get('mac_address')
         amount = int(request.form.get('amount'))
-        # Convert amount to minutes (1 peso = 1 minute)
-        minutes = amount * 1
+        minutes = rate_table.minutes_for(amount)
         
         logger.info(f"Adding {minutes} minutes for MAC {mac_address}")
         if user_manager.add_time(mac_address, amount, minutes):
             network_controller.unblock_mac(mac_address)
-            return redirect(url_for('index'))
-        return "Error adding time", 400
+            refresh_device_state(mac_address)
+            unit = 'MB' if user_manager.billing_mode == 'data' else 'minutes'
+            return action_response(f'Added {minutes} {unit}')
+        return action_response('Error adding time', 'error', 400)
     except Exception as e:
         logger.error(f"Error in add_time route: {e}")
-        return "Internal Server Error", 500
+        return action_response('Internal Server Error', 'error', 500)
+
+@app.route('/api/credit', methods=['POST'])
+def api_credit():
+    """Idempotent credit ingestion for coin acceptors and payment bridges.
+
+    Accepts JSON or form fields `mac_address` and `amount` (pesos) plus an
+    `Idempotency-Key` header (or `idempotency_key` field). Credits are applied
+    asynchronously in bursts; retries with the same key are ignored.
+    """
+    try:
+        if CREDIT_API_KEY:
+            if request.headers.get('X-API-Key') != CREDIT_API_KEY:
+                return jsonify({'error': 'Invalid API key'}), 401
+        elif request.remote_addr not in ('127.0.0.1', '::1') and not session.get('is_admin'):
+            return jsonify({'error': 'Set CREDIT_API_KEY to accept remote credits'}), 403
+
+        data = request.get_json(silent=True) or request.form
+        mac_address = data.get('mac_address')
+        amount = float(data.get('amount', 0))
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+
+        mac = to_mac(mac_address)
+        if mac is None:
+            return jsonify({'error': 'Invalid MAC address'}), 400
+        if amount <= 0:
+            return jsonify({'error': 'Amount must be positive'}), 400
+
+        # Stored the way station dumps spell it, whatever separators/case the caller used
+        status, key = credit_ingestor.submit(str(mac), amount, idempotency_key)
+        return jsonify({'status': status, 'idempotency_key': key}), 202 if status == 'accepted' else 200
+    except ValueError:
+        return jsonify({'error': 'Invalid amount'}), 400
+    except Exception as e:
+        logger.error(f"Error in api_credit route: {e}")
+        return jsonify({'error': 'Internal Server Error'}), 500
+
+@app.route('/api/sync/pull', methods=['POST'])
+def api_sync_pull():
+    """Balance events this unit has beyond the caller's version vector (see node_sync.py)"""
+    try:
+        if SYNC_KEY:
+            if request.headers.get('X-Sync-Key') != SYNC_KEY:
+                return jsonify({'error': 'Invalid sync key'}), 401
+        elif request.remote_addr not in ('127.0.0.1', '::1'):
+            return jsonify({'error': 'Set SYNC_KEY to sync with remote units'}), 403
+
+        return jsonify(node_sync.handle_pull(request.get_json(silent=True) or {}))
+    except Exception as e:
+        logger.error(f"Error in api_sync_pull route: {e}")
+        return jsonify({'error': 'Internal Server Error'}), 500
+
+@app.route('/redeem', methods=['GET', 'POST'])
+def redeem():
+    """Redeem a printed voucher code for time on a device"""
+    if request.method == 'GET':
+        # The portal redirect passes the client's MAC; fall back to its lease
+        mac = to_mac(request.args.get('mac_address'))
+        if mac is None:
+            mac = network_controller.mac_for_ip(request.remote_addr)
+        return render_template('redeem.html', mac_address=str(mac) if mac is not None else '')
+
+    try:
+        mac = to_mac(request.form.get('mac_address'))
+        code = request.form.get('code', '')
+
+        if mac is None:
+            return action_response('Invalid MAC address', 'error', 400)
+        mac_address = str(mac)
+        if not code.strip():
+            return action_response('Please enter a voucher code', 'error', 400)
+
+        result = voucher_manager.redeem(code, mac_address)
+        if result is None:
+            return action_response('Invalid or already used voucher code', 'error', 400)
+
+        amount, minutes = result
+        on_credited(mac_address, amount, minutes)
+        return action_response(f'Voucher redeemed: {minutes:g} minutes added')
+    except Exception as e:
+        logger.error(f"Error in redeem route: {e}")
+        return action_response('Internal Server Error', 'error', 500)
+
+@app.route('/vouchers/generate', methods=['POST'])
+def generate_vouchers():
+    """Generate a batch of vouchers and download the codes as CSV (admin only)"""
+    try:
+        if not session.get('is_admin'):
+            return action_response('Admin access required', 'error', 403)
+
+        count = int(request.form.get('count', 0))
+        amount = float(request.form.get('amount', 0))
+        minutes = float(request.form.get('minutes') or rate_table.minutes_for(amount))
+
+        if not 0 < count <= 100000 or minutes <= 0:
+            return action_response('Enter 1-100000 vouchers and a positive amount or minutes', 'error', 400)
+
+        batch_id, codes = voucher_manager.generate(count, minutes, amount)
+        lines = ['code,minutes,amount'] + [f"{code},{minutes:g},{amount:g}" for code in codes]
+        return Response('\n'.join(lines) + '\n', mimetype='text/csv', headers={
+            'Content-Disposition': f'attachment; filename=vouchers-{batch_id}.csv'
+        })
+    except ValueError:
+        return action_response('Invalid voucher parameters', 'error', 400)
+    except Exception as e:
+        logger.error(f"Error generating vouchers: {e}")
+        return action_response('Error generating vouchers', 'error', 500)
+
+def report_range():
+    """Resolve ?start=&end= (ISO dates) or ?period=today|week|month"""
+    start = request.args.get('start')
+    end = request.args.get('end')
+    if start or end:
+        start = datetime.strptime(start or end, '%Y-%m-%d').date().isoformat()
+        end = datetime.strptime(end or start, '%Y-%m-%d').date().isoformat()
+        return start, end
+    return ReportManager.period_range(request.args.get('period', 'today'))
+
+@app.route('/reports')
+def reports():
+    """Revenue and usage summaries (admin only)"""
+    if not session.get('is_admin'):
+        flash('Admin access required', 'error')
+        return redirect(url_for('login'))
+    try:
+        start, end = report_range()
+    except ValueError:
+        flash('Invalid report range', 'error')
+        start, end = ReportManager.period_range('today')
+    try:
+        return render_template('reports.html', report=report_manager.summary(start, end),
+                               period=request.args.get('period'))
+    except Exception as e:
+        logger.error(f"Error loading reports: {e}")
+        flash('Error loading reports', 'error')
+        return redirect(url_for('index'))
+
+@app.route('/api/reports')
+def api_reports():
+    """Revenue and usage summaries as JSON (admin only)"""
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+    try:
+        start, end = report_range()
+    except ValueError:
+        return jsonify({'error': 'Use start/end as YYYY-MM-DD or period=today|week|month'}), 400
+    try:
+        return jsonify(report_manager.summary(start, end))
+    except Exception as e:
+        logger.error(f"Error in reports API: {e}")
+        return jsonify({'error': 'Internal Server Error'}), 500
+
+@app.route('/admin/users')
+def admin_users():
+    """Browse all users, connected or not (admin only)"""
+    if not session.get('is_admin'):
+        flash('Admin access required', 'error')
+        return redirect(url_for('login'))
+    try:
+        query = request.args.get('q', '').strip()
+        field = request.args.get('field') if request.args.get('field') in ('mac', 'hostname') else None
+        limit = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+        users, next_cursor = user_browser.list_users(query, field, request.args.get('after'), limit)
+        return render_template('users.html', users=users, next_cursor=next_cursor,
+                               query=query, field=field, per_page=limit)
+    except Exception as e:
+        logger.error(f"Error browsing users: {e}")
+        flash('Error loading users', 'error')
+        return redirect(url_for('index'))
+
+@app.route('/admin/users/<mac_address>')
+def admin_user_detail(mac_address):
+    """A user's balance, plan changes, transactions and deductions (admin only)"""
+    if not session.get('is_admin'):
+        flash('Admin access required', 'error')
+        return redirect(url_for('login'))
+    try:
+        user = user_browser.get_user(mac_address)
+        if user is None:
+            flash('User not found', 'error')
+            return redirect(url_for('admin_users'))
+        transactions, transactions_next = user_browser.get_transactions(
+            user['id'], request.args.get('transactions_before'))
+        time_logs, time_logs_next = user_browser.get_time_logs(
+            user['mac_address'], request.args.get('logs_before'))
+        return render_template(
+            'user_detail.html',
+            user=user,
+            plan_changes=user_browser.get_plan_changes(user['mac_address']),
+            transactions=transactions,
+            transactions_next=transactions_next,
+            time_logs=time_logs,
+            time_logs_next=time_logs_next,
+            traffic={resolution: traffic.series(user['mac_address'], resolution, size)
+                     for resolution, (step, size) in RESOLUTIONS.items()}
+        )
+    except Exception as e:
+        logger.error(f"Error loading user {mac_address}: {e}")
+        flash('Error loading user', 'error')
+        return redirect(url_for('admin_users'))
+
+@app.route('/export/<table>')
+def export(table):
+    """Stream transactions, time_logs or users as CSV/NDJSON (admin only).
+
+    Filters: start/end (YYYY-MM-DD, inclusive), mac; format=csv|ndjson.
+    Gzipped when the client sends Accept-Encoding: gzip.
+    """
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+
+    fmt = request.args.get('format', 'csv')
+    filters = {
+        'start': request.args.get('start'),
+        'end': request.args.get('end'),
+        'mac_address': request.args.get('mac')
+    }
+    try:
+        # Validate up front; once streaming starts the status can't change
+        exporter.build_query(table, **filters)
+        if fmt not in Exporter.FORMATS:
+            raise ValueError(f"Unknown format: {fmt}")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    body = exporter.stream(table, fmt, **filters)
+    headers = {'Content-Disposition': f'attachment; filename={table}.{fmt}'}
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, mimetype=Exporter.FORMATS[fmt], headers=headers)
 
 @app.route('/deduct_time', methods=['POST'])
 def deduct_time():
     try:
         mac_address = request.form.get('mac_address')
         minutes = int(request.form.get('minutes', 0))
+        # In data mode the form amount is MB, taken from the balance check_balance reads
+        unit = 'MB' if user_manager.billing_mode == 'data' else 'minutes'
         
         if minutes <= 0:
-            flash('Please enter a valid number of minutes', 'error')
-            return redirect(url_for('index'))
+            return action_response(f'Please enter a valid number of {unit}', 'error', 400)
         
-        logger.info(f"Manually deducting {minutes} minutes from {mac_address}")
+        logger.info(f"Manually deducting {minutes} {unit} from {mac_address}")
         
-        # Deduct time
-        if user_manager.deduct_time(mac_address, minutes):
+        if user_manager.billing_mode == 'data':
+            deducted = mac_address in (user_manager.deduct_data({mac_address: minutes * BYTES_PER_MB}) or {})
+        else:
+            deducted = user_manager.deduct_time(mac_address, minutes)
+        if deducted:
             # Check if balance is now zero
             new_balance = user_manager.check_balance(mac_address)
             if new_balance <= 0:
                 network_controller.block_mac(mac_address)
                 logger.info(f"Blocked {mac_address} due to zero balance after manual deduction")
-            flash(f'Successfully deducted {minutes} minutes', 'success')
-        else:
-            flash('Error deducting time', 'error')
-            
-        return redirect(url_for('index'))
+            refresh_device_state(mac_address)
+            return action_response(f'Successfully deducted {minutes} {unit}')
+        return action_response('Error deducting time', 'error', 400)
     except Exception as e:
         logger.error(f"Error in deduct_time route: {e}")
-        flash('Internal Server Error', 'error')
-        return redirect(url_for('index'))
+        return action_response('Internal Server Error', 'error', 500)
+
+@app.route('/api/traffic')
+def api_traffic():
+    """Download/upload kbps per bucket and byte totals for every device seen recently"""
+    resolution = request.args.get('resolution', '5s')
+    if resolution not in RESOLUTIONS:
+        return jsonify({'error': f"resolution must be one of {', '.join(RESOLUTIONS)}"}), 400
+    points = min(max(request.args.get('points', 60, type=int), 1), RESOLUTIONS[resolution][1])
+    return jsonify({
+        'resolution': resolution,
+        'step': RESOLUTIONS[resolution][0],
+        'devices': traffic.summary(resolution, points)
+    })
+
+@app.route('/api/traffic/<mac_address>')
+def api_device_traffic(mac_address):
+    """One device's byte and packet counts per bucket, oldest first"""
+    resolution = request.args.get('resolution', '5s')
+    if resolution not in RESOLUTIONS:
+        return jsonify({'error': f"resolution must be one of {', '.join(RESOLUTIONS)}"}), 400
+    points = min(max(request.args.get('points', 60, type=int), 1), RESOLUTIONS[resolution][1])
+    series = traffic.series(mac_address, resolution, points)
+    if series is None:
+        return jsonify({'error': 'No traffic recorded for this device'}), 404
+    return jsonify(series)
 
 @app.route('/debug/connections')
 def debug_connections():
     """Debug endpoint to check connection status"""
     try:
-        # Get connected devices
-        devices = network_controller.get_connected_devices()
+        # Devices come from the time manager snapshot; command output from the
+        # cached collector, so repeated hits don't re-run iw/ip/iptables
+        _, devices, _, _ = time_manager.device_state.query()
+        snapshot = diagnostics.get_snapshot()
         
-        # Get interface status
-        ap_status = network_controller._execute_command(f"ip addr show {network_controller.ap_interface}")
-        internet_status = network_controller._execute_command(f"ip addr show {network_controller.internet_interface}")
-        
-        # Get hostapd status
-        hostapd_status = network_controller._execute_command("systemctl status hostapd")
-        
-        # Get iptables rules
-        iptables_rules = network_controller._execute_command("iptables -L -n -v")
-        
-        return jsonify({
-            'connected_devices': devices,
-            'ap_interface_status': ap_status,
-            'internet_interface_status': internet_status,
-            'hostapd_status': hostapd_status,
-            'iptables_rules': iptables_rules
-        })
+        response = {'connected_devices': devices}
+        response.update(snapshot['results'])
+        response['collected_at'] = snapshot['collected_at']
+        response['age_seconds'] = snapshot['age_seconds']
+        response['refreshing'] = snapshot['refreshing']
+        return jsonify(response)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/debug/logs')
+def debug_logs():
+    """Dump the in-memory debug log ring buffer (admin only)"""
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+
+    ring_buffer = get_ring_buffer()
+    if ring_buffer is None:
+        return jsonify({'error': 'Debug ring buffer is not configured'}), 404
+
+    limit = request.args.get('limit', 500, type=int)
+    level = getattr(logging, request.args.get('level', 'DEBUG').upper(), logging.DEBUG)
+    lines = ring_buffer.dump(limit=limit, level=level)
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """Arm a profile of the next N ticks or requests (POST), or fetch its results (admin only).
+
+    POST target=tick|request, count=N, mode=cprofile|sample.
+    GET format=json (progress), pstats (sort, limit) or collapsed (flamegraph input).
+    """
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+
+    if request.method == 'POST':
+        params = request.get_json(silent=True) or request.form
+        try:
+            profile = profiler.arm(params.get('target', 'tick'), int(params.get('count', 10)),
+                                   params.get('mode', 'cprofile'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(profile.summary()), 202
+
+    profile = profiler.session
+    if profile is None:
+        return jsonify({'error': 'No profile has been armed'}), 404
+    fmt = request.args.get('format', 'json')
+    if fmt == 'pstats':
+        try:
+            text = profile.pstats_text(request.args.get('sort', 'cumulative'), request.args.get('limit', 50, type=int))
+        except KeyError:
+            return jsonify({'error': 'Unknown sort key'}), 400
+        return Response(text, mimetype='text/plain')
+    if fmt == 'collapsed':
+        return Response(profile.collapsed(), mimetype='text/plain')
+    return jsonify(profile.summary())
+
+@app.route('/debug/slow')
+def debug_slow():
+    """Stacks captured from ticks and requests that overran their threshold (admin only)"""
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+    return jsonify({'thresholds': profiler.thresholds, 'slow': list(profiler.slow)})
+
+@app.route('/debug/conntrack')
+def debug_conntrack():
+    """Latest conntrack table sample: usage, heaviest clients, throttled MACs (admin only)"""
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+    if conntrack_monitor.last_sample is None:
+        return jsonify({'error': 'No sample yet'}), 404
+    return jsonify(conntrack_monitor.last_sample)
+
+@app.route('/api/ap', methods=['GET', 'POST'])
+def api_ap():
+    """Radio settings (GET), or plan and apply a live change to one radio (POST); admin only.
+
+    POST interface plus any of ssid, channel, hw_mode, max_clients, dhcp_start
+    and dhcp_end. With dry_run=1 the steps it would take (and whether any of
+    them disconnects clients) are returned without touching the AP.
+    """
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+
+    if request.method == 'GET':
+        return jsonify({'radios': [
+            dict({field: getattr(radio, field) for field in RADIO_FIELDS},
+                 interface=radio.interface, ip=radio.ip, dhcp_range=list(radio.dhcp_range()))
+            for radio in network_controller.radios
+        ]})
+
+    params = dict(request.get_json(silent=True) or request.form)
+    interface = params.pop('interface', None) or network_controller.ap_interface
+    dry_run = str(params.pop('dry_run', '0')).lower() in ('1', 'true', 'yes')
+    try:
+        result = network_controller.reconfigure_radio(interface, params, dry_run=dry_run)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    failed = not dry_run and result['steps'] and not result['applied']
+    return jsonify(result), 500 if failed else 200
+
 @app.route('/set_bandwidth', methods=['POST'])
 def set_bandwidth():
     try:
@@ -203,28 +754,23 @@ def set_bandwidth():
         
         # Validate input
         if download < 32 or upload < 32:
-            flash('Minimum bandwidth is 32 kbps', 'error')
-            return redirect(url_for('index'))
+            return action_response('Minimum bandwidth is 32 kbps', 'error', 400)
         
         if download > 100000 or upload > 100000:
-            flash('Maximum bandwidth is 100 Mbps', 'error')
-            return redirect(url_for('index'))
+            return action_response('Maximum bandwidth is 100 Mbps', 'error', 400)
         
         # Update database
-        if user_manager.set_bandwidth(mac_address, download, upload):
-            # Apply network rules
-            if network_controller.set_bandwidth_limit(mac_address, download, upload):
-                flash('Bandwidth limits updated successfully', 'success')
-            else:
-                flash('Error applying bandwidth limits', 'error')
-        else:
-            flash('Error updating bandwidth settings', 'error')
-            
-        return redirect(url_for('index'))
+        if not user_manager.set_bandwidth(mac_address, download, upload):
+            return action_response('Error updating bandwidth settings', 'error', 500)
+        refresh_device_state(mac_address)
+        
+        # Apply network rules
+        if network_controller.set_bandwidth_limit(mac_address, download, upload):
+            return action_response('Bandwidth limits updated successfully')
+        return action_response('Error applying bandwidth limits', 'error', 500)
     except Exception as e:
         logger.error(f"Error in set_bandwidth route: {e}")
-        flash('Internal Server Error', 'error')
-        return redirect(url_for('index'))
+        return action_response('Internal Server Error', 'error', 500)
 
 @app.route('/request_upgrade', methods=['POST'])
 def request_upgrade():
@@ -237,20 +783,19 @@ def request_upgrade():
         c.execute('UPDATE users SET upgrade_requested = 1 WHERE mac_address = ?', (mac_address,))
         conn.commit()
         conn.close()
+        user_manager.notify_changed([mac_address])
+        refresh_device_state(mac_address)
         
-        flash('Premium upgrade requested. Please wait for admin approval.', 'success')
-        return redirect(url_for('index'))
+        return action_response('Premium upgrade requested. Please wait for admin approval.')
     except Exception as e:
         logger.error(f"Error requesting upgrade: {e}")
-        flash('Error requesting upgrade', 'error')
-        return redirect(url_for('index'))
+        return action_response('Error requesting upgrade', 'error', 500)
 
 @app.route('/manage_plan', methods=['POST'])
 def manage_plan():
     try:
         if not session.get('is_admin'):
-            flash('Admin access required', 'error')
-            return redirect(url_for('index'))
+            return action_response('Admin access required', 'error', 403)
             
         mac_address = request.form.get('mac_address')
         new_plan = request.form.get('plan')
@@ -262,8 +807,8 @@ def manage_plan():
         current_plan = c.fetchone()
         
         if current_plan and current_plan[0] == new_plan:
-            flash('Device is already on this plan', 'info')
-            return redirect(url_for('index'))
+            conn.close()
+            return action_response('Device is already on this plan', 'info')
         
         # Remove existing bandwidth limits
         network_controller.remove_bandwidth_limit(mac_address)
@@ -285,39 +830,49 @@ def manage_plan():
                 upgrade_requested = 0
             WHERE mac_address = ?
         ''', (new_plan, download_speed, upload_speed, mac_address))
+        c.execute('INSERT INTO plan_changes (mac_address, old_plan, new_plan) VALUES (?, ?, ?)',
+                  (mac_address, current_plan[0] if current_plan else None, new_plan))
         
         conn.commit()
         conn.close()
-        
-        # Apply new bandwidth limits
-        if network_controller.set_bandwidth_limit(mac_address, download_speed, upload_speed):
-            flash(f'Plan updated to {new_plan}. New speeds: {download_speed}kbps down / {upload_speed}kbps up', 'success')
-        else:
-            flash(f'Plan updated but there was an issue applying bandwidth limits', 'warning')
+        user_manager.notify_changed([mac_address])
+        refresh_device_state(mac_address)
             
         # Log the change
         logger.info(f"Updated plan for {mac_address} to {new_plan} with speeds: {download_speed}/{upload_speed}")
         
-        return redirect(url_for('index'))
+        # Apply the new plan's connection limits and bandwidth
+        network_controller.set_connection_plan(mac_address)
+        if network_controller.set_bandwidth_limit(mac_address, download_speed, upload_speed):
+            return action_response(f'Plan updated to {new_plan}. New speeds: {download_speed}kbps down / {upload_speed}kbps up')
+        return action_response('Plan updated but there was an issue applying bandwidth limits', 'warning')
     except Exception as e:
         logger.error(f"Error managing plan: {e}")
-        flash('Error updating plan', 'error')
-        return redirect(url_for('index'))
+        return action_response('Error updating plan', 'error', 500)
 
 if __name__ == '__main__':
     try:
         logger.info("Starting PISO WIFI application...")
         
         # Initialize services
-        user_manager, network_controller, time_manager = init_services()
+        (user_manager, network_controller, time_manager, diagnostics,
+         credit_ingestor, voucher_manager, log_compactor, report_manager, exporter,
+         user_browser, node_sync, portal_responder, conntrack_monitor) = init_services()
         
-        # Start time manager only (it handles connection monitoring)
+        # Start time manager (it handles connection monitoring)
         logger.info("Starting time manager...")
         time_manager.start()
+        credit_ingestor.start()
+        log_compactor.start()
+        node_sync.start()
+        if portal_responder:
+            portal_responder.start()
+        conntrack_monitor.start()
+        profiler.start()
         
         # Start Flask application
         logger.info("Starting web server...")
-        app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
+        app.run(host='0.0.0.0', port=int(os.getenv('FLASK_PORT', '5000')), debug=True, use_reloader=False)
         
     except Exception as e:
         logger.error(f"Fatal error: {e}")
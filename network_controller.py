@@ -3,17 +3,37 @@ import logging
 import subprocess
 import re
 import time
+import tempfile
+import threading
+import ipaddress
 import netifaces
 from enum import Enum
+from log_config import log_event, dump_ring_buffer
+from diagnostics import run_commands, DiagnosticsCollector
+from firewall_worker import FirewallWorker
+from radios import radios_from_env, HOSTAPD_CTRL_DIR
+from nft_backend import NftBackend
+from conntrack import ConnLimits
+from stations import Mac, Station, to_mac
+from ap_config import FIELDS as RADIO_FIELDS, plan_reconfigure
+
+class HostapdUnreachable(RuntimeError):
+    """hostapd_cli couldn't connect to hostapd's control interface"""
+
 
 class NetworkController:
     def __init__(self):
         """Initialize Network Controller"""
         try:
-            # Set up logging first
-            logging.basicConfig(level=logging.DEBUG)
+            # Logging is configured by the application (see log_config)
             self.logger = logging.getLogger(__name__)
             self.logger.info("Initializing Network Controller...")
+            self.worker = None
+            self.diagnostics = None
+            
+            # Failures tend to repeat every tick; debug dumps are limited to one per interval
+            self.debug_dump_interval = int(os.getenv('DEBUG_DUMP_INTERVAL', '300'))
+            self._last_debug_dump = None
             
             # Bandwidth plans (define these FIRST)
             self.DEFAULT_DOWNLOAD_SPEED = 2048  # 2 Mbps
@@ -22,27 +42,84 @@ class NetworkController:
             self.PREMIUM_UPLOAD_SPEED = 8096    # 8 Mbps
             
             # Get environment variables
-            self.ap_interface = os.getenv('WIFI_INTERFACE', 'wlan0')
+            self.radios = radios_from_env()
             self.internet_interface = os.getenv('INTERNET_INTERFACE', 'wlan1')
-            self.ssid = os.getenv('AP_SSID', 'PisoWiFi')
             self.password = os.getenv('AP_PASSWORD', 'pisowifi123')
-            self.ip = os.getenv('AP_IP', '192.168.4.1')
             
-            self.logger.info(f"Using AP interface: {self.ap_interface}")
+            # Captive portal: HTTP from unpaid MACs is redirected to the probe responder
+            self.captive_portal = os.getenv('CAPTIVE_PORTAL', '0') == '1'
+            self.portal_port = int(os.getenv('PORTAL_PORT', '8081'))
+            
+            # Per-plan caps on each client's connections (CONN_LIMITS); empty means unlimited
+            self.conn_limits = ConnLimits.from_env()
+            
+            # 'iptables' (rule per client) or 'nftables' (verdict/mark maps, atomic reloads)
+            self.firewall_backend = os.getenv('FIREWALL_BACKEND', 'iptables')
+            self.flowtable = os.getenv('FLOWTABLE', '0') == '1'
+            if self.flowtable and self.firewall_backend != 'nftables':
+                self.logger.warning("FLOWTABLE needs FIREWALL_BACKEND=nftables; keeping the regular forward path")
+                self.flowtable = False
+            self.nft = None
+            if self.firewall_backend == 'nftables':
+                self.nft = NftBackend(self.radios, self.internet_interface, self._execute_command,
+                                      captive_portal=self.captive_portal, portal_port=self.portal_port,
+                                      flowtable=self.flowtable, conn_limits=self.conn_limits)
+            
+            # Offloaded packets bypass the mark chain, so with a flowtable tc classifies by address
+            self.use_marks = self.nft is not None and not self.flowtable
+            
+            # The first radio doubles as the primary AP (portal address, diagnostics)
+            self.ap_interface = self.radios[0].interface
+            self.ssid = self.radios[0].ssid
+            self.ip = self.radios[0].ip
+            
+            for radio in self.radios:
+                self.logger.info(f"Using AP interface: {radio.interface} (SSID: {radio.ssid}, IP: {radio.ip}, "
+                                 f"channel {radio.channel}, up to {radio.max_clients} clients)")
             self.logger.info(f"Using Internet interface: {self.internet_interface}")
-            self.logger.info(f"SSID: {self.ssid}")
-            self.logger.info(f"IP: {self.ip}")
             
-            # Paths for config files
-            self.hostapd_conf = '/etc/hostapd/hostapd.conf'
+            # Cached diagnostics, shared by /debug/connections and failure dumps
+            self.diagnostics = DiagnosticsCollector(self._execute_command, self.diagnostic_commands(),
+                                                    ttl=int(os.getenv('DIAGNOSTICS_TTL', '30')))
+            
+            # Paths for config files (hostapd configs are per radio)
             self.dnsmasq_conf = '/etc/dnsmasq.conf'
             
-            # Keep track of connected devices
+            # One live reconfiguration at a time (see reconfigure_radio)
+            self.reconfigure_lock = threading.Lock()
+            
+            # Keep track of connected devices and the radio each one is on.
+            # Per-client state below is keyed by Mac (the address as an int).
             self.connected_devices = set()
+            self.station_interface = {}
+            
+            # Last firewall state applied per MAC ('allowed' or 'blocked')
+            self.access_state = {}
+            
+            # Client IP each MAC's shaping filters were installed for, and the
+            # (download, upload) limits they were installed with
+            self.shaped = {}
+            self.shaped_limits = {}
+            
+            # Optional handler(mac, ip) deciding access for newly associated stations
+            self.admission_handler = None
+            
+            # Optional handler({mac: counters}) fed from every station dump (traffic accounting)
+            self.traffic_handler = None
+            
+            # Connection limits: plan_lookup(mac) gives a client's plan, plan_overrides
+            # replace it (e.g. 'throttled'), limit_plans is what's installed per allowed MAC
+            self.plan_lookup = None
+            self.plan_overrides = {}
+            self.limit_plans = {}
             
             # Verify system requirements
             self._verify_requirements()
             
+            # All iptables/tc changes for clients are serialized through this worker
+            self.worker = FirewallWorker(self)
+            self.worker.start()
+            
             # Configure and start AP
             self.logger.info("Configuring access point...")
             self._configure_ap()
@@ -62,6 +139,9 @@ class NetworkController:
         except Exception as e:
             self.logger.error(f"Failed to initialize Network Controller: {e}")
             self._dump_debug_info()
+            if self.worker:
+                # Don't leave the worker thread behind a controller that never came up
+                self.worker.stop()
             raise
 
     def _verify_requirements(self):
@@ -73,12 +153,15 @@ class NetworkController:
             if os.geteuid() != 0:
                 raise Exception("Must run as root")
             
-            # Check if interface exists
-            if not os.path.exists(f"/sys/class/net/{self.ap_interface}"):
-                raise Exception(f"Interface {self.ap_interface} does not exist")
+            # Check if interfaces exist
+            for radio in self.radios:
+                if not os.path.exists(f"/sys/class/net/{radio.interface}"):
+                    raise Exception(f"Interface {radio.interface} does not exist")
             
             # Check for required commands
-            required_commands = ['hostapd', 'dnsmasq', 'iw', 'ip', 'iptables']
+            required_commands = ['hostapd', 'dnsmasq', 'iw', 'ip', 'nft' if self.nft else 'iptables']
+            if self.flowtable:
+                required_commands.append('conntrack')
             for cmd in required_commands:
                 if not self._command_exists(cmd):
                     raise Exception(f"Required command '{cmd}' not found")
@@ -87,7 +170,7 @@ class NetworkController:
             try:
                 iw_output = self._execute_command(f"iw list | grep -A 4 'Supported interface modes'")
                 if "AP" not in iw_output:
-                    raise Exception(f"Interface {self.ap_interface} does not support AP mode")
+                    raise Exception("Wireless hardware does not support AP mode")
             except Exception as e:
                 self.logger.warning(f"Could not verify AP mode support: {e}")
             
@@ -107,57 +190,35 @@ class NetworkController:
             # Create hostapd directory if it doesn't exist
             os.makedirs('/etc/hostapd', exist_ok=True)
             
-            # Configure hostapd with open network settings
-            hostapd_config = f"""
-# Interface configuration
-interface={self.ap_interface}
-driver=nl80211
-ssid={self.ssid}
-
-# Hardware configuration
-hw_mode=g
-channel=7
-ieee80211n=1
-wmm_enabled=0
-
-# Open network configuration
-auth_algs=1
-ignore_broadcast_ssid=0
-
-# Debugging
-logger_syslog=-1
-logger_syslog_level=2
-logger_stdout=-1
-logger_stdout_level=2
-
-# Stability settings
-beacon_int=100
-dtim_period=2
-max_num_sta=10
-rts_threshold=2347
-fragm_threshold=2346
-"""
-            # Write hostapd configuration
-            with open(self.hostapd_conf, 'w') as f:
-                f.write(hostapd_config.strip())
-            
-            # Set proper ownership and permissions
-            self._execute_command(f"chown root:root {self.hostapd_conf}")
-            self._execute_command(f"chmod 644 {self.hostapd_conf}")
-            
-            # Configure dnsmasq
-            dnsmasq_config = f"""
-# Interface configuration
-interface={self.ap_interface}
+            # Configure hostapd with open network settings, one config per radio
+            for radio in self.radios:
+                self._write_hostapd_config(radio)
+            
+            self._write_dnsmasq_config(self.radios)
+            
+            self.logger.info("AP configuration completed")
+            
+        except Exception as e:
+            self.logger.error(f"Error configuring AP: {e}")
+            raise
+    
+    def _write_hostapd_config(self, radio):
+        with open(radio.hostapd_conf, 'w') as f:
+            f.write(radio.hostapd_config())
+        
+        # Set proper ownership and permissions
+        self._execute_command(f"chown root:root {radio.hostapd_conf}")
+        self._execute_command(f"chmod 644 {radio.hostapd_conf}")
+    
+    def _write_dnsmasq_config(self, radios):
+        """Configure dnsmasq with a DHCP scope per radio"""
+        scopes = '\n\n'.join(radio.dnsmasq_scope() for radio in radios)
+        dnsmasq_config = f"""
+# Interface and DHCP configuration (one scope per radio)
+{scopes}
 no-dhcp-interface=lo
 bind-interfaces
 
-# DHCP server configuration
-dhcp-range={os.getenv('DHCP_RANGE_START', '192.168.4.2')},{os.getenv('DHCP_RANGE_END', '192.168.4.20')},{os.getenv('NETWORK_MASK', '255.255.255.0')},24h
-dhcp-option=option:router,{self.ip}
-dhcp-option=option:dns-server,{self.ip}
-dhcp-option=option:netmask,{os.getenv('NETWORK_MASK', '255.255.255.0')}
-
 # DNS configuration
 no-resolv
 no-poll
@@ -168,18 +229,104 @@ server=8.8.4.4
 log-queries
 log-dhcp
 """
-            # Write dnsmasq configuration
-            with open(self.dnsmasq_conf, 'w') as f:
-                f.write(dnsmasq_config.strip())
-            
-            self._execute_command(f"chown root:root {self.dnsmasq_conf}")
-            self._execute_command(f"chmod 644 {self.dnsmasq_conf}")
-            
-            self.logger.info("AP configuration completed")
-            
+        with open(self.dnsmasq_conf, 'w') as f:
+            f.write(dnsmasq_config.strip())
+        
+        self._execute_command(f"chown root:root {self.dnsmasq_conf}")
+        self._execute_command(f"chmod 644 {self.dnsmasq_conf}")
+    
+    def reconfigure_radio(self, interface, settings, dry_run=False):
+        """Change a running radio's settings ({field: value}) with as little disruption as possible.
+
+        Returns the plan summary (see ap_config.plan_reconfigure): with
+        `dry_run` nothing is changed, otherwise each step gets a 'result' of
+        'ok', 'fallback' (the live path was refused and the daemon restarted),
+        'failed' (with its 'error') or 'skipped', and 'applied' tells whether
+        the radio now runs the new settings. Raises ValueError for unknown radios or bad settings.
+        """
+        radio = next((radio for radio in self.radios if radio.interface == interface), None)
+        if radio is None:
+            raise ValueError(f"Unknown radio {interface}")
+        with self.reconfigure_lock:
+            plan = plan_reconfigure(radio, settings, self.dnsmasq_conf)
+            summary = plan.summary()
+            if dry_run or not plan.steps:
+                return dict(summary, dry_run=dry_run, applied=False)
+
+            radios = [plan.updated if other is radio else other for other in self.radios]
+            failed = False
+            for step in summary['steps']:
+                if failed:
+                    step['result'] = 'skipped'
+                    continue
+                step['result'] = self._run_reconfigure_step(step, plan.updated, radios)
+                failed = step['result'] == 'failed'
+                if step['result'] == 'fallback':
+                    # The restart took the radio's stations with it
+                    step['disconnects'] = True
+            summary['disconnects_clients'] = any(step['disconnects'] for step in summary['steps']
+                                                 if step.get('result') in ('ok', 'fallback'))
+
+            if failed:
+                # Put the files back so a later restart doesn't pick up half a change
+                try:
+                    self._write_hostapd_config(radio)
+                    self._write_dnsmasq_config(self.radios)
+                except Exception as e:
+                    self.logger.error(f"Error restoring AP config files: {e}")
+            else:
+                for field in RADIO_FIELDS:
+                    setattr(radio, field, getattr(plan.updated, field))
+                if radio is self.radios[0]:
+                    self.ssid = radio.ssid
+            log_event(self.logger, logging.WARNING if failed else logging.INFO, 'radio_reconfigured',
+                      interface=interface, changes=','.join(plan.changes), applied=not failed,
+                      disconnects=summary['disconnects_clients'])
+            return dict(summary, dry_run=False, applied=not failed)
+
+    def _run_reconfigure_step(self, step, updated, radios):
+        """Run one step of a reconfiguration plan; returns its result"""
+        try:
+            if step['action'] == 'write_hostapd_config':
+                self._write_hostapd_config(updated)
+            elif step['action'] == 'write_dnsmasq_config':
+                self._write_dnsmasq_config(radios)
+            else:
+                for command in step['commands']:
+                    if command.startswith('hostapd_cli'):
+                        self._hostapd_command(command)
+                    else:
+                        self._execute_command(command)
+            return 'ok'
         except Exception as e:
-            self.logger.error(f"Error configuring AP: {e}")
-            raise
+            # The fallback is for a driver refusing the live path, not for hostapd being unreachable
+            if not step.get('fallback') or isinstance(e, HostapdUnreachable):
+                self.logger.error(f"AP reconfiguration step {step['action']} failed: {e}")
+                step['error'] = str(e)
+                return 'failed'
+            self.logger.warning(f"AP reconfiguration step {step['action']} refused ({e}), restarting hostapd instead")
+        try:
+            for command in step['fallback']:
+                self._execute_command(command)
+            return 'fallback'
+        except Exception as e:
+            self.logger.error(f"AP reconfiguration fallback for {step['action']} failed: {e}")
+            step['error'] = str(e)
+            return 'failed'
+
+    def _hostapd_command(self, command):
+        """Run a hostapd_cli command; raises unless hostapd replies OK"""
+        try:
+            output = self._execute_command(command)
+        except subprocess.CalledProcessError as e:
+            output = f"{e.stdout or ''}{e.stderr or ''}"
+        if 'Failed to connect' in output:
+            raise HostapdUnreachable(f"{command}: no hostapd control socket in {HOSTAPD_CTRL_DIR} "
+                                     f"(is ctrl_interface set in the hostapd config?)")
+        # Exit status is 0 either way; the reply is OK or FAIL
+        if 'OK' not in output.split():
+            raise RuntimeError(f"{command}: {output.strip() or 'no reply'}")
+        return output
     
     def start_ap(self):
         """Start the WiFi Access Point"""
@@ -203,23 +350,25 @@ log-dhcp
             
             time.sleep(1)
             
-            # Stop NetworkManager only for AP interface
-            try:
-                self._execute_command(f"nmcli device set {self.ap_interface} managed no")
-            except subprocess.CalledProcessError as e:
-                self.logger.warning(f"Could not set {self.ap_interface} to unmanaged: {e}")
-            
-            # Configure AP interface
             self._execute_command("rfkill unblock wifi")
-            self._execute_command(f"ip link set {self.ap_interface} down")
-            self._execute_command(f"iw dev {self.ap_interface} set type __ap")
-            self._execute_command(f"ip addr flush dev {self.ap_interface}")
-            self._execute_command(f"ip addr add {self.ip}/24 dev {self.ap_interface}")
-            self._execute_command(f"ip link set {self.ap_interface} up")
+            for radio in self.radios:
+                # Stop NetworkManager only for AP interfaces
+                try:
+                    self._execute_command(f"nmcli device set {radio.interface} managed no")
+                except subprocess.CalledProcessError as e:
+                    self.logger.warning(f"Could not set {radio.interface} to unmanaged: {e}")
+                
+                # Configure AP interface
+                self._execute_command(f"ip link set {radio.interface} down")
+                self._execute_command(f"iw dev {radio.interface} set type __ap")
+                self._execute_command(f"ip addr flush dev {radio.interface}")
+                self._execute_command(f"ip addr add {radio.ip}/{radio.prefix_length} dev {radio.interface}")
+                self._execute_command(f"ip link set {radio.interface} up")
             time.sleep(1)
             
-            # Start hostapd with explicit configuration
-            self._execute_command(f"hostapd -B -P /run/hostapd.pid {self.hostapd_conf}")
+            # Start one hostapd per radio with explicit configuration
+            for radio in self.radios:
+                self._execute_command(f"hostapd -B -P {radio.pid_file} {radio.hostapd_conf}")
             time.sleep(2)
             self._check_ap_status()
             
@@ -228,41 +377,123 @@ log-dhcp
             
             # Enable IP forwarding and NAT with better control
             self._execute_command("echo 1 > /proc/sys/net/ipv4/ip_forward")
-            self._execute_command("iptables -t nat -F")
-            self._execute_command("iptables -F")
-            
-            # Default policies
-            self._execute_command("iptables -P FORWARD DROP")  # Default deny
-            self._execute_command("iptables -P INPUT ACCEPT")
-            self._execute_command("iptables -P OUTPUT ACCEPT")
-            
-            # Allow established connections
-            self._execute_command("iptables -A FORWARD -m state --state ESTABLISHED,RELATED -j ACCEPT")
-            
-            # NAT rules
-            self._execute_command(f"iptables -t nat -A POSTROUTING -o {self.internet_interface} -j MASQUERADE")
-            
-            # Allow DNS and DHCP
-            self._execute_command(f"iptables -A FORWARD -i {self.ap_interface} -p udp --dport 53 -j ACCEPT")
-            self._execute_command(f"iptables -A FORWARD -i {self.ap_interface} -p udp --dport 67:68 -j ACCEPT")
-            
-            # Allow access to local web interface
-            self._execute_command(f"iptables -A FORWARD -i {self.ap_interface} -d {self.ip} -j ACCEPT")
-            
-            # Block all other forward traffic by default (redundant but explicit)
-            self._execute_command(f"iptables -A FORWARD -i {self.ap_interface} -j DROP")
+            if self.nft:
+                self._load_nft_ruleset()
+                # The table now holds the whole policy; clear legacy rules that would also filter
+                for command in ("iptables -P FORWARD ACCEPT", "iptables -F", "iptables -t nat -F", "iptables -t mangle -F"):
+                    self._execute_command(command, ignore_errors=True)
+            else:
+                self._load_iptables_rules()
             
             # Verify hostapd is running
             if not self._check_hostapd_running():
                 raise Exception("Hostapd failed to start")
                 
-            self.logger.info(f"Started WiFi Access Point: {self.ssid}")
+            self.logger.info(f"Started WiFi Access Point on {len(self.radios)} radio(s): "
+                             f"{', '.join(radio.interface for radio in self.radios)}")
             
         except Exception as e:
             self.logger.error(f"Failed to start WiFi Access Point: {e}")
             self._dump_debug_info()
             raise
 
+    def _load_iptables_rules(self):
+        """Base iptables policy: default deny, NAT, DNS/DHCP and the portal page"""
+        self._execute_command("iptables -t nat -F")
+        self._execute_command("iptables -t mangle -F")
+        self._execute_command("iptables -F")
+        
+        # Default policies
+        self._execute_command("iptables -P FORWARD DROP")  # Default deny
+        self._execute_command("iptables -P INPUT ACCEPT")
+        self._execute_command("iptables -P OUTPUT ACCEPT")
+        
+        # Allow established connections
+        self._execute_command("iptables -A FORWARD -m state --state ESTABLISHED,RELATED -j ACCEPT")
+        
+        # NAT rules
+        self._execute_command(f"iptables -t nat -A POSTROUTING -o {self.internet_interface} -j MASQUERADE")
+        
+        if self.captive_portal:
+            # Unpaid clients' HTTP goes to the probe responder; paying MACs get a RETURN rule
+            self._execute_command("iptables -t nat -N PORTAL", ignore_errors=True)
+            self._execute_command("iptables -t nat -F PORTAL")
+            self._execute_command(f"iptables -t nat -A PORTAL -p tcp -j REDIRECT --to-ports {self.portal_port}")
+            for radio in self.radios:
+                self._execute_command(f"iptables -t nat -A PREROUTING -i {radio.interface} -p tcp --dport 80 -j PORTAL")
+        
+        for radio in self.radios:
+            # Allow DNS and DHCP
+            self._execute_command(f"iptables -A FORWARD -i {radio.interface} -p udp --dport 53 -j ACCEPT")
+            self._execute_command(f"iptables -A FORWARD -i {radio.interface} -p udp --dport 67:68 -j ACCEPT")
+            
+            # Allow access to local web interface
+            self._execute_command(f"iptables -A FORWARD -i {radio.interface} -d {radio.ip} -j ACCEPT")
+            
+            # Block all other forward traffic by default (redundant but explicit)
+            self._execute_command(f"iptables -A FORWARD -i {radio.interface} -j DROP")
+
+    def _load_nft_ruleset(self, access_state=None):
+        """Replace the whole nftables table (policy, access and marks) in one transaction"""
+        access_state = self.access_state if access_state is None else access_state
+        self.nft.apply(self.nft.ruleset(access_state, self._marks(), self._limit_plans(access_state)))
+
+    def _limit_plan(self, mac_address):
+        """The connection-limit plan a client should have, or None when it's unlimited"""
+        if not self.conn_limits:
+            return None
+        plan = self.plan_overrides.get(mac_address)
+        if plan is None and self.plan_lookup:
+            plan = self.plan_lookup(mac_address)
+        return self.conn_limits.plan_for(plan or 'default')
+
+    def _limit_plans(self, access_state):
+        """{mac: limit plan} for the allowed MACs in `access_state`"""
+        if not self.conn_limits:
+            return {}
+        return {mac: self._limit_plan(mac) for mac, state in access_state.items() if state == 'allowed'}
+
+    def set_connection_plan(self, mac_address, plan=None):
+        """Re-apply a client's connection limits; `plan` overrides its own plan, None clears the override"""
+        mac_address = Mac(mac_address)
+        if plan is None:
+            self.plan_overrides.pop(mac_address, None)
+        else:
+            self.plan_overrides[mac_address] = plan
+        return self._wait(self.worker.call(self._apply_connection_plan, mac_address))
+
+    def _apply_connection_plan(self, mac_address):
+        """Swap an allowed client's limit rules for its current plan (worker thread only)"""
+        installed = self.limit_plans.get(mac_address)
+        wanted = self._limit_plan(mac_address) if self.access_state.get(mac_address) == 'allowed' else None
+        if installed == wanted:
+            return True
+        try:
+            if self.nft:
+                self.nft.apply(self.nft.limit_script(mac_address, installed, wanted))
+            else:
+                lines = ['*mangle']
+                if installed:
+                    lines += self.conn_limits.iptables_rules(mac_address, installed, '-D')
+                if wanted:
+                    lines += self.conn_limits.iptables_rules(mac_address, wanted)
+                self._apply_batch("iptables-restore --noflush", lines + ['COMMIT'])
+        except Exception as e:
+            self.logger.error(f"Error applying connection limits for {mac_address}: {e}")
+            return False
+        if wanted:
+            self.limit_plans[mac_address] = wanted
+        else:
+            self.limit_plans.pop(mac_address, None)
+        log_event(self.logger, logging.INFO, 'connection_limits_applied', mac=mac_address, plan=wanted)
+        return True
+
+    def _marks(self):
+        """{client ip: fwmark} for every shaped client (the mark is its tc class id)"""
+        if not self.use_marks:
+            return {}
+        return {ip_address: self.class_id_for(mac) for mac, ip_address in self.shaped.items()}
+
     def _check_hostapd_running(self):
         """Check if hostapd is running"""
         try:
@@ -272,20 +503,21 @@ log-dhcp
                 self.logger.error("No hostapd process found")
                 return False
 
-            # Check if hostapd is responding
-            try:
-                hostapd_cli = self._execute_command("hostapd_cli status")
-                if "state=ENABLED" not in hostapd_cli:
-                    self.logger.error("Hostapd is not in ENABLED state")
-                    return False
-            except:
-                self.logger.warning("Could not check hostapd_cli status")
+            for radio in self.radios:
+                # Check if hostapd is responding
+                try:
+                    hostapd_cli = self._execute_command(f"hostapd_cli -i {radio.interface} status")
+                    if "state=ENABLED" not in hostapd_cli:
+                        self.logger.error(f"Hostapd is not in ENABLED state on {radio.interface}")
+                        return False
+                except:
+                    self.logger.warning(f"Could not check hostapd_cli status on {radio.interface}")
 
-            # Check if interface is in AP mode
-            iw_info = self._execute_command(f"iw dev {self.ap_interface} info")
-            if "type AP" not in iw_info:
-                self.logger.error("Interface not in AP mode")
-                return False
+                # Check if interface is in AP mode
+                iw_info = self._execute_command(f"iw dev {radio.interface} info")
+                if "type AP" not in iw_info:
+                    self.logger.error(f"Interface {radio.interface} not in AP mode")
+                    return False
 
             self.logger.debug("Hostapd check passed")
             return True
@@ -294,36 +526,42 @@ log-dhcp
             self.logger.error(f"Error checking hostapd: {e}")
             return False
 
+    def diagnostic_commands(self):
+        """Commands behind the cached diagnostics (/debug/connections, failure dumps)"""
+        commands = {}
+        for radio in self.radios:
+            suffix = '' if radio is self.radios[0] else f"_{radio.interface}"
+            commands[f'stations{suffix}'] = f"iw dev {radio.interface} station dump"
+            commands[f'ap_interface_status{suffix}'] = f"ip addr show {radio.interface}"
+        commands.update({
+            'internet_interface_status': f"ip addr show {self.internet_interface}",
+            'hostapd_status': "systemctl status hostapd",
+            'iptables_rules': "nft list table inet pisowifi" if self.nft else "iptables -L -n -v"
+        })
+        return commands
+
     def _dump_debug_info(self):
         """Dump debug information when something goes wrong"""
         try:
-            self.logger.error("=== Debug Information ===")
-            
-            # Check interface status
-            self.logger.error("Interface Status:")
-            self.logger.error(self._execute_command(f"ip addr show {self.ap_interface}"))
-            
-            # Check hostapd status
-            self.logger.error("Hostapd Status:")
-            self.logger.error(self._execute_command("systemctl status hostapd"))
-            
-            # Check hostapd logs
-            self.logger.error("Hostapd Logs:")
-            self.logger.error(self._execute_command("journalctl -u hostapd -n 50"))
-            
-            # Check dnsmasq status
-            self.logger.error("Dnsmasq Status:")
-            self.logger.error(self._execute_command("systemctl status dnsmasq"))
-            
-            # Check RF kill status
-            self.logger.error("RF Kill Status:")
-            self.logger.error(self._execute_command("rfkill list"))
-            
-            # Check network interfaces
-            self.logger.error("Network Interfaces:")
-            self.logger.error(self._execute_command("iwconfig"))
-            
-            self.logger.error("=====================")
+            now = time.monotonic()
+            if self._last_debug_dump is not None and now - self._last_debug_dump < self.debug_dump_interval:
+                self.logger.debug("Skipping debug dump, last one was %.0fs ago", now - self._last_debug_dump)
+                return
+            self._last_debug_dump = now
+            
+            # The in-memory DEBUG history usually explains what led up to the failure
+            dump_ring_buffer(self.logger)
+            
+            if not self.diagnostics:
+                return
+            # Command output comes from the cached snapshot; a stale one is
+            # refreshed in the background rather than on the failing path
+            snapshot = self.diagnostics.get_snapshot()
+            sections = [f"{name}:\n{output}" for name, output in snapshot['results'].items()]
+            
+            # One record so the log rate limiter keeps the dump intact
+            self.logger.error("=== Debug Information (collected %.0fs ago) ===\n%s\n=====================",
+                              snapshot['age_seconds'] or 0, '\n'.join(sections))
         except Exception as e:
             self.logger.error(f"Error dumping debug info: {e}")
     
@@ -331,11 +569,14 @@ log-dhcp
         """Stop the WiFi Access Point"""
         try:
             self._execute_command("systemctl stop hostapd")
+            for radio in self.radios:
+                self._execute_command(f"kill $(cat {radio.pid_file})", ignore_errors=True)
             self._execute_command("systemctl stop dnsmasq")
-            self._execute_command(f"ip link set {self.ap_interface} down")
             
-            # Re-enable NetworkManager for both interfaces
-            self._execute_command(f"nmcli device set {self.ap_interface} managed yes")
+            # Re-enable NetworkManager for the radios and the uplink
+            for radio in self.radios:
+                self._execute_command(f"ip link set {radio.interface} down")
+                self._execute_command(f"nmcli device set {radio.interface} managed yes")
             self._execute_command(f"nmcli device set {self.internet_interface} managed yes")
             
             self.logger.info("WiFi Access Point stopped")
@@ -343,104 +584,540 @@ log-dhcp
             self.logger.error(f"Failed to stop WiFi Access Point: {e}")
 
     def get_connected_devices(self):
-        """Get list of connected devices with detailed information"""
+        """Stations associated with any radio, with their lease's IP and hostname"""
         try:
-            connected_devices = []
+            stations = []
             
             # Get DHCP leases first for hostname and IP information
-            dhcp_info = {}
-            try:
-                leases_file = "/var/lib/misc/dnsmasq.leases"
-                if os.path.exists(leases_file):
-                    current_time = int(time.time())
-                    with open(leases_file, 'r') as f:
-                        for line in f:
-                            parts = line.strip().split()
-                            if len(parts) >= 5:
-                                lease_expiry = int(parts[0])
-                                mac = parts[1].upper()
-                                ip = parts[2]
-                                hostname = parts[3] if parts[3] != '*' else 'Unknown'
-                                
-                                # Only include active leases in our subnet
-                                if lease_expiry > current_time and ip.startswith("192.168.4."):
-                                    dhcp_info[mac] = {
-                                        'ip': ip,
-                                        'hostname': hostname,
-                                        'lease_expiry': lease_expiry
-                                    }
-                self.logger.debug(f"DHCP info found: {dhcp_info}")
-            except Exception as e:
-                self.logger.warning(f"DHCP leases check failed: {e}")
+            dhcp_info = self._read_dhcp_leases()
 
-            # Get currently connected devices
+            # Get currently connected devices, polling every radio concurrently.
+            # The dump already carries signal strength, so no per-station queries.
             try:
-                result = self._execute_command(f"iw dev {self.ap_interface} station dump")
-                for line in result.split('\n'):
-                    if "Station" in line:
-                        mac = line.split()[1].upper()
-                        if self._is_valid_mac(mac):
-                            device_info = {
-                                'mac_address': mac,
-                                'ip': dhcp_info.get(mac, {}).get('ip', 'Unknown'),
-                                'hostname': dhcp_info.get(mac, {}).get('hostname', 'Unknown'),
-                                'connected': True
-                            }
-                            
-                            # Get signal strength and other stats
-                            try:
-                                info = self._execute_command(f"iw dev {self.ap_interface} station get {mac}")
-                                signal = re.search(r"signal:\s*([-\d]+)\s*dBm", info)
-                                if signal:
-                                    device_info['signal'] = f"{signal.group(1)} dBm"
-                            except Exception as e:
-                                self.logger.debug(f"Could not get signal info for {mac}: {e}")
+                dumps = run_commands(self._execute_command, {
+                    radio.interface: f"iw dev {radio.interface} station dump" for radio in self.radios
+                }, max_workers=len(self.radios))
+                counters = {}
+                for interface, result in dumps.items():
+                    if self.traffic_handler:
+                        counters.update(self.parse_station_counters(result))
+                    for mac, signal, inactive_ms in self.parse_station_dump(result):
+                        lease = dhcp_info.get(mac, {})
+                        stations.append(Station(mac, interface, lease.get('ip'), lease.get('hostname'), signal,
+                                                inactive_ms))
+                        self.station_interface[mac] = interface
                             
-                            connected_devices.append(device_info)
-                            
-                self.logger.debug(f"Connected devices with info: {connected_devices}")
+                log_event(self.logger, logging.DEBUG, 'station_dump', stations=len(stations),
+                          radios=len(dumps))
+                if self.traffic_handler:
+                    self.traffic_handler(counters)
             except Exception as e:
                 self.logger.warning(f"IW station dump failed: {e}")
 
             # Update connected devices set
-            current_macs = {device['mac_address'] for device in connected_devices}
+            current_macs = {station.mac for station in stations}
             new_devices = current_macs - self.connected_devices
             disconnected_devices = self.connected_devices - current_macs
 
             # Log new connections and disconnections
             for mac in new_devices:
-                self.logger.info(f"New device connected: {mac}")
+                log_event(self.logger, logging.INFO, 'device_connected', mac=mac)
                 self._log_device_details(mac)
-                # Block new devices by default
-                self.block_mac(mac)
+                if self.admission_handler:
+                    self.admission_handler(mac, dhcp_info.get(mac, {}).get('ip'))
+                # Block new devices by default, but keep access restored for paying users
+                elif self.access_state.get(mac) != 'allowed':
+                    self.block_mac(mac)
 
             for mac in disconnected_devices:
-                self.logger.info(f"Device disconnected: {mac}")
+                log_event(self.logger, logging.INFO, 'device_disconnected', mac=mac)
 
             # Update connected devices
             self.connected_devices = current_macs
 
-            # Debug output
-            self.logger.info(f"Total connected devices: {len(connected_devices)}")
-            return connected_devices
+            log_event(self.logger, logging.DEBUG, 'connected_devices', total=len(stations),
+                      new=len(new_devices), disconnected=len(disconnected_devices))
+            return stations
 
         except Exception as e:
-            self.logger.error(f"Error getting connected devices: {e}")
+            log_event(self.logger, logging.ERROR, 'get_connected_devices_failed', error=e)
             self._dump_debug_info()
             return []
 
-    def _is_valid_mac(self, mac):
-        """Validate MAC address format"""
+    @staticmethod
+    def parse_station_dump(output):
+        """(Mac, signal dBm, inactive ms) for each station in `iw dev X station dump` output (None when missing)"""
+        stations = []
+        station = None
+        for line in output.split('\n'):
+            if line.startswith('Station'):
+                mac = to_mac(line.split()[1])
+                station = [mac, None, None] if mac is not None else None
+                if station:
+                    stations.append(station)
+            elif station:
+                signal = re.match(r"\s*signal:\s*([-\d]+)", line)
+                inactive = re.match(r"\s*inactive time:\s*(\d+)", line)
+                if signal and station[1] is None:
+                    station[1] = signal.group(1)
+                elif inactive:
+                    station[2] = int(inactive.group(1))
+        return [tuple(station) for station in stations]
+
+    @staticmethod
+    def parse_station_counters(output):
+        """{Mac: (down bytes, up bytes, down packets, up packets)} from `iw dev X station dump` output.
+
+        The dump counts from the AP's side: what it transmits to a station is that station's download.
+        """
+        counters = {}
+        station = None
+        for line in output.split('\n'):
+            if line.startswith('Station'):
+                mac = to_mac(line.split()[1])
+                station = {}
+                if mac is not None:
+                    counters[mac] = station
+            elif station is not None:
+                counter = re.match(r"\s*(rx|tx) (bytes|packets):\s*(\d+)", line)
+                if counter:
+                    station[f"{counter.group(1)}_{counter.group(2)}"] = int(counter.group(3))
+        return {
+            mac: (station.get('tx_bytes', 0), station.get('rx_bytes', 0),
+                  station.get('tx_packets', 0), station.get('rx_packets', 0))
+            for mac, station in counters.items()
+        }
+
+    def read_usage_counters(self):
+        """{Mac: (download bytes, upload bytes)} for shaped clients, from one `tc -s -batch` call.
+
+        Downloads are the client's HTB class on its radio, uploads its ingress
+        police filter; both are counted by the kernel as packets pass the
+        qdiscs, so this also sees traffic the flowtable fast-paths.
+        """
+        lines = []
+        for radio in self.radios:
+            lines += [f"class show dev {radio.interface}", f"filter show dev {radio.interface} parent ffff:"]
+        classes, uploads = self.parse_tc_usage(self._apply_batch("tc -s -batch", lines))
+        ips = {lease['ip']: mac for mac, lease in self._read_dhcp_leases().items()}
+        macs = set(self.shaped) | {mac for mac, state in dict(self.access_state).items() if state == 'allowed'}
+        counters = {}
+        for mac in macs:
+            download = classes.get(str(self.class_id_for(mac)))
+            if download is None:
+                continue
+            upload = sum(sent for ip, sent in uploads.items() if ips.get(ip) == mac)
+            counters[mac] = (download, upload)
+        return counters
+
+    @staticmethod
+    def parse_tc_usage(output):
+        """({class minor id: bytes sent}, {source IP: bytes sent}) from `tc -s class/filter show` output.
+
+        Class ids are kept as printed: tc reads the decimal ids we give it as hex and prints them back the same way.
+        """
+        classes, filters = {}, {}
+        current = None
+        for line in output.split('\n'):
+            stripped = line.strip()
+            class_line = re.match(r"class htb 1:([0-9a-f]+) ", stripped)
+            source = re.match(r"match ([0-9a-f]{8})/ffffffff at 12", stripped)
+            if class_line:
+                current = (classes, class_line.group(1))
+            elif source:
+                current = (filters, str(ipaddress.IPv4Address(int(source.group(1), 16))))
+            elif stripped.startswith('Sent ') and current:
+                table, key = current
+                table[key] = table.get(key, 0) + int(stripped.split()[1])
+                current = None
+        return classes, filters
+
+    def radio_for_ip(self, ip_address):
+        """The radio whose subnet contains the address (falls back to the first radio)"""
+        for radio in self.radios:
+            if radio.contains(ip_address):
+                return radio
+        return self.radios[0]
+
+    def _interface_for_ip(self, ip_address):
+        return self.radio_for_ip(ip_address).interface
+
+    def mac_for_ip(self, ip_address):
+        """Mac of the client leasing `ip_address`, or None"""
+        for mac, lease in self._read_dhcp_leases().items():
+            if lease['ip'] == ip_address:
+                return mac
+        return None
+
+    def _read_dhcp_leases(self):
+        """Active dnsmasq leases in the AP subnet: {Mac: {ip, hostname, lease_expiry}}"""
+        dhcp_info = {}
+        try:
+            leases_file = "/var/lib/misc/dnsmasq.leases"
+            if os.path.exists(leases_file):
+                current_time = int(time.time())
+                with open(leases_file, 'r') as f:
+                    for line in f:
+                        parts = line.strip().split()
+                        if len(parts) >= 5:
+                            lease_expiry = int(parts[0])
+                            mac = to_mac(parts[1])
+                            ip = parts[2]
+                            hostname = parts[3] if parts[3] != '*' else 'Unknown'
+                            
+                            # Only include active leases in one of our radios' subnets
+                            if mac is not None and lease_expiry > current_time and any(radio.contains(ip) for radio in self.radios):
+                                dhcp_info[mac] = {
+                                    'ip': ip,
+                                    'hostname': hostname,
+                                    'lease_expiry': lease_expiry
+                                }
+            log_event(self.logger, logging.DEBUG, 'dhcp_leases', count=len(dhcp_info))
+        except Exception as e:
+            self.logger.warning(f"DHCP leases check failed: {e}")
+        return dhcp_info
+
+    @staticmethod
+    def class_id_for(mac_address):
+        """tc class id of a client (range 20-1019)"""
+        return (Mac(mac_address) & 0xFFFF) % 1000 + 20
+
+    @staticmethod
+    def u32_handles(mac_address):
+        """Handles of a client's u32 filters: (download by dst, download by src, upload police).
+
+        Nodes in the prio's default hash table (800:), numbered from the class
+        id so no two clients share one. tc only honours a handle when deleting
+        a u32 filter (a `match` is ignored and the whole prio goes), so every
+        filter is installed and removed by its handle.
+        """
+        class_id = NetworkController.class_id_for(mac_address)
+        return f"800::{2 * class_id:x}", f"800::{2 * class_id + 1:x}", f"800::{class_id:x}"
+
+    @staticmethod
+    def build_restore_batches(users, leases, interface_for, captive_portal=False, use_marks=False):
+        """iptables-restore and tc -batch input that re-admit and re-shape `users`.
+
+        `users` are dicts with mac_address, download_limit and upload_limit;
+        `leases` maps Macs to {'ip': ...}; `interface_for(ip)` names the radio
+        whose tc tree shapes that address. Users without a lease are allowed
+        but can't be shaped until they get an address. With `captive_portal`
+        each user also bypasses the portal redirect. With `use_marks` downloads
+        are classified by fwmark (set from the nftables ip_mark map) instead of
+        per-client u32 filters.
+        """
+        iptables_lines = ['*filter']
+        nat_lines = ['*nat']
+        tc_lines = []
+        for user in users:
+            mac = Mac(user['mac_address'])
+            iptables_lines.append(f"-I FORWARD 1 -m mac --mac-source {mac} -j ACCEPT")
+            nat_lines.append(f"-I PORTAL 1 -m mac --mac-source {mac} -j RETURN")
+
+            ip_address = leases.get(mac, {}).get('ip')
+            if not ip_address:
+                continue
+            class_id = NetworkController.class_id_for(mac)
+            dst_handle, src_handle, police_handle = NetworkController.u32_handles(mac)
+            ap_interface = interface_for(ip_address)
+            download, upload = user['download_limit'], user['upload_limit']
+            tc_lines += [
+                f"class replace dev {ap_interface} parent 1:1 classid 1:{class_id} htb rate {download}kbit ceil {download}kbit burst 15k",
+                f"qdisc replace dev {ap_interface} parent 1:{class_id} handle {class_id}: sfq perturb 10",
+            ]
+            if use_marks:
+                tc_lines.append(f"filter replace dev {ap_interface} parent 1: protocol ip prio 1 handle {class_id} fw flowid 1:{class_id}")
+            else:
+                tc_lines += [
+                    f"filter replace dev {ap_interface} parent 1: protocol ip prio 1 handle {dst_handle} u32 match ip dst {ip_address} flowid 1:{class_id}",
+                    f"filter replace dev {ap_interface} parent 1: protocol ip prio 1 handle {src_handle} u32 match ip src {ip_address} flowid 1:{class_id}",
+                ]
+            tc_lines.append(
+                f"filter replace dev {ap_interface} parent ffff: protocol ip prio 1 handle {police_handle} u32 match ip src {ip_address} police rate {upload}kbit burst 15k drop flowid :1"
+            )
+        iptables_lines.append('COMMIT')
+        if captive_portal:
+            iptables_lines += nat_lines + ['COMMIT']
+        return iptables_lines, tc_lines
+
+    def _apply_batch(self, command, lines):
+        """Run a batch tool (iptables-restore, tc -batch) on `lines` in one process"""
+        with tempfile.NamedTemporaryFile('w', suffix='.rules') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            return self._execute_command(f"{command} {f.name}")
+
+    def restore_state(self, users):
+        """Re-admit and re-shape users that still have balance after a restart.
+
+        start_ap flushes iptables and _setup_qos wipes the tc tree, so this runs
+        once at startup with every active user, applying all rules in two batched
+        commands instead of several commands per user.
+        """
+        return self._wait(self.worker.call(self._restore_state, users))
+
+    def _restore_state(self, users):
+        started = time.monotonic()
+        users = list(users)
+        if not users:
+            log_event(self.logger, logging.INFO, 'state_restored', users=0, shaped=0, seconds=0)
+            return True
+        try:
+            leases = self._read_dhcp_leases()
+            iptables_lines, tc_lines = self.build_restore_batches(users, leases, self._interface_for_ip,
+                                                                 self.captive_portal, use_marks=self.use_marks)
+            macs = [Mac(user['mac_address']) for user in users]
+            leased = [mac for mac in macs if mac in leases]
+
+            limits = {Mac(user['mac_address']): (user['download_limit'], user['upload_limit']) for user in users}
+            if self.nft:
+                # Access and marks for every user go in with one table swap
+                for mac in leased:
+                    self.shaped[mac] = leases[mac]['ip']
+                    self.shaped_limits[mac] = limits[mac]
+                self._load_nft_ruleset(dict(self.access_state, **dict.fromkeys(macs, 'allowed')))
+            else:
+                if self.conn_limits:
+                    iptables_lines += ['*mangle'] + [
+                        rule for mac in macs
+                        for rule in self.conn_limits.iptables_rules(mac, self._limit_plan(mac))
+                    ] + ['COMMIT']
+                self._apply_batch("iptables-restore --noflush", iptables_lines)
+            for mac in macs:
+                self.access_state[mac] = 'allowed'
+                if self.conn_limits:
+                    self.limit_plans[mac] = self._limit_plan(mac)
+            if tc_lines:
+                # -force: a clashing class id skips that client instead of aborting the batch
+                self._apply_batch("tc -force -batch", tc_lines)
+                for mac in leased:
+                    self.shaped[mac] = leases[mac]['ip']
+                    self.shaped_limits[mac] = limits[mac]
+
+            log_event(self.logger, logging.INFO, 'state_restored', users=len(users),
+                      shaped=len(leased), seconds=round(time.monotonic() - started, 2))
+            return True
+        except Exception as e:
+            self.logger.error(f"Error restoring access for {len(users)} users: {e}")
+            return False
+
+    def admit_mac(self, mac_address, download_kbps, upload_kbps, ip_address=None):
+        """Allow a station and, when its IP is known, install its shaping class"""
+        mac_address = Mac(mac_address)
+        futures = [self.worker.set_access(mac_address, 'allowed')]
+        if ip_address:
+            futures.append(self.worker.set_shaping(mac_address, download_kbps, upload_kbps, ip_address))
+        admitted = all([self._wait(future) for future in futures])
+        if admitted:
+            log_event(self.logger, logging.INFO, 'mac_admitted', mac=mac_address, ip=ip_address)
+        return admitted
+
+    def _wait(self, future, timeout=30):
+        """Block until the worker has applied a change; returns its result or False"""
         try:
-            return bool(re.match(r'^([0-9A-F]{2}:){5}[0-9A-F]{2}$', mac.upper()))
-        except:
+            return future.result(timeout=timeout)
+        except Exception as e:
+            self.logger.error(f"Network change failed: {e}")
+            return False
+
+    def _apply_access(self, changes):
+        """Apply {mac: 'allowed' | 'blocked'} in one iptables-restore; returns {mac: success}.
+
+        Runs on the worker thread, which owns the rules, so access_state tells
+        exactly which rule each MAC has and unchanged MACs can be skipped.
+        """
+        wanted = {mac: self._limit_plan(mac) for mac, state in changes.items() if state == 'allowed'}
+        if self.nft:
+            lines, updates = self.nft.access_script(changes, self.access_state, self.limit_plans, wanted)
+        else:
+            lines, updates = self.build_access_batch(changes, self.access_state, self.captive_portal,
+                                                     self.conn_limits, self.limit_plans, wanted)
+        results = {mac_address: True for mac_address in changes}
+        if not updates:
+            return results
+
+        try:
+            if self.nft:
+                self.nft.apply(lines)
+            else:
+                self._apply_batch("iptables-restore --noflush", lines)
+        except Exception as e:
+            if self.nft:
+                # Map out of step with access_state; swapping in the whole table fixes both
+                self.logger.warning(f"nft element update failed, reloading the ruleset: {e}")
+                try:
+                    self._load_nft_ruleset(dict(self.access_state, **updates))
+                except Exception as e:
+                    self.logger.error(f"Error reloading nftables ruleset: {e}")
+                    return {mac_address: mac_address not in updates for mac_address in changes}
+                self.access_state.update(updates)
+                self._record_limit_plans(updates, wanted)
+                if self.flowtable:
+                    self._drop_offloaded_flows([mac for mac, state in updates.items() if state == 'blocked'])
+                return results
+            # Rules changed behind our back; fall back to the rule-by-rule path
+            self.logger.warning(f"Batched access update failed, applying one by one: {e}")
+            for mac_address, state in updates.items():
+                apply = self._unblock_mac if state == 'allowed' else self._block_mac
+                results[mac_address] = apply(mac_address)
+            return results
+
+        for mac_address, state in updates.items():
+            self.access_state[mac_address] = state
+            log_event(self.logger, logging.INFO, 'mac_unblocked' if state == 'allowed' else 'mac_blocked',
+                      mac=mac_address)
+        self._record_limit_plans(updates, wanted)
+        if self.flowtable:
+            self._drop_offloaded_flows([mac for mac, state in updates.items() if state == 'blocked'])
+        return results
+
+    def _record_limit_plans(self, updates, wanted):
+        for mac_address, state in updates.items():
+            if state == 'allowed' and wanted.get(mac_address):
+                self.limit_plans[mac_address] = wanted[mac_address]
+            else:
+                self.limit_plans.pop(mac_address, None)
+
+    def _drop_offloaded_flows(self, mac_addresses):
+        """Delete the conntrack entries of newly blocked clients so their offloaded flows stop too"""
+        if not mac_addresses:
+            return
+        leases = self._read_dhcp_leases()
+        for mac_address in mac_addresses:
+            ip_address = self.shaped.get(mac_address) or leases.get(mac_address, {}).get('ip')
+            if ip_address:
+                # Client-initiated (NATed) connections all have the client as original source
+                self._execute_command(f"conntrack -D -s {ip_address}", ignore_errors=True)
+
+    @staticmethod
+    def build_access_batch(changes, access_state, captive_portal=False, conn_limits=None,
+                           installed=None, wanted=None):
+        """iptables-restore input moving MACs to the wanted state; returns (lines, {mac: state} changed).
+
+        Allowed MACs get an ACCEPT rule in FORWARD and, with `captive_portal`, a
+        RETURN rule in the PORTAL nat chain so their HTTP is no longer redirected.
+        With `conn_limits`, mangle rules for the plan in `wanted` are added next
+        to the ACCEPT, and those of the plan in `installed` go with it.
+        """
+        lines = ['*filter']
+        nat_lines = ['*nat']
+        mangle_lines = ['*mangle']
+        installed = installed or {}
+        wanted = wanted or {}
+        updates = {}
+        for mac_address, state in changes.items():
+            current = access_state.get(mac_address)
+            if current == state:
+                continue
+            if current == 'blocked':
+                lines.append(f"-D FORWARD -m mac --mac-source {mac_address} -j DROP")
+            elif current == 'allowed':
+                lines.append(f"-D FORWARD -m mac --mac-source {mac_address} -j ACCEPT")
+                nat_lines.append(f"-D PORTAL -m mac --mac-source {mac_address} -j RETURN")
+                if conn_limits and installed.get(mac_address):
+                    mangle_lines += conn_limits.iptables_rules(mac_address, installed[mac_address], '-D')
+            target = 'ACCEPT' if state == 'allowed' else 'DROP'
+            lines.append(f"-I FORWARD 1 -m mac --mac-source {mac_address} -j {target}")
+            if state == 'allowed':
+                nat_lines.append(f"-I PORTAL 1 -m mac --mac-source {mac_address} -j RETURN")
+                if conn_limits and wanted.get(mac_address):
+                    mangle_lines += conn_limits.iptables_rules(mac_address, wanted[mac_address])
+            updates[mac_address] = state
+        lines.append('COMMIT')
+        if captive_portal and len(nat_lines) > 1:
+            lines += nat_lines + ['COMMIT']
+        if len(mangle_lines) > 1:
+            lines += mangle_lines + ['COMMIT']
+        return lines, updates
+
+    def _apply_shaping(self, mac_address, download_kbps=None, upload_kbps=None, ip_address=None):
+        """Worker-side shaping change: remove, shape a known IP in one tc batch, or look the IP up"""
+        if self.use_marks:
+            return self._apply_marked_shaping(mac_address, download_kbps, upload_kbps, ip_address)
+        if download_kbps is None and upload_kbps is None:
+            self.shaped.pop(mac_address, None)
+            self.shaped_limits.pop(mac_address, None)
+            return self._remove_bandwidth_limit(mac_address)
+        if not ip_address:
+            self.shaped.pop(mac_address, None)
+            self.shaped_limits.pop(mac_address, None)
+            return self._set_bandwidth_limit(mac_address, download_kbps, upload_kbps)
+        old_ip = self.shaped.get(mac_address)
+        if old_ip == ip_address and self.shaped_limits.get(mac_address) == (download_kbps, upload_kbps):
+            return True
+
+        # Class and filters are replaced in place by id and handle; only a move to
+        # another radio leaves the old ones behind
+        tc_lines = []
+        old_interface = self._interface_for_ip(old_ip) if old_ip else None
+        if old_interface and old_interface != self._interface_for_ip(ip_address):
+            tc_lines = self._u32_filter_deletes(mac_address, old_interface) + [
+                f"class del dev {old_interface} classid 1:{self.class_id_for(mac_address)}"]
+        user = {'mac_address': mac_address, 'download_limit': download_kbps, 'upload_limit': upload_kbps}
+        tc_lines += self.build_restore_batches([user], {mac_address: {'ip': ip_address}},
+                                               self._interface_for_ip)[1]
+        self._apply_batch("tc -force -batch", tc_lines)
+        self.shaped[mac_address] = ip_address
+        self.shaped_limits[mac_address] = (download_kbps, upload_kbps)
+        return True
+
+    def _u32_filter_deletes(self, mac_address, interface, ingress_only=False):
+        """tc -batch lines deleting a client's u32 filters on `interface`, by handle"""
+        dst_handle, src_handle, police_handle = self.u32_handles(mac_address)
+        lines = [] if ingress_only else [
+            f"filter del dev {interface} parent 1: protocol ip prio 1 handle {dst_handle} u32",
+            f"filter del dev {interface} parent 1: protocol ip prio 1 handle {src_handle} u32",
+        ]
+        return lines + [f"filter del dev {interface} parent ffff: protocol ip prio 1 handle {police_handle} u32"]
+
+    def _apply_marked_shaping(self, mac_address, download_kbps=None, upload_kbps=None, ip_address=None):
+        """nftables variant of _apply_shaping: the ip_mark map entry picks the client's tc class"""
+        class_id = self.class_id_for(mac_address)
+        old_ip = self.shaped.get(mac_address)
+        try:
+            if download_kbps is None and upload_kbps is None:
+                self.nft.apply(self.nft.mark_script(None, None, old_ip))
+                self.shaped.pop(mac_address, None)
+                self.shaped_limits.pop(mac_address, None)
+                interface = self._interface_for_ip(old_ip) if old_ip else self.station_interface.get(mac_address, self.ap_interface)
+                self._apply_batch("tc -force -batch", [
+                    f"filter del dev {interface} parent 1: protocol ip prio 1 handle {class_id} fw",
+                    f"class del dev {interface} classid 1:{class_id}",
+                ] + self._u32_filter_deletes(mac_address, interface, ingress_only=True))
+                return True
+
+            ip_address = ip_address or self._read_dhcp_leases().get(mac_address, {}).get('ip')
+            if not ip_address:
+                self.logger.error(f"Could not find IP address for MAC {mac_address}")
+                return False
+            if old_ip == ip_address and self.shaped_limits.get(mac_address) == (download_kbps, upload_kbps):
+                return True
+
+            # Upload policing is still a u32 filter, replaced by handle; a move to
+            # another radio leaves the old one behind
+            tc_lines = []
+            old_interface = self._interface_for_ip(old_ip) if old_ip else None
+            if old_interface and old_interface != self._interface_for_ip(ip_address):
+                tc_lines = self._u32_filter_deletes(mac_address, old_interface, ingress_only=True)
+            user = {'mac_address': mac_address, 'download_limit': download_kbps or self.DEFAULT_DOWNLOAD_SPEED,
+                    'upload_limit': upload_kbps or self.DEFAULT_UPLOAD_SPEED}
+            tc_lines += self.build_restore_batches([user], {mac_address: {'ip': ip_address}},
+                                                   self._interface_for_ip, use_marks=True)[1]
+            self._apply_batch("tc -force -batch", tc_lines)
+            self.nft.apply(self.nft.mark_script(ip_address, class_id, old_ip))
+            self.shaped[mac_address] = ip_address
+            self.shaped_limits[mac_address] = (download_kbps, upload_kbps)
+            return True
+        except Exception as e:
+            self.logger.error(f"Error shaping {mac_address}: {e}")
             return False
 
     def _log_device_details(self, mac):
         """Log additional details about a connected device"""
         try:
             # Get station info
-            info = self._execute_command(f"iw dev {self.ap_interface} station get {mac}")
+            interface = self.station_interface.get(mac, self.ap_interface)
+            info = self._execute_command(f"iw dev {interface} station get {mac}")
             
             # Extract useful information
             signal = re.search(r"signal:\s*([-\d]+)\s*dBm", info)
@@ -465,6 +1142,14 @@ log-dhcp
 
     def block_mac(self, mac_address):
         """Block a MAC address using iptables"""
+        return self._wait(self.worker.set_access(Mac(mac_address), 'blocked'))
+
+    def unblock_mac(self, mac_address):
+        """Unblock a MAC address using iptables"""
+        return self._wait(self.worker.set_access(Mac(mac_address), 'allowed'))
+
+    def _block_mac(self, mac_address):
+        """Block a MAC rule by rule (worker thread only)"""
         try:
             # Remove any existing rules for this MAC
             self._execute_command(f"iptables -D FORWARD -m mac --mac-source {mac_address} -j ACCEPT", ignore_errors=True)
@@ -472,14 +1157,18 @@ log-dhcp
             
             # Add block rule
             self._execute_command(f"iptables -I FORWARD 1 -m mac --mac-source {mac_address} -j DROP")
-            self.logger.info(f"Blocked MAC address: {mac_address}")
+            self._replace_limit_rules(mac_address, None)
+            if self.captive_portal:
+                self._execute_command(f"iptables -t nat -D PORTAL -m mac --mac-source {mac_address} -j RETURN", ignore_errors=True)
+            self.access_state[mac_address] = 'blocked'
+            log_event(self.logger, logging.INFO, 'mac_blocked', mac=mac_address)
             return True
         except Exception as e:
             self.logger.error(f"Error blocking MAC {mac_address}: {e}")
             return False
 
-    def unblock_mac(self, mac_address):
-        """Unblock a MAC address using iptables"""
+    def _unblock_mac(self, mac_address):
+        """Unblock a MAC rule by rule (worker thread only)"""
         try:
             # Remove any existing rules for this MAC
             self._execute_command(f"iptables -D FORWARD -m mac --mac-source {mac_address} -j ACCEPT", ignore_errors=True)
@@ -487,16 +1176,52 @@ log-dhcp
             
             # Add allow rule
             self._execute_command(f"iptables -I FORWARD 1 -m mac --mac-source {mac_address} -j ACCEPT")
-            self.logger.info(f"Unblocked MAC address: {mac_address}")
+            self._replace_limit_rules(mac_address, self._limit_plan(mac_address))
+            if self.captive_portal:
+                self._execute_command(f"iptables -t nat -D PORTAL -m mac --mac-source {mac_address} -j RETURN", ignore_errors=True)
+                self._execute_command(f"iptables -t nat -I PORTAL 1 -m mac --mac-source {mac_address} -j RETURN")
+            self.access_state[mac_address] = 'allowed'
+            log_event(self.logger, logging.INFO, 'mac_unblocked', mac=mac_address)
             return True
         except Exception as e:
             self.logger.error(f"Error unblocking MAC {mac_address}: {e}")
             return False
 
+    def _replace_limit_rules(self, mac_address, plan):
+        """Rule-by-rule swap of a client's connection limits (worker thread only)"""
+        if not self.conn_limits:
+            return
+        installed = self.limit_plans.pop(mac_address, None)
+        if installed:
+            for rule in self.conn_limits.iptables_rules(mac_address, installed, '-D'):
+                self._execute_command(f"iptables -t mangle {rule}", ignore_errors=True)
+        if plan:
+            for rule in self.conn_limits.iptables_rules(mac_address, plan):
+                self._execute_command(f"iptables -t mangle {rule}")
+            self.limit_plans[mac_address] = plan
+
+    def deauthenticate(self, mac_address, interface=None):
+        """Send a station off its radio through hostapd's control interface, freeing its slot"""
+        mac_address = Mac(mac_address)
+        interface = interface or self.station_interface.get(mac_address, self.ap_interface)
+        try:
+            self._hostapd_command(f"hostapd_cli -i {interface} deauthenticate {mac_address}")
+            return True
+        except HostapdUnreachable as e:
+            self.logger.error(f"Cannot deauthenticate {mac_address}: {e}")
+            return False
+        except Exception as e:
+            self.logger.warning(f"hostapd did not deauthenticate {mac_address} on {interface}: {e}")
+            return False
+
+    def is_blocked(self, mac_address):
+        """Whether the MAC is currently cut off (devices start out blocked)"""
+        return self.access_state.get(Mac(mac_address)) != 'allowed'
+
     def _execute_command(self, command, ignore_errors=False):
         """Execute a shell command and return output"""
         try:
-            self.logger.debug(f"Executing command: {command}")
+            self.logger.debug("Executing command: %s", command)
             result = subprocess.run(
                 command, 
                 shell=True,
@@ -506,20 +1231,21 @@ log-dhcp
                 universal_newlines=True
             )
             
+            # Output only lives in the debug ring buffer; keep it short
             if result.stdout:
-                self.logger.debug(f"Command output: {result.stdout}")
+                self.logger.debug("Command output: %.500s", result.stdout)
             if result.stderr:
-                self.logger.debug(f"Command stderr: {result.stderr}")
+                self.logger.debug("Command stderr: %.500s", result.stderr)
                 
             return result.stdout
             
         except subprocess.CalledProcessError as e:
             if ignore_errors:
-                self.logger.debug(f"Ignored error in command '{command}': {e}")
+                self.logger.debug("Ignored error in command '%s': %s", command, e)
                 return ""
             else:
-                self.logger.error(f"Command failed: {command}")
-                self.logger.error(f"Error output: {e.stderr}")
+                log_event(self.logger, logging.ERROR, 'command_failed', command=command,
+                          returncode=e.returncode, stderr=(e.stderr or '').strip()[:500])
                 raise
 
     def monitor_connections(self):
@@ -537,16 +1263,17 @@ log-dhcp
                 self.logger.error("Hostapd is not running")
                 return False
 
-            # Check interface status
-            interface_status = self._execute_command(f"ip addr show {self.ap_interface}")
-            if "UP" not in interface_status:
-                self.logger.error(f"Interface {self.ap_interface} is not UP")
-                return False
+            for radio in self.radios:
+                # Check interface status
+                interface_status = self._execute_command(f"ip addr show {radio.interface}")
+                if "UP" not in interface_status:
+                    self.logger.error(f"Interface {radio.interface} is not UP")
+                    return False
 
-            # Check if interface has correct IP
-            if self.ip not in interface_status:
-                self.logger.error(f"Interface {self.ap_interface} does not have IP {self.ip}")
-                return False
+                # Check if interface has correct IP
+                if radio.ip not in interface_status:
+                    self.logger.error(f"Interface {radio.interface} does not have IP {radio.ip}")
+                    return False
 
             # Check dnsmasq
             dnsmasq_running = "running" in self._execute_command("systemctl status dnsmasq")
@@ -575,21 +1302,23 @@ log-dhcp
     def _setup_qos(self):
         """Initialize QoS rules"""
         try:
-            # Clear existing rules
-            self._execute_command(f"tc qdisc del dev {self.ap_interface} root", ignore_errors=True)
-            self._execute_command(f"tc qdisc del dev {self.ap_interface} ingress", ignore_errors=True)
+            # Each radio gets its own HTB tree
+            for radio in self.radios:
+                # Clear existing rules
+                self._execute_command(f"tc qdisc del dev {radio.interface} root", ignore_errors=True)
+                self._execute_command(f"tc qdisc del dev {radio.interface} ingress", ignore_errors=True)
             
-            # Create HTB qdisc
-            self._execute_command(f"tc qdisc add dev {self.ap_interface} root handle 1: htb default 10")
+                # Create HTB qdisc
+                self._execute_command(f"tc qdisc add dev {radio.interface} root handle 1: htb default 10")
             
-            # Create main class with total bandwidth (100Mbit)
-            self._execute_command(f"tc class add dev {self.ap_interface} parent 1: classid 1:1 htb rate 100mbit burst 15k")
+                # Create main class with total bandwidth (100Mbit)
+                self._execute_command(f"tc class add dev {radio.interface} parent 1: classid 1:1 htb rate 100mbit burst 15k")
             
-            # Create default class for unclassified traffic
-            self._execute_command(f"tc class add dev {self.ap_interface} parent 1:1 classid 1:10 htb rate {self.DEFAULT_DOWNLOAD_SPEED}kbit ceil {self.DEFAULT_DOWNLOAD_SPEED}kbit burst 15k")
+                # Create default class for unclassified traffic
+                self._execute_command(f"tc class add dev {radio.interface} parent 1:1 classid 1:10 htb rate {self.DEFAULT_DOWNLOAD_SPEED}kbit ceil {self.DEFAULT_DOWNLOAD_SPEED}kbit burst 15k")
             
-            # Add ingress qdisc for upload control
-            self._execute_command(f"tc qdisc add dev {self.ap_interface} ingress")
+                # Add ingress qdisc for upload control
+                self._execute_command(f"tc qdisc add dev {radio.interface} ingress")
             
             self.logger.info("QoS rules initialized")
         except Exception as e:
@@ -598,6 +1327,14 @@ log-dhcp
 
     def set_bandwidth_limit(self, mac_address, download_kbps=None, upload_kbps=None):
         """Set bandwidth limits for a specific MAC address"""
+        if download_kbps is None:
+            download_kbps = self.DEFAULT_DOWNLOAD_SPEED
+        if upload_kbps is None:
+            upload_kbps = self.DEFAULT_UPLOAD_SPEED
+        return self._wait(self.worker.set_shaping(Mac(mac_address), download_kbps, upload_kbps))
+
+    def _set_bandwidth_limit(self, mac_address, download_kbps=None, upload_kbps=None):
+        """Shape a MAC after looking up its IP (worker thread only)"""
         try:
             if download_kbps is None:
                 download_kbps = self.DEFAULT_DOWNLOAD_SPEED
@@ -605,40 +1342,37 @@ log-dhcp
                 upload_kbps = self.DEFAULT_UPLOAD_SPEED
 
             # Get IP address for the MAC
-            ip_address = None
-            arp_output = self._execute_command("arp -n")
-            for line in arp_output.splitlines():
-                if mac_address.lower() in line.lower():
-                    ip_address = line.split()[0]
-                    break
+            ip_address = self._arp_lookup(mac_address)
                     
             if not ip_address:
                 self.logger.error(f"Could not find IP address for MAC {mac_address}")
                 return False
 
             # Generate a unique class ID based on MAC address
-            mac_hex = mac_address.replace(':', '')
-            class_id = int(mac_hex[-4:], 16) % 1000 + 20  # Range 20-1019
+            class_id = self.class_id_for(mac_address)
+            interface = self._interface_for_ip(ip_address)
             
             # Remove existing rules first
-            self.remove_bandwidth_limit(mac_address)
+            self._remove_bandwidth_limit(mac_address)
             
             # Create HTB class for this client
-            self._execute_command(f"tc class add dev {self.ap_interface} parent 1:1 classid 1:{class_id} htb rate {download_kbps}kbit ceil {download_kbps}kbit burst 15k")
+            self._execute_command(f"tc class add dev {interface} parent 1:1 classid 1:{class_id} htb rate {download_kbps}kbit ceil {download_kbps}kbit burst 15k")
             
             # Add fair queuing
-            self._execute_command(f"tc qdisc add dev {self.ap_interface} parent 1:{class_id} handle {class_id}: sfq perturb 10")
+            self._execute_command(f"tc qdisc add dev {interface} parent 1:{class_id} handle {class_id}: sfq perturb 10")
             
             # Add filters using IP instead of MAC for better compatibility
-            self._execute_command(f"tc filter add dev {self.ap_interface} parent 1: protocol ip prio 1 u32 match ip dst {ip_address} flowid 1:{class_id}")
-            self._execute_command(f"tc filter add dev {self.ap_interface} parent 1: protocol ip prio 1 u32 match ip src {ip_address} flowid 1:{class_id}")
+            dst_handle, src_handle, police_handle = self.u32_handles(mac_address)
+            self._execute_command(f"tc filter replace dev {interface} parent 1: protocol ip prio 1 handle {dst_handle} u32 match ip dst {ip_address} flowid 1:{class_id}")
+            self._execute_command(f"tc filter replace dev {interface} parent 1: protocol ip prio 1 handle {src_handle} u32 match ip src {ip_address} flowid 1:{class_id}")
             
             # Add upload limit using ingress
-            self._execute_command(f"tc filter add dev {self.ap_interface} parent ffff: protocol ip prio 1 u32 match ip src {ip_address} police rate {upload_kbps}kbit burst 15k drop flowid :1")
+            self._execute_command(f"tc filter replace dev {interface} parent ffff: protocol ip prio 1 handle {police_handle} u32 match ip src {ip_address} police rate {upload_kbps}kbit burst 15k drop flowid :1")
             
-            # Ensure forwarding is enabled for the client
-            self._execute_command(f"iptables -A FORWARD -s {ip_address} -j ACCEPT")
-            self._execute_command(f"iptables -A FORWARD -d {ip_address} -j ACCEPT")
+            if not self.nft:
+                # Ensure forwarding is enabled for the client (the nftables table decides that itself)
+                self._execute_command(f"iptables -A FORWARD -s {ip_address} -j ACCEPT")
+                self._execute_command(f"iptables -A FORWARD -d {ip_address} -j ACCEPT")
             
             self.logger.info(f"Set bandwidth limits for {mac_address} ({ip_address}): Download={download_kbps}kbps, Upload={upload_kbps}kbps")
             
@@ -647,32 +1381,38 @@ log-dhcp
             self.logger.error(f"Error setting bandwidth limit for {mac_address}: {e}")
             return False
 
+    def _arp_lookup(self, mac_address):
+        """IP address `arp -n` lists for a MAC, or None"""
+        for line in self._execute_command("arp -n").splitlines():
+            fields = line.split()
+            if len(fields) >= 3 and to_mac(fields[2]) == mac_address:
+                return fields[0]
+        return None
+
     def remove_bandwidth_limit(self, mac_address):
         """Remove bandwidth limits for a MAC address"""
+        return self._wait(self.worker.set_shaping(Mac(mac_address)))
+
+    def _remove_bandwidth_limit(self, mac_address):
+        """Remove a MAC's shaping rule by rule (worker thread only)"""
         try:
             # Get IP address
-            ip_address = None
-            arp_output = self._execute_command("arp -n")
-            for line in arp_output.splitlines():
-                if mac_address.lower() in line.lower():
-                    ip_address = line.split()[0]
-                    break
+            ip_address = self._arp_lookup(mac_address)
 
-            mac_hex = mac_address.replace(':', '')
-            class_id = int(mac_hex[-4:], 16) % 1000 + 20
+            class_id = self.class_id_for(mac_address)
+            interface = self._interface_for_ip(ip_address) if ip_address else self.station_interface.get(mac_address, self.ap_interface)
             
-            # Remove tc rules
-            self._execute_command(f"tc filter del dev {self.ap_interface} parent 1: protocol ip prio 1", ignore_errors=True)
-            self._execute_command(f"tc class del dev {self.ap_interface} classid 1:{class_id}", ignore_errors=True)
-            self._execute_command(f"tc qdisc del dev {self.ap_interface} parent 1:{class_id}", ignore_errors=True)
+            # Remove this client's tc rules (filters by handle, leaving the other clients' alone)
+            for line in self._u32_filter_deletes(mac_address, interface):
+                self._execute_command(f"tc {line}", ignore_errors=True)
+            self._execute_command(f"tc class del dev {interface} classid 1:{class_id}", ignore_errors=True)
+            self._execute_command(f"tc qdisc del dev {interface} parent 1:{class_id}", ignore_errors=True)
             
             if ip_address:
-                # Remove ingress filters
-                self._execute_command(f"tc filter del dev {self.ap_interface} parent ffff: protocol ip prio 1 u32 match ip src {ip_address}", ignore_errors=True)
-                
-                # Remove iptables rules
-                self._execute_command(f"iptables -D FORWARD -s {ip_address} -j ACCEPT", ignore_errors=True)
-                self._execute_command(f"iptables -D FORWARD -d {ip_address} -j ACCEPT", ignore_errors=True)
+                if not self.nft:
+                    # Remove iptables rules
+                    self._execute_command(f"iptables -D FORWARD -s {ip_address} -j ACCEPT", ignore_errors=True)
+                    self._execute_command(f"iptables -D FORWARD -d {ip_address} -j ACCEPT", ignore_errors=True)
             
             self.logger.info(f"Removed bandwidth limits for {mac_address}")
             return True
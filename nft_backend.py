@@ -0,0 +1,195 @@
+import tempfile
+import logging
+
+class NftBackend:
+    """Client firewall policy as one nftables table, changed by atomic `nft -f` transactions.
+
+    Access is a MAC -> verdict map consulted by a single rule, and shaping marks
+    come from an IP -> mark map, so the per-packet cost stays constant however
+    many clients there are. A full load replaces the table in one transaction
+    (there is never a moment without rules); access and shaping changes only
+    add and delete map elements.
+
+    With `flowtable`, established TCP/UDP connections of paying clients are put
+    in a software flowtable between the radios and the uplink, so their later
+    packets skip the forward chains and NAT entirely. Offloaded packets never
+    get the ip_mark fwmark, so shaping then classifies by address instead.
+
+    With `conn_limits`, new connections from paying clients jump through the
+    mac_limits map to their plan's limit chain, which drops connections over
+    the plan's concurrent and per-second caps.
+    """
+
+    def __init__(self, radios, internet_interface, execute, captive_portal=False,
+                 portal_port=8081, table='pisowifi', flowtable=False, conn_limits=None):
+        self.radios = radios
+        self.internet_interface = internet_interface
+        self.execute = execute
+        self.captive_portal = captive_portal
+        self.portal_port = portal_port
+        self.flowtable = flowtable
+        self.conn_limits = conn_limits
+        self.table = f"inet {table}"
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def _elements(entries):
+        return f"\t\telements = {{ {', '.join(entries)} }}" if entries else None
+
+    def ruleset(self, access_state, marks, limit_plans=None):
+        """Script replacing the whole table.
+
+        `access_state` maps MACs to 'allowed' or 'blocked'; `marks` maps client
+        IPs to the fwmark (tc class id) their downloads are shaped with;
+        `limit_plans` maps paying MACs to their connection-limit plan.
+        """
+        interfaces = ', '.join(f'"{radio.interface}"' for radio in self.radios)
+        verdicts = [f"{str(mac).lower()} : {'accept' if state == 'allowed' else 'drop'}"
+                    for mac, state in sorted(access_state.items())]
+        paid = [str(mac).lower() for mac, state in sorted(access_state.items()) if state == 'allowed']
+        mark_elements = [f"{ip} : {mark}" for ip, mark in sorted(marks.items())]
+
+        lines = [
+            # Declaring then deleting the table makes the load work whether or not it exists yet
+            f"table {self.table}",
+            f"delete table {self.table}",
+            f"table {self.table} {{",
+            "\tset paid {",
+            "\t\ttype ether_addr",
+            self._elements(paid),
+            "\t}",
+            "",
+            "\tmap mac_verdict {",
+            "\t\ttype ether_addr : verdict",
+            self._elements(verdicts),
+            "\t}",
+            "",
+            "\tmap ip_mark {",
+            "\t\ttype ipv4_addr : mark",
+            self._elements(mark_elements),
+            "\t}",
+            "",
+        ]
+        if self.conn_limits:
+            limit_elements = [f"{str(mac).lower()} : jump limit_{plan}"
+                              for mac, plan in sorted((limit_plans or {}).items()) if plan]
+            lines += self.conn_limits.nft_declarations() + [
+                "\tmap mac_limits {",
+                "\t\ttype ether_addr : verdict",
+                self._elements(limit_elements),
+                "\t}",
+                "",
+            ]
+        if self.flowtable:
+            lines += [
+                "\tflowtable fastpath {",
+                "\t\thook ingress priority filter",
+                f'\t\tdevices = {{ {interfaces}, "{self.internet_interface}" }}',
+                "\t}",
+                "",
+            ]
+        lines += [
+            "\tchain forward {",
+            "\t\ttype filter hook forward priority filter; policy drop;",
+        ]
+        if self.flowtable:
+            # Non-terminal: the packet still goes through the rules below, later ones take the fast path
+            lines.append(f"\t\tiifname {{ {interfaces} }} ether saddr @paid meta l4proto {{ tcp, udp }} "
+                         "ct state established flow add @fastpath")
+        lines += [
+            "\t\tct state established,related accept",
+        ]
+        if self.conn_limits:
+            lines.append(f"\t\tiifname {{ {interfaces} }} ct state new ether saddr vmap @mac_limits")
+        for radio in self.radios:
+            lines += [
+                f'\t\tiifname "{radio.interface}" udp dport {{ 53, 67-68 }} accept',
+                f'\t\tiifname "{radio.interface}" ip daddr {radio.ip} accept',
+            ]
+        lines += [
+            f"\t\tiifname {{ {interfaces} }} ether saddr vmap @mac_verdict",
+            f"\t\tiifname {{ {interfaces} }} drop",
+            "\t}",
+            "",
+        ]
+        if not self.flowtable:
+            lines += [
+                "\tchain shape {",
+                "\t\ttype filter hook forward priority mangle; policy accept;",
+                # Matched by a tc fw filter on the radio's egress HTB tree
+                "\t\tmeta mark set ip daddr map @ip_mark",
+                "\t}",
+                "",
+            ]
+        lines += [
+            "\tchain prerouting {",
+            "\t\ttype nat hook prerouting priority dstnat; policy accept;",
+        ]
+        if self.captive_portal:
+            lines.append(f"\t\tiifname {{ {interfaces} }} tcp dport 80 ether saddr != @paid redirect to :{self.portal_port}")
+        lines += [
+            "\t}",
+            "",
+            "\tchain postrouting {",
+            "\t\ttype nat hook postrouting priority srcnat; policy accept;",
+            f'\t\toifname "{self.internet_interface}" masquerade',
+            "\t}",
+            "}",
+        ]
+        return [line for line in lines if line is not None]
+
+    def access_script(self, changes, access_state, installed=None, wanted=None):
+        """Element updates moving MACs to the wanted state; returns (lines, {mac: state} changed).
+
+        `installed` and `wanted` map MACs to their current and new connection-limit plans.
+        """
+        lines = []
+        installed = installed or {}
+        wanted = wanted or {}
+        updates = {}
+        for mac_address, state in changes.items():
+            current = access_state.get(mac_address)
+            if current == state:
+                continue
+            mac = str(mac_address).lower()
+            if current:
+                lines.append(f"delete element {self.table} mac_verdict {{ {mac} }}")
+            if current == 'allowed':
+                lines.append(f"delete element {self.table} paid {{ {mac} }}")
+            verdict = 'accept' if state == 'allowed' else 'drop'
+            lines.append(f"add element {self.table} mac_verdict {{ {mac} : {verdict} }}")
+            if state == 'allowed':
+                lines.append(f"add element {self.table} paid {{ {mac} }}")
+            if self.conn_limits:
+                lines += self.limit_script(mac_address, installed.get(mac_address),
+                                           wanted.get(mac_address) if state == 'allowed' else None)
+            updates[mac_address] = state
+        return lines, updates
+
+    def limit_script(self, mac_address, installed, wanted):
+        """Element updates moving a MAC from one connection-limit plan to another (None for none)"""
+        mac = str(mac_address).lower()
+        lines = []
+        if installed:
+            lines.append(f"delete element {self.table} mac_limits {{ {mac} }}")
+        if wanted:
+            lines.append(f"add element {self.table} mac_limits {{ {mac} : jump limit_{wanted} }}")
+        return lines
+
+    def mark_script(self, ip_address, mark, old_ip=None):
+        """Element updates pointing `ip_address` at `mark` (None removes it); `old_ip` is the client's previous address"""
+        lines = []
+        if old_ip:
+            lines.append(f"delete element {self.table} ip_mark {{ {old_ip} }}")
+        if ip_address and mark is not None:
+            lines.append(f"add element {self.table} ip_mark {{ {ip_address} : {mark} }}")
+        return lines
+
+    def apply(self, lines, check=False):
+        """Run a script as one nft transaction (`check` only validates it)"""
+        if not lines:
+            return ''
+        with tempfile.NamedTemporaryFile('w', suffix='.nft') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            return self.execute(f"nft {'-c ' if check else ''}-f {f.name}")
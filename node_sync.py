@@ -0,0 +1,501 @@
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import argparse
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from log_config import log_event
+
+# Every balance change is appended to balance_events under the node that made it,
+# numbered by that node's own sequence. A balance is the sum of all events for
+# the MAC (credits add, deductions subtract), so events can be merged in any
+# order and every node that has seen the same events holds the same balance.
+# sync_vector keeps the highest contiguous sequence seen per node; the local
+# node's row (local = 1) is also its sequence counter.
+#
+# sync_acks holds, per unit we exchange with directly, how far it has seen
+# each node's events. Events every such unit holds are folded into one
+# balance_snapshots row per (node, MAC) and deleted, and sync_compacted keeps
+# the sequence each node is folded through. A unit starting from nothing gets
+# the snapshots in place of the events they replace.
+
+def init_sync_tables(c, node_id=None, ledger=True):
+    """Create the ledger tables on an open cursor and claim a node id on first run.
+
+    With `ledger` (balance events are being recorded) the ledger is first
+    brought level with the users table, see reconcile_ledger.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS balance_events (
+            node_id TEXT,
+            seq INTEGER,
+            mac_address TEXT,
+            kind TEXT,
+            minutes REAL,
+            amount REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (node_id, seq)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            node_id TEXT,
+            mac_address TEXT,
+            minutes REAL,
+            amount REAL DEFAULT 0,
+            PRIMARY KEY (node_id, mac_address)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sync_compacted (
+            node_id TEXT PRIMARY KEY,
+            seq INTEGER DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sync_acks (
+            peer_id TEXT,
+            node_id TEXT,
+            seq INTEGER,
+            PRIMARY KEY (peer_id, node_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sync_vector (
+            node_id TEXT PRIMARY KEY,
+            seq INTEGER DEFAULT 0,
+            local INTEGER DEFAULT 0
+        )
+    ''')
+    c.execute('SELECT 1 FROM sync_vector WHERE local = 1')
+    if c.fetchone() is None:
+        c.execute('INSERT INTO sync_vector (node_id, seq, local) VALUES (?, 0, 1)',
+                  (node_id or uuid.uuid4().hex[:12],))
+    if ledger:
+        reconcile_ledger(c)
+
+def reconcile_ledger(c):
+    """Record an opening event for each balance the ledger doesn't add up to.
+
+    Covers balances from before the ledger existed and changes made while it
+    was off (a unit running without SYNC_PEERS records no events).
+    """
+    c.execute('''
+        SELECT users.mac_address, users.time_balance - COALESCE(ledger.minutes, 0)
+        FROM users LEFT JOIN (
+            SELECT mac_address, SUM(minutes) AS minutes FROM (
+                SELECT mac_address, minutes FROM balance_events
+                UNION ALL
+                SELECT mac_address, minutes FROM balance_snapshots
+            ) GROUP BY mac_address
+        ) AS ledger ON ledger.mac_address = users.mac_address
+    ''')
+    for mac_address, missing in c.fetchall():
+        if missing and abs(missing) > 1e-6:
+            record_balance_event(c, mac_address, 'opening', missing)
+
+def record_balance_event(c, mac_address, kind, minutes, amount=0):
+    """Append a local balance change (signed minutes) inside the writing transaction"""
+    c.execute('UPDATE sync_vector SET seq = seq + 1 WHERE local = 1')
+    c.execute('''
+        INSERT INTO balance_events (node_id, seq, mac_address, kind, minutes, amount)
+        SELECT node_id, seq, ?, ?, ?, ? FROM sync_vector WHERE local = 1
+    ''', (mac_address, kind, minutes, amount))
+
+
+class NodeSync:
+    """Replicates balance events between Piso WiFi units over HTTP.
+
+    Each node periodically pulls from its peers every event it hasn't seen,
+    sending its version vector so a peer only returns what's missing (including
+    events the peer relayed from other units). Merging is idempotent: events at
+    or below the vector are skipped, so overlapping pulls and retries are safe.
+    Both sides of a pull learn the other's vector, and compact() folds away
+    the events every unit this one exchanges with already holds.
+    Only time balances are on the ledger, so it doesn't run in data billing mode.
+    """
+
+    EVENT_FIELDS = ('node_id', 'seq', 'mac_address', 'kind', 'minutes', 'amount', 'created_at')
+
+    def __init__(self, db_path, peers=(), key=None, user_manager=None, on_merged=None,
+                 interval=2.0, batch_size=500):
+        self.db_path = db_path
+        self.peers = [peer.rstrip('/') for peer in peers]
+        self.key = key
+        self.user_manager = user_manager
+        self.on_merged = on_merged
+        self.interval = interval
+        self.batch_size = batch_size
+        self.logger = logging.getLogger(__name__)
+        self.running = False
+        self.thread = None
+        self.node_id = self._local_node_id()
+        self.peer_nodes = {}  # peer URL -> its node id, once it has answered a pull
+
+    @classmethod
+    def from_env(cls, user_manager, on_merged=None):
+        return cls(
+            user_manager.db_path,
+            peers=[peer.strip() for peer in os.getenv('SYNC_PEERS', '').split(',') if peer.strip()],
+            key=os.getenv('SYNC_KEY'),
+            user_manager=user_manager,
+            on_merged=on_merged,
+            interval=float(os.getenv('SYNC_INTERVAL', '2')),
+            batch_size=int(os.getenv('SYNC_BATCH_SIZE', '500'))
+        )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _local_node_id(self):
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT node_id FROM sync_vector WHERE local = 1').fetchone()[0]
+        finally:
+            conn.close()
+
+    def version_vector(self):
+        """{node_id: highest sequence applied here}"""
+        conn = self._connect()
+        try:
+            return dict(conn.execute('SELECT node_id, seq FROM sync_vector').fetchall())
+        finally:
+            conn.close()
+
+    def events_since(self, vector, limit=None):
+        """Events this node has beyond `vector`; returns (events, more)"""
+        limit = limit or self.batch_size
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            events = []
+            compacted = dict(c.execute('SELECT node_id, seq FROM sync_compacted').fetchall())
+            c.execute('SELECT node_id, seq FROM sync_vector ORDER BY node_id')
+            for node_id, seq in c.fetchall():
+                after = int(vector.get(node_id, 0))
+                if seq <= after or len(events) > limit:
+                    continue
+                if after < compacted.get(node_id, 0):
+                    if after:
+                        # Folded into snapshots partway through what the caller has; it
+                        # gets the rest from a unit that waited for its acknowledgement
+                        log_event(self.logger, logging.WARNING, 'sync_compacted_gap', node=node_id,
+                                  have=after, compacted=compacted[node_id])
+                        continue
+                    # Starting from nothing: snapshots_since covers the folded events
+                    after = compacted[node_id]
+                # Primary key range: only the missing tail of each node's events is read
+                c.execute('''
+                    SELECT node_id, seq, mac_address, kind, minutes, amount, created_at
+                    FROM balance_events WHERE node_id = ? AND seq > ?
+                    ORDER BY seq LIMIT ?
+                ''', (node_id, after, limit + 1 - len(events)))
+                events += [list(row) for row in c.fetchall()]
+            return events[:limit], len(events) > limit
+        finally:
+            conn.close()
+
+    def snapshots_since(self, vector):
+        """Snapshot rows [node_id, seq, mac_address, minutes, amount] for compacted nodes `vector` lacks entirely"""
+        conn = self._connect()
+        try:
+            rows = conn.execute('''
+                SELECT snapshots.node_id, compacted.seq, snapshots.mac_address, snapshots.minutes, snapshots.amount
+                FROM balance_snapshots AS snapshots JOIN sync_compacted AS compacted USING (node_id)
+                ORDER BY snapshots.node_id, snapshots.mac_address
+            ''').fetchall()
+        finally:
+            conn.close()
+        return [list(row) for row in rows if not int(vector.get(row[0], 0))]
+
+    def handle_pull(self, payload):
+        """Answer a peer's pull request ({"node_id": ..., "vector": {...}, "limit": n})"""
+        limit = min(int(payload.get('limit') or self.batch_size), self.batch_size)
+        vector = payload.get('vector') or {}
+        if payload.get('node_id'):
+            # The caller holds everything up to its vector
+            self.record_acks(payload['node_id'], vector)
+        events, more = self.events_since(vector, limit)
+        return {'node_id': self.node_id, 'vector': self.version_vector(), 'events': events,
+                'snapshots': self.snapshots_since(vector), 'more': more}
+
+    def record_acks(self, peer_id, vector):
+        """Remember how far `peer_id` has seen each node's events"""
+        if peer_id == self.node_id:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('''
+                    INSERT INTO sync_acks (peer_id, node_id, seq) VALUES (?, ?, ?)
+                    ON CONFLICT (peer_id, node_id) DO UPDATE SET seq = MAX(seq, excluded.seq)
+                ''', [(peer_id, node_id, int(seq)) for node_id, seq in vector.items()])
+        finally:
+            conn.close()
+
+    def merge(self, events, snapshots=()):
+        """Apply events (and snapshots) from a peer; returns {mac_address: minutes} actually applied"""
+        if not events and not snapshots:
+            return {}
+
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            # Read the vector under the write lock so concurrent merges can't both apply an event
+            c.execute('BEGIN IMMEDIATE')
+            vector = dict(c.execute('SELECT node_id, seq FROM sync_vector').fetchall())
+
+            # Snapshots stand in for a node's first events; only a node we have nothing of can take them
+            folded = [row for row in snapshots if row[0] != self.node_id and not vector.get(row[0], 0)]
+            for node_id, seq, *_ in folded:
+                vector[node_id] = int(seq)
+            c.executemany('''
+                INSERT INTO balance_snapshots (node_id, mac_address, minutes, amount) VALUES (?, ?, ?, ?)
+            ''', [(node_id, mac_address, minutes, amount) for node_id, _, mac_address, minutes, amount in folded])
+            c.executemany('''
+                INSERT INTO sync_compacted (node_id, seq) VALUES (?, ?)
+                ON CONFLICT (node_id) DO UPDATE SET seq = excluded.seq
+            ''', {(node_id, seq) for node_id, seq, *_ in folded})
+
+            fresh = []
+            for event in sorted(events, key=lambda event: (event[0], event[1])):
+                node_id, seq = event[0], int(event[1])
+                if node_id == self.node_id or seq <= vector.get(node_id, 0):
+                    continue
+                if seq != vector.get(node_id, 0) + 1:
+                    # A gap means events are missing; skip the rest of this node until they arrive
+                    continue
+                vector[node_id] = seq
+                fresh.append(event)
+
+            c.executemany('''
+                INSERT INTO balance_events (node_id, seq, mac_address, kind, minutes, amount, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', fresh)
+            c.executemany('''
+                INSERT INTO sync_vector (node_id, seq) VALUES (?, ?)
+                ON CONFLICT (node_id) DO UPDATE SET seq = excluded.seq
+            ''', [(node_id, seq) for node_id, seq in vector.items() if node_id != self.node_id])
+
+            deltas = {}
+            for _, _, mac_address, minutes, _ in folded:
+                deltas[mac_address] = deltas.get(mac_address, 0) + minutes
+            for event in fresh:
+                deltas[event[2]] = deltas.get(event[2], 0) + event[4]
+            c.executemany('''
+                INSERT INTO users (mac_address, time_balance, status)
+                VALUES (?, ?, CASE WHEN ? > 0 THEN 'active' ELSE 'inactive' END)
+                ON CONFLICT (mac_address) DO UPDATE SET
+                    time_balance = time_balance + excluded.time_balance,
+                    status = CASE WHEN time_balance + excluded.time_balance > 0 THEN 'active' ELSE 'inactive' END
+            ''', [(mac, minutes, minutes) for mac, minutes in deltas.items()])
+
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error merging {len(events)} balance events: {e}")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        if deltas:
+            if self.user_manager:
+                self.user_manager.notify_changed(deltas)
+            if self.on_merged:
+                self.on_merged(deltas)
+        return deltas
+
+    def pull(self, peer):
+        """Pull everything a peer has that this node lacks; returns the number of events applied"""
+        applied = 0
+        while True:
+            body = json.dumps({
+                'node_id': self.node_id,
+                'vector': self.version_vector(),
+                'limit': self.batch_size
+            }).encode()
+            request = urllib.request.Request(f"{peer}/api/sync/pull", data=body, method='POST',
+                                             headers={'Content-Type': 'application/json'})
+            if self.key:
+                request.add_header('X-Sync-Key', self.key)
+            with urllib.request.urlopen(request, timeout=10) as response:
+                result = json.loads(response.read())
+
+            self.peer_nodes[peer] = result['node_id']
+            if 'vector' in result:
+                self.record_acks(result['node_id'], result['vector'])
+            before = self.version_vector()
+            self.merge(result['events'], result.get('snapshots', ()))
+            progress = sum(self.version_vector().values()) - sum(before.values())
+            applied += progress
+            # Stop when the peer is drained or a batch made no progress (e.g. a gap)
+            if not result.get('more') or not progress:
+                return applied
+
+    def sync_once(self):
+        """Pull from every peer; unreachable peers are logged and retried next round"""
+        applied = 0
+        for peer in self.peers:
+            started = time.monotonic()
+            try:
+                count = self.pull(peer)
+            except Exception as e:
+                log_event(self.logger, logging.WARNING, 'sync_failed', peer=peer, error=str(e))
+                continue
+            applied += count
+            if count:
+                log_event(self.logger, logging.INFO, 'sync_pulled', peer=peer, events=count,
+                          ms=round((time.monotonic() - started) * 1000))
+        return applied
+
+    def compact(self):
+        """Fold events every directly connected unit holds into snapshots; returns how many were folded.
+
+        Waits until every configured peer has answered, so a peer that is down
+        keeps its events here until it catches up. A unit that once pulled from
+        this one and was retired for good keeps holding compaction back until
+        its sync_acks rows are deleted.
+        """
+        if len(self.peer_nodes) < len(self.peers):
+            return 0
+        conn = self._connect()
+        c = conn.cursor()
+        folded = 0
+        try:
+            acks = {}
+            for peer_id, node_id, seq in c.execute('SELECT peer_id, node_id, seq FROM sync_acks').fetchall():
+                acks.setdefault(peer_id, {})[node_id] = seq
+            acks.pop(self.node_id, None)
+            if not acks:
+                return 0
+            vector = dict(c.execute('SELECT node_id, seq FROM sync_vector').fetchall())
+            compacted = dict(c.execute('SELECT node_id, seq FROM sync_compacted').fetchall())
+            for node_id, seq in vector.items():
+                # Everyone we exchange with holds this node's events up to `upto`
+                upto = min([seq] + [peer.get(node_id, 0) for peer in acks.values()])
+                start = compacted.get(node_id, 0)
+                while start < upto:
+                    end = min(start + self.batch_size, upto)
+                    c.execute('BEGIN IMMEDIATE')
+                    c.execute('''
+                        INSERT INTO balance_snapshots (node_id, mac_address, minutes, amount)
+                        SELECT node_id, mac_address, SUM(minutes), SUM(amount) FROM balance_events
+                        WHERE node_id = ? AND seq > ? AND seq <= ?
+                        GROUP BY mac_address
+                        ON CONFLICT (node_id, mac_address) DO UPDATE SET
+                            minutes = minutes + excluded.minutes,
+                            amount = amount + excluded.amount
+                    ''', (node_id, start, end))
+                    c.execute('DELETE FROM balance_events WHERE node_id = ? AND seq > ? AND seq <= ?',
+                              (node_id, start, end))
+                    folded += c.rowcount
+                    c.execute('''
+                        INSERT INTO sync_compacted (node_id, seq) VALUES (?, ?)
+                        ON CONFLICT (node_id) DO UPDATE SET seq = excluded.seq
+                    ''', (node_id, end))
+                    conn.commit()
+                    start = end
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if folded:
+            log_event(self.logger, logging.INFO, 'sync_compacted', events=folded)
+        return folded
+
+    def start(self):
+        if not self.peers:
+            return
+        if self.user_manager and self.user_manager.billing_mode == 'data':
+            # The ledger carries minutes; data balances (bytes) are never recorded on it
+            self.logger.error("SYNC_PEERS is set but node sync only replicates time balances; "
+                              "not syncing with BILLING_MODE=data")
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='node-sync')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while self.running:
+            try:
+                self.sync_once()
+                self.compact()
+            except Exception as e:
+                self.logger.error(f"Error in node sync: {e}")
+            time.sleep(self.interval)
+
+
+def make_server(node_sync, host='127.0.0.1', port=0):
+    """A standalone HTTP server for /api/sync/pull (the app serves the same route)"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/api/sync/pull':
+                self.send_error(404)
+                return
+            if node_sync.key and self.headers.get('X-Sync-Key') != node_sync.key:
+                self.send_error(401)
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.dumps(node_sync.handle_pull(json.loads(self.rfile.read(length) or b'{}'))).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            node_sync.logger.debug(format % args)
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from user_manager import UserManager
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Balance sync between Piso WiFi units")
+    parser.add_argument('command', choices=['serve', 'status', 'credit'])
+    parser.add_argument('--db', default='config/piso_wifi.db')
+    parser.add_argument('--port', type=int, default=5100, help="serve: port for /api/sync/pull")
+    parser.add_argument('--peers', default=os.getenv('SYNC_PEERS', ''), help="serve: comma-separated peer URLs")
+    parser.add_argument('--mac')
+    parser.add_argument('--minutes', type=float, help="credit: minutes to add (negative deducts)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    user_manager = UserManager(args.db, ledger=True)
+    node_sync = NodeSync(args.db, [peer for peer in args.peers.split(',') if peer], key=os.getenv('SYNC_KEY'),
+                         user_manager=user_manager, interval=float(os.getenv('SYNC_INTERVAL', '2')))
+
+    if args.command == 'credit':
+        if args.minutes >= 0:
+            user_manager.add_time(args.mac, 0, args.minutes)
+        else:
+            user_manager.deduct_time(args.mac, -args.minutes, manual=True)
+        print(f"{args.mac}: {user_manager.check_balance(args.mac)} minutes")
+    elif args.command == 'status':
+        print(f"Node {node_sync.node_id}")
+        for node_id, seq in sorted(node_sync.version_vector().items()):
+            print(f"  {node_id}: {seq} events")
+    else:
+        server = make_server(node_sync, '0.0.0.0', args.port)
+        node_sync.start()
+        print(f"Node {node_sync.node_id} serving sync on port {args.port}, peers: {', '.join(node_sync.peers) or 'none'}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            node_sync.stop()
+            sys.exit(0)
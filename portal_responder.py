@@ -0,0 +1,157 @@
+import os
+import html
+import asyncio
+import logging
+import argparse
+import threading
+from urllib.parse import urlencode
+from log_config import log_event
+
+# Connectivity checks phones and laptops make right after joining a network.
+# Anything other than the expected answer (204, "Success", ...) makes the OS
+# show its "sign in to network" sheet, so all of them get the redirect.
+PROBE_PATHS = {
+    '/generate_204': 'android',
+    '/gen_204': 'android',
+    '/hotspot-detect.html': 'apple',
+    '/library/test/success.html': 'apple',
+    '/connecttest.txt': 'windows',
+    '/ncsi.txt': 'windows',
+    '/success.txt': 'firefox',
+    '/canonical.html': 'linux',
+}
+
+class PortalResponder:
+    """Answers HTTP from unpaid clients with a redirect to the customer portal page (/redeem).
+
+    Runs its own asyncio loop on a background thread, separate from Flask, so
+    a room full of phones re-probing connectivity costs a few coroutines
+    instead of web workers. Requests arrive here through the PORTAL nat chain
+    (see NetworkController.start_ap); the redirect points at the address the
+    client reached, i.e. its own radio's gateway, and carries the client's IP
+    and, when `mac_lookup(ip)` knows it, its MAC so the page can fill them in.
+    """
+
+    MAX_REQUEST_BYTES = 8192
+
+    def __init__(self, port=8081, portal_port=5000, host='0.0.0.0', timeout=5, mac_lookup=None):
+        self.port = port
+        self.portal_port = portal_port
+        self.mac_lookup = mac_lookup
+        self.host = host
+        self.timeout = timeout
+        self.logger = logging.getLogger(__name__)
+        self.stats = {'requests': 0, 'probes': 0, 'errors': 0}
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.ready = threading.Event()
+
+    @classmethod
+    def from_env(cls, mac_lookup=None):
+        return cls(
+            port=int(os.getenv('PORTAL_PORT', '8081')),
+            portal_port=int(os.getenv('FLASK_PORT', '5000')),
+            mac_lookup=mac_lookup
+        )
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name='portal-responder')
+        self.thread.daemon = True
+        self.thread.start()
+        self.ready.wait(timeout=5)
+
+    def stop(self):
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port, reuse_address=True,
+                                     limit=self.MAX_REQUEST_BYTES)
+            )
+            self.port = self.server.sockets[0].getsockname()[1]
+            log_event(self.logger, logging.INFO, 'portal_responder_started', port=self.port)
+        except Exception as e:
+            self.logger.error(f"Error starting portal responder on port {self.port}: {e}")
+            return
+        finally:
+            self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+    @staticmethod
+    def parse_request_line(data):
+        """(method, path) from the raw request head; the query string is dropped"""
+        try:
+            method, target, _ = data.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+        except ValueError:
+            return None, None
+        return method, target.split('?', 1)[0]
+
+    def response(self, portal_host, client_ip=None, mac_address=None):
+        query = {'ip': client_ip} if client_ip else {}
+        if mac_address is not None:
+            query['mac_address'] = str(mac_address)
+        location = f"http://{portal_host}:{self.portal_port}/redeem"
+        if query:
+            location += f"?{urlencode(query)}"
+        body = f"<a href=\"{html.escape(location)}\">Sign in</a>\r\n"
+        return (
+            "HTTP/1.1 302 Found\r\n"
+            f"Location: {location}\r\n"
+            "Cache-Control: no-cache, no-store\r\n"
+            "Content-Type: text/html\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+            f"{body}"
+        ).encode()
+
+    async def _handle(self, reader, writer):
+        try:
+            data = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+            method, path = self.parse_request_line(data)
+            self.stats['requests'] += 1
+            client_ip = writer.get_extra_info('peername')[0]
+            if path in PROBE_PATHS:
+                self.stats['probes'] += 1
+                log_event(self.logger, logging.DEBUG, 'portal_probe', os=PROBE_PATHS[path], client=client_ip)
+            mac_address = None
+            if self.mac_lookup:
+                # Lease lookups read a file; keep them off the loop
+                mac_address = await self.loop.run_in_executor(None, self.mac_lookup, client_ip)
+            # After REDIRECT the local end of the socket is the gateway address of the client's radio
+            writer.write(self.response(writer.get_extra_info('sockname')[0], client_ip, mac_address))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            self.stats['errors'] += 1
+        finally:
+            writer.close()
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Run the captive portal probe responder on its own")
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORTAL_PORT', '8081')))
+    parser.add_argument('--portal-port', type=int, default=int(os.getenv('FLASK_PORT', '5000')))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    responder = PortalResponder(args.port, args.portal_port)
+    responder.start()
+    try:
+        responder.thread.join()
+    except KeyboardInterrupt:
+        responder.stop()
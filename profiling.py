@@ -0,0 +1,229 @@
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import traceback
+from collections import Counter, deque
+from contextlib import contextmanager
+from log_config import log_event
+
+MODES = ('cprofile', 'sample')
+TARGETS = ('tick', 'request')
+
+def collapse_stack(frame):
+    """'file:function;...' from the outermost frame down to `frame` (flamegraph collapsed format)"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class ProfileSession:
+    """Profile data gathered over the next `count` ticks or requests"""
+
+    def __init__(self, target, count, mode):
+        self.target = target
+        self.count = count
+        self.mode = mode
+        self.remaining = count
+        self.started_at = time.time()
+        self.finished_at = None
+        self.stats = None          # pstats.Stats merged over the profiled sections (cprofile)
+        self.samples = Counter()   # collapsed stack -> samples (sample)
+        self.skipped = 0           # sections not profiled because another one held cProfile
+
+    @property
+    def done(self):
+        return self.remaining <= 0
+
+    def add_profile(self, profile):
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def pstats_text(self, sort='cumulative', limit=50):
+        if self.stats is None:
+            return ''
+        stream = io.StringIO()
+        self.stats.stream = stream
+        self.stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def collapsed(self):
+        """Collapsed stacks, one `stack count` line each, for flamegraph.pl or speedscope"""
+        if self.mode == 'sample':
+            return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+        if self.stats is None:
+            return ''
+        # cProfile keeps caller -> callee edges, not full stacks; give each function its own time
+        lines = []
+        for (filename, line, name), (_, _, own_time, _, _) in self.stats.stats.items():
+            if own_time > 0:
+                lines.append(f"{os.path.basename(filename)}:{name} {int(own_time * 1000000)}\n")
+        return ''.join(sorted(lines))
+
+    def summary(self):
+        return {
+            'target': self.target,
+            'mode': self.mode,
+            'count': self.count,
+            'profiled': self.count - self.remaining,
+            'skipped': self.skipped,
+            'done': self.done,
+            'samples': sum(self.samples.values()),
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class Profiler:
+    """On-demand profiling and a slow-section watchdog for ticks and requests.
+
+    Code marks its sections with begin()/end() (or section()). While a session
+    is armed, the next `count` sections of its target are profiled, either with
+    cProfile or by sampling the section's thread stack every `sample_interval`
+    seconds from the watchdog thread. Independently, a section still running
+    after its kind's threshold gets its stack captured and logged once, while
+    it is still stuck.
+    """
+
+    def __init__(self, slow_tick=2.0, slow_request=1.0, sample_interval=0.005, keep=20):
+        self.thresholds = {'tick': slow_tick, 'request': slow_request}
+        self.sample_interval = sample_interval
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        # cProfile may only profile one section at a time
+        self.cprofile_lock = threading.Lock()
+        self.active = {}           # thread ident -> section dict
+        self.session = None
+        self.slow = deque(maxlen=keep)
+        self.running = False
+        self.thread = None
+        # Cuts the watchdog's idle wait short when a sampling session is armed
+        self.wake = threading.Event()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            slow_tick=float(os.getenv('SLOW_TICK_SECONDS', '2')),
+            slow_request=float(os.getenv('SLOW_REQUEST_SECONDS', '1'))
+        )
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._watch, name='profiler-watchdog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+
+    def arm(self, target, count, mode='cprofile'):
+        """Profile the next `count` sections of `target` ('tick' or 'request'); replaces any previous session"""
+        if target not in TARGETS:
+            raise ValueError(f"target must be one of {', '.join(TARGETS)}")
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+        if not 1 <= count <= 1000:
+            raise ValueError("count must be between 1 and 1000")
+        with self.lock:
+            self.session = ProfileSession(target, count, mode)
+        self.wake.set()
+        log_event(self.logger, logging.INFO, 'profile_armed', target=target, count=count, mode=mode)
+        return self.session
+
+    def begin(self, kind, name):
+        """Mark the start of a tick or request on the current thread; pass the result to end()"""
+        section = {'kind': kind, 'name': name, 'started': time.monotonic(), 'captured': False,
+                   'session': None, 'profile': None}
+        session = self.session
+        if session and session.target == kind and not session.done:
+            section['session'] = session
+            if session.mode == 'cprofile':
+                if self.cprofile_lock.acquire(blocking=False):
+                    section['profile'] = cProfile.Profile()
+                    section['profile'].enable()
+                else:
+                    section['session'] = None
+                    session.skipped += 1
+        self.active[threading.get_ident()] = section
+        return section
+
+    def end(self, section):
+        self.active.pop(threading.get_ident(), None)
+        profile = section['profile']
+        if profile is not None:
+            profile.disable()
+            self.cprofile_lock.release()
+        session = section['session']
+        if session is None:
+            return
+        with self.lock:
+            if profile is not None:
+                session.add_profile(profile)
+            session.remaining = max(session.remaining - 1, 0)
+            if session.done and session.finished_at is None:
+                session.finished_at = time.time()
+                log_event(self.logger, logging.INFO, 'profile_finished', target=session.target,
+                          mode=session.mode, count=session.count)
+
+    @contextmanager
+    def section(self, kind, name):
+        section = self.begin(kind, name)
+        try:
+            yield section
+        finally:
+            self.end(section)
+
+    def _watch(self):
+        while self.running:
+            try:
+                self._check_sections()
+            except Exception as e:
+                self.logger.error(f"Error in profiler watchdog: {e}")
+            session = self.session
+            sampling = session is not None and session.mode == 'sample' and not session.done
+            self.wake.wait(self.sample_interval if sampling else 0.05)
+            self.wake.clear()
+
+    def _check_sections(self):
+        if not self.active:
+            return
+        now = time.monotonic()
+        frames = sys._current_frames()
+        for ident, section in list(self.active.items()):
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            session = section['session']
+            if session is not None and session.mode == 'sample':
+                session.samples[collapse_stack(frame)] += 1
+            elapsed = now - section['started']
+            if not section['captured'] and elapsed >= self.thresholds.get(section['kind'], float('inf')):
+                section['captured'] = True
+                self._capture_slow(section, frame, elapsed)
+
+    def _capture_slow(self, section, frame, elapsed):
+        stack = traceback.format_stack(frame)
+        code = frame.f_code
+        snapshot = {
+            'kind': section['kind'],
+            'name': section['name'],
+            'seconds': round(elapsed, 3),
+            'captured_at': time.time(),
+            'stack': ''.join(stack),
+        }
+        self.slow.append(snapshot)
+        log_event(self.logger, logging.WARNING, f"slow_{section['kind']}", name=section['name'],
+                  seconds=snapshot['seconds'],
+                  at=f"{os.path.basename(code.co_filename)}:{frame.f_lineno}:{code.co_name}")
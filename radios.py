@@ -0,0 +1,161 @@
+import os
+import logging
+import ipaddress
+
+# hostapd_cli looks for the control sockets here by default
+HOSTAPD_CTRL_DIR = '/var/run/hostapd'
+
+class Radio:
+    """One AP interface with its own hostapd config, DHCP scope and tc tree.
+
+    The client limit drives both hostapd's max_num_sta and the size of the
+    DHCP pool (twice the limit, so leases of devices that just left don't
+    starve new ones).
+    """
+
+    def __init__(self, interface, ip, ssid, channel=7, hw_mode='g', max_clients=32,
+                 netmask='255.255.255.0', country_code='PH', dhcp_start=None, dhcp_end=None):
+        self.interface = interface
+        self.ip = ip
+        self.ssid = ssid
+        self.channel = int(channel)
+        self.hw_mode = hw_mode
+        self.max_clients = int(max_clients)
+        self.netmask = netmask
+        self.country_code = country_code
+        self.dhcp_start = dhcp_start
+        self.dhcp_end = dhcp_end
+        self.network = ipaddress.IPv4Network(f"{ip}/{netmask}", strict=False)
+
+    @property
+    def hostapd_conf(self):
+        return f"/etc/hostapd/hostapd-{self.interface}.conf"
+
+    @property
+    def pid_file(self):
+        return f"/run/hostapd-{self.interface}.pid"
+
+    @property
+    def prefix_length(self):
+        return self.network.prefixlen
+
+    def contains(self, ip_address):
+        try:
+            return ipaddress.IPv4Address(ip_address) in self.network
+        except ValueError:
+            return False
+
+    def dhcp_range(self):
+        """(first, last) pool addresses, sized from max_clients and kept inside the subnet"""
+        if self.dhcp_start and self.dhcp_end:
+            return self.dhcp_start, self.dhcp_end
+        hosts = list(self.network.hosts())
+        start = min(9, max(len(hosts) - 1, 0))  # Leave .1-.9 for the AP and static hosts
+        end = min(start + 2 * self.max_clients, len(hosts)) - 1
+        return str(hosts[start]), str(hosts[end])
+
+    def pool_size(self):
+        """Number of addresses in the DHCP pool"""
+        start, end = self.dhcp_range()
+        return max(int(ipaddress.IPv4Address(end)) - int(ipaddress.IPv4Address(start)) + 1, 0)
+
+    def hostapd_config(self):
+        five_ghz = self.hw_mode == 'a'
+        lines = [
+            "# Interface configuration",
+            f"interface={self.interface}",
+            "driver=nl80211",
+            f"ssid={self.ssid}",
+            "",
+            "# Control interface for hostapd_cli (live reconfiguration, deauthentication)",
+            f"ctrl_interface={HOSTAPD_CTRL_DIR}",
+            "ctrl_interface_group=0",
+            "",
+            "# Hardware configuration",
+            f"hw_mode={self.hw_mode}",
+            f"channel={self.channel}",
+            "ieee80211n=1",
+        ]
+        if five_ghz:
+            lines += [
+                "ieee80211ac=1",
+                f"country_code={self.country_code}",
+                "ieee80211d=1",
+            ]
+        lines += [
+            "wmm_enabled=1" if five_ghz else "wmm_enabled=0",
+            "",
+            "# Open network configuration",
+            "auth_algs=1",
+            "ignore_broadcast_ssid=0",
+            "",
+            "# Debugging",
+            "logger_syslog=-1",
+            "logger_syslog_level=2",
+            "logger_stdout=-1",
+            "logger_stdout_level=2",
+            "",
+            "# Stability settings",
+            "beacon_int=100",
+            "dtim_period=2",
+            f"max_num_sta={self.max_clients}",
+            "rts_threshold=2347",
+            "fragm_threshold=2346",
+        ]
+        return '\n'.join(lines)
+
+    def dnsmasq_scope(self):
+        """dnsmasq lines for this radio's interface, pool and gateway (tagged by interface)"""
+        start, end = self.dhcp_range()
+        tag = self.interface
+        return '\n'.join([
+            f"interface={self.interface}",
+            f"dhcp-range=set:{tag},{start},{end},{self.netmask},24h",
+            f"dhcp-option=tag:{tag},option:router,{self.ip}",
+            f"dhcp-option=tag:{tag},option:dns-server,{self.ip}",
+            f"dhcp-option=tag:{tag},option:netmask,{self.netmask}",
+        ])
+
+
+def radios_from_env():
+    """Radios from RADIOS="wlan0,wlan2" and RADIO_<IFACE>_* overrides.
+
+    Without RADIOS a single radio is built from the original WIFI_INTERFACE,
+    AP_SSID and AP_IP settings. Per-radio settings: RADIO_<IFACE>_IP, _SSID,
+    _CHANNEL, _HW_MODE, _MAX_CLIENTS (default MAX_CLIENTS_PER_RADIO) and
+    _DHCP_START / _DHCP_END (the first radio also honours DHCP_RANGE_*). An
+    explicit pool smaller than the radio's client limit is logged, since
+    hostapd then admits stations dnsmasq has no address for.
+    """
+    interfaces = [name.strip() for name in os.getenv('RADIOS', '').split(',') if name.strip()]
+    if not interfaces:
+        interfaces = [os.getenv('WIFI_INTERFACE', 'wlan0')]
+
+    base_ssid = os.getenv('AP_SSID', 'PisoWiFi')
+    netmask = os.getenv('NETWORK_MASK', '255.255.255.0')
+    max_clients = os.getenv('MAX_CLIENTS_PER_RADIO', '32')
+    country_code = os.getenv('COUNTRY_CODE', 'PH')
+
+    radios = []
+    for index, interface in enumerate(interfaces):
+        key = f"RADIO_{interface.upper().replace('-', '_')}_"
+        default_ip = os.getenv('AP_IP', '192.168.4.1') if index == 0 else f"192.168.{4 + index}.1"
+        hw_mode = os.getenv(key + 'HW_MODE', 'g')
+        radios.append(Radio(
+            interface,
+            os.getenv(key + 'IP', default_ip),
+            os.getenv(key + 'SSID', base_ssid),
+            channel=os.getenv(key + 'CHANNEL', '36' if hw_mode == 'a' else '7'),
+            hw_mode=hw_mode,
+            max_clients=os.getenv(key + 'MAX_CLIENTS', max_clients),
+            netmask=netmask,
+            country_code=country_code,
+            dhcp_start=os.getenv(key + 'DHCP_START', os.getenv('DHCP_RANGE_START') if index == 0 else None),
+            dhcp_end=os.getenv(key + 'DHCP_END', os.getenv('DHCP_RANGE_END') if index == 0 else None)
+        ))
+    for radio in radios:
+        if radio.dhcp_start and radio.dhcp_end and radio.pool_size() < radio.max_clients:
+            logging.getLogger(__name__).warning(
+                f"DHCP pool {radio.dhcp_start}-{radio.dhcp_end} on {radio.interface} has {radio.pool_size()} "
+                f"addresses for up to {radio.max_clients} clients; widen it or drop it to size it automatically")
+    return radios
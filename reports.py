@@ -0,0 +1,256 @@
+import sys
+import sqlite3
+import logging
+import argparse
+from datetime import date, timedelta
+
+# Summary tables are keyed by local calendar day and the device's plan. They are
+# kept up to date inside the same transactions that credit and meter time, so
+# reports never scan transactions or time_logs. Data billing (BILLING_MODE=data)
+# sells and meters bytes, which go in their own columns next to the minutes.
+
+def init_report_tables(c):
+    """Create the summary tables on an open cursor"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_revenue (
+            day TEXT,
+            plan TEXT,
+            amount REAL DEFAULT 0,
+            minutes REAL DEFAULT 0,
+            data_bytes INTEGER DEFAULT 0,
+            transactions INTEGER DEFAULT 0,
+            devices INTEGER DEFAULT 0,
+            PRIMARY KEY (day, plan)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_usage (
+            day TEXT,
+            plan TEXT,
+            minutes_used REAL DEFAULT 0,
+            bytes_used INTEGER DEFAULT 0,
+            devices INTEGER DEFAULT 0,
+            PRIMARY KEY (day, plan)
+        ) WITHOUT ROWID
+    ''')
+    # Which devices paid / used time on a day, for distinct device counts
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_device_activity (
+            day TEXT,
+            kind TEXT,
+            plan TEXT,
+            mac_address TEXT,
+            PRIMARY KEY (day, kind, plan, mac_address)
+        ) WITHOUT ROWID
+    ''')
+    # Columns added after the first release
+    for table, column in (('daily_revenue', 'data_bytes'), ('daily_usage', 'bytes_used')):
+        c.execute(f'PRAGMA table_info({table})')
+        if column not in {row[1] for row in c.fetchall()}:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER DEFAULT 0')
+
+def _day_and_plan(c, mac_address):
+    c.execute('''
+        SELECT date('now', 'localtime'),
+               COALESCE((SELECT plan FROM users WHERE mac_address = ?), 'default')
+    ''', (mac_address,))
+    return c.fetchone()
+
+def _mark_active(c, day, kind, plan, mac_address):
+    """Record device activity; returns True the first time on that day"""
+    c.execute('INSERT OR IGNORE INTO daily_device_activity (day, kind, plan, mac_address) VALUES (?, ?, ?, ?)',
+              (day, kind, plan, mac_address))
+    return c.rowcount == 1
+
+def record_credit(c, mac_address, amount, minutes, data_bytes=0):
+    """Add a credit to today's revenue summary (call inside the crediting transaction)"""
+    day, plan = _day_and_plan(c, mac_address)
+    new_device = 1 if _mark_active(c, day, 'paid', plan, mac_address) else 0
+    c.execute('''
+        INSERT INTO daily_revenue (day, plan, amount, minutes, data_bytes, transactions, devices)
+        VALUES (?, ?, ?, ?, ?, 1, ?)
+        ON CONFLICT (day, plan) DO UPDATE SET
+            amount = amount + excluded.amount,
+            minutes = minutes + excluded.minutes,
+            data_bytes = data_bytes + excluded.data_bytes,
+            transactions = transactions + 1,
+            devices = devices + excluded.devices
+    ''', (day, plan, amount, minutes, data_bytes, new_device))
+
+def record_usage(c, mac_address, minutes, data_bytes=0):
+    """Add metered minutes (or bytes) to today's usage summary (call inside the deducting transaction)"""
+    day, plan = _day_and_plan(c, mac_address)
+    new_device = 1 if _mark_active(c, day, 'used', plan, mac_address) else 0
+    c.execute('''
+        INSERT INTO daily_usage (day, plan, minutes_used, bytes_used, devices)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (day, plan) DO UPDATE SET
+            minutes_used = minutes_used + excluded.minutes_used,
+            bytes_used = bytes_used + excluded.bytes_used,
+            devices = devices + excluded.devices
+    ''', (day, plan, minutes, data_bytes, new_device))
+
+
+class ReportManager:
+    """Reads the revenue/usage summaries and rebuilds them from history"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.logger = logging.getLogger(__name__)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def period_range(period, today=None):
+        """Map 'today', 'week' (last 7 days) or 'month' (last 30 days) to (start, end)"""
+        today = today or date.today()
+        days = {'today': 1, 'week': 7, 'month': 30}.get(period)
+        if days is None:
+            raise ValueError(f"Unknown period: {period}")
+        return (today - timedelta(days=days - 1)).isoformat(), today.isoformat()
+
+    def summary(self, start, end):
+        """Revenue and usage per day and plan between two ISO dates, with totals"""
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute('''
+                SELECT day, plan, amount, minutes, data_bytes, transactions, devices
+                FROM daily_revenue WHERE day BETWEEN ? AND ? ORDER BY day, plan
+            ''', (start, end))
+            revenue = [
+                {'day': r[0], 'plan': r[1], 'amount': r[2], 'minutes': r[3], 'data_bytes': r[4],
+                 'transactions': r[5], 'devices': r[6]}
+                for r in c.fetchall()
+            ]
+
+            c.execute('''
+                SELECT day, plan, minutes_used, bytes_used, devices
+                FROM daily_usage WHERE day BETWEEN ? AND ? ORDER BY day, plan
+            ''', (start, end))
+            usage = [
+                {'day': r[0], 'plan': r[1], 'minutes_used': r[2], 'bytes_used': r[3], 'devices': r[4]}
+                for r in c.fetchall()
+            ]
+
+            # Distinct devices over the whole range (a device active on several days counts once)
+            c.execute('''
+                SELECT kind, COUNT(DISTINCT mac_address) FROM daily_device_activity
+                WHERE day BETWEEN ? AND ? GROUP BY kind
+            ''', (start, end))
+            devices = dict(c.fetchall())
+
+            return {
+                'start': start,
+                'end': end,
+                'revenue': revenue,
+                'usage': usage,
+                'totals': {
+                    'amount': sum(r['amount'] for r in revenue),
+                    'minutes_sold': sum(r['minutes'] for r in revenue),
+                    'bytes_sold': sum(r['data_bytes'] for r in revenue),
+                    'transactions': sum(r['transactions'] for r in revenue),
+                    'minutes_used': sum(u['minutes_used'] for u in usage),
+                    'bytes_used': sum(u['bytes_used'] for u in usage),
+                    'paying_devices': devices.get('paid', 0),
+                    'active_devices': devices.get('used', 0)
+                }
+            }
+        finally:
+            conn.close()
+
+    def rebuild(self):
+        """Recompute all summaries from transactions and time logs (backfill).
+
+        Devices are attributed to their current plan. Usage that has already
+        been compacted out of time_logs is taken from the daily rollups.
+        """
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            init_report_tables(c)
+            c.execute('DELETE FROM daily_revenue')
+            c.execute('DELETE FROM daily_usage')
+            c.execute('DELETE FROM daily_device_activity')
+
+            c.execute('''
+                INSERT INTO daily_device_activity (day, kind, plan, mac_address)
+                SELECT DISTINCT date(t.created_at, 'localtime'), 'paid', COALESCE(u.plan, 'default'), u.mac_address
+                FROM transactions t JOIN users u ON u.id = t.user_id
+            ''')
+            c.execute('''
+                INSERT INTO daily_revenue (day, plan, amount, minutes, data_bytes, transactions, devices)
+                SELECT date(t.created_at, 'localtime') AS day, COALESCE(u.plan, 'default') AS plan,
+                       SUM(t.amount), SUM(t.minutes), SUM(COALESCE(t.data_bytes, 0)), COUNT(*),
+                       COUNT(DISTINCT u.mac_address)
+                FROM transactions t LEFT JOIN users u ON u.id = t.user_id
+                GROUP BY day, plan
+            ''')
+
+            c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'time_logs_daily'")
+            if c.fetchone():
+                c.execute("SELECT COALESCE(MAX(value), 0) FROM compaction_state WHERE name = 'time_logs_rolled_up'")
+                watermark = c.fetchone()[0]
+                usage_source = '''
+                    SELECT day, mac_address, minutes_deducted AS minutes, bytes_deducted AS bytes FROM time_logs_daily
+                    UNION ALL
+                    SELECT date(deducted_at, 'localtime'), mac_address, minutes_deducted, bytes_deducted
+                    FROM time_logs WHERE id > ?
+                '''
+                params = (watermark,)
+            else:
+                usage_source = '''
+                    SELECT date(deducted_at, 'localtime') AS day, mac_address, minutes_deducted AS minutes,
+                           bytes_deducted AS bytes
+                    FROM time_logs
+                '''
+                params = ()
+
+            c.execute(f'''
+                INSERT INTO daily_device_activity (day, kind, plan, mac_address)
+                SELECT DISTINCT s.day, 'used', COALESCE(u.plan, 'default'), s.mac_address
+                FROM ({usage_source}) s LEFT JOIN users u ON u.mac_address = s.mac_address
+            ''', params)
+            c.execute(f'''
+                INSERT INTO daily_usage (day, plan, minutes_used, bytes_used, devices)
+                SELECT s.day, COALESCE(u.plan, 'default') AS plan, SUM(s.minutes), SUM(COALESCE(s.bytes, 0)),
+                       COUNT(DISTINCT s.mac_address)
+                FROM ({usage_source}) s LEFT JOIN users u ON u.mac_address = s.mac_address
+                GROUP BY s.day, plan
+            ''', params)
+
+            conn.commit()
+            c.execute('SELECT COUNT(*) FROM daily_revenue')
+            revenue_rows = c.fetchone()[0]
+            c.execute('SELECT COUNT(*) FROM daily_usage')
+            usage_rows = c.fetchone()[0]
+            self.logger.info(f"Rebuilt reports: {revenue_rows} revenue rows, {usage_rows} usage rows")
+            return revenue_rows, usage_rows
+        except Exception as e:
+            self.logger.error(f"Error rebuilding reports: {e}")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Revenue and usage reports")
+    parser.add_argument('command', choices=['rebuild', 'show'])
+    parser.add_argument('--db', default='config/piso_wifi.db')
+    parser.add_argument('--period', default='today', choices=['today', 'week', 'month'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    reports = ReportManager(args.db)
+
+    if args.command == 'rebuild':
+        revenue_rows, usage_rows = reports.rebuild()
+        print(f"Rebuilt {revenue_rows} revenue and {usage_rows} usage summary rows")
+    else:
+        totals = reports.summary(*ReportManager.period_range(args.period))['totals']
+        for key, value in totals.items():
+            print(f"{key}: {value}")
+    sys.exit(0)
@@ -0,0 +1,81 @@
+import re
+
+_HEX_DIGITS = re.compile(r'[0-9A-Fa-f]{12}')
+
+class Mac(int):
+    """A MAC address as its 48-bit integer value.
+
+    Any spelling ('aa:bb:cc:dd:ee:ff', 'AA-BB-CC-DD-EE-FF', 'aabb.ccdd.eeff')
+    parses to the same key, so dicts and sets of MACs can't disagree on case
+    or separators. It formats as 'AA:BB:CC:DD:EE:FF' wherever it is turned into
+    text (f-strings, logs, rules); pass str(mac) to SQL and JSON, which would
+    otherwise take it as a number.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, value):
+        if isinstance(value, Mac):
+            return value
+        if isinstance(value, int):
+            number = value
+        else:
+            digits = re.sub(r'[:.\-]', '', str(value).strip())
+            if not _HEX_DIGITS.fullmatch(digits):
+                raise ValueError(f"Invalid MAC address: {value!r}")
+            number = int(digits, 16)
+        if not 0 <= number < 1 << 48:
+            raise ValueError(f"Invalid MAC address: {value!r}")
+        return super().__new__(cls, number)
+
+    def __str__(self):
+        digits = f"{int(self):012X}"
+        return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+    def __repr__(self):
+        return f"Mac('{self}')"
+
+
+def to_mac(value):
+    """Mac for `value`, or None if it isn't a MAC address"""
+    try:
+        return Mac(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Station:
+    """A station associated with one of the radios, as seen on the latest station dump"""
+
+    __slots__ = ('mac', 'interface', 'ip', 'hostname', 'signal', 'inactive_ms')
+
+    def __init__(self, mac, interface, ip=None, hostname=None, signal=None, inactive_ms=None):
+        self.mac = Mac(mac)
+        self.interface = interface
+        self.ip = ip
+        self.hostname = hostname
+        self.signal = signal
+        self.inactive_ms = inactive_ms  # ms since the station last sent or received anything
+
+    @property
+    def mac_address(self):
+        return str(self.mac)
+
+    def to_dict(self):
+        """The device dict served by the API and dashboard"""
+        device = {
+            'mac_address': str(self.mac),
+            'ip': self.ip or 'Unknown',
+            'hostname': self.hostname or 'Unknown',
+            'interface': self.interface,
+            'connected': True
+        }
+        if self.signal:
+            device['signal'] = f"{self.signal} dBm"
+        return device
+
+    def __repr__(self):
+        return f"Station({self.mac}, {self.interface}, ip={self.ip})"
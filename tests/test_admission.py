@@ -0,0 +1,55 @@
+import pytest
+from user_manager import UserManager
+from admission import AdmissionIndex
+
+MAC = "00:11:22:33:44:55"
+
+class FakeNetworkController:
+    def __init__(self):
+        self.calls = []
+
+    def block_mac(self, mac_address):
+        self.calls.append(('block', mac_address))
+        return True
+
+    def admit_mac(self, mac_address, download_kbps, upload_kbps, ip_address=None):
+        self.calls.append(('admit', mac_address, download_kbps, upload_kbps, ip_address))
+        return True
+
+@pytest.fixture
+def user_manager(tmp_path):
+    return UserManager(db_path=str(tmp_path / 'piso_wifi.db'))
+
+@pytest.fixture
+def network_controller():
+    return FakeNetworkController()
+
+@pytest.fixture
+def admission(user_manager, network_controller):
+    index = AdmissionIndex(user_manager, network_controller)
+    index.load()
+    user_manager.add_listener(index.refresh)
+    return index
+
+def test_unknown_device_is_blocked(admission, network_controller):
+    admission.admit(MAC, '192.168.4.10')
+    assert network_controller.calls == [('block', MAC)]
+
+def test_index_follows_credits_and_deductions(user_manager, admission, network_controller):
+    user_manager.add_time(MAC, 5, 5)
+    assert admission.lookup(MAC) == (5, 'default', 1024, 512)
+
+    admission.admit(MAC, '192.168.4.10')
+    assert network_controller.calls[-1] == ('admit', MAC, 1024, 512, '192.168.4.10')
+
+    user_manager.deduct_time(MAC, 5)
+    admission.admit(MAC)
+    assert network_controller.calls[-1] == ('block', MAC)
+
+def test_load_picks_up_existing_balances(user_manager, network_controller):
+    user_manager.add_time(MAC, 10, 10)
+    user_manager.set_bandwidth(MAC, 4096, 2048)
+
+    index = AdmissionIndex(user_manager, network_controller)
+    assert index.load() == 1
+    assert index.lookup(MAC) == (10, 'default', 4096, 2048)
@@ -0,0 +1,143 @@
+import logging
+import threading
+import pytest
+from ap_config import plan_reconfigure, channel_frequency
+from network_controller import NetworkController
+from radios import Radio
+
+def actions(plan):
+    return [step['action'] for step in plan.steps]
+
+@pytest.fixture
+def radio():
+    return Radio('wlan0', '192.168.4.1', 'PisoWiFi', channel=6, max_clients=32)
+
+def test_channel_frequency():
+    assert channel_frequency(1) == 2412
+    assert channel_frequency(14) == 2484
+    assert channel_frequency(36) == 5180
+    with pytest.raises(ValueError):
+        channel_frequency(20)
+
+def test_unchanged_settings_need_nothing(radio):
+    plan = plan_reconfigure(radio, {'ssid': 'PisoWiFi', 'channel': '6'})
+    assert plan.changes == {} and plan.steps == []
+
+def test_client_limit_is_set_live_and_resizes_the_pool(radio):
+    plan = plan_reconfigure(radio, {'max_clients': 64})
+    assert actions(plan) == ['write_hostapd_config', 'hostapd_set', 'write_dnsmasq_config', 'restart_dnsmasq']
+    assert plan.steps[1]['commands'] == ["hostapd_cli -i wlan0 set max_num_sta 64"]
+    assert not plan.disconnects
+    assert plan.updated.dhcp_range() == ('192.168.4.10', '192.168.4.137')
+    assert radio.max_clients == 32
+
+def test_fixed_pool_keeps_dnsmasq_running(radio):
+    radio.dhcp_start, radio.dhcp_end = '192.168.4.10', '192.168.4.200'
+    assert actions(plan_reconfigure(radio, {'max_clients': 64})) == ['write_hostapd_config', 'hostapd_set']
+
+def test_channel_moves_with_a_switch_announcement(radio):
+    plan = plan_reconfigure(radio, {'channel': 11})
+    step = plan.steps[1]
+    assert step['action'] == 'chan_switch'
+    assert step['commands'] == ["hostapd_cli -i wlan0 chan_switch 5 2462", "hostapd_cli -i wlan0 set channel 11"]
+    assert 'hostapd -B -P /run/hostapd-wlan0.pid /etc/hostapd/hostapd-wlan0.conf' in step['fallback']
+    assert not plan.disconnects
+
+def test_ssid_reloads_and_band_change_restarts(radio):
+    plan = plan_reconfigure(radio, {'ssid': "Juan's WiFi"})
+    assert plan.steps[1]['commands'] == ["hostapd_cli -i wlan0 set ssid 'Juan'\"'\"'s WiFi'", "hostapd_cli -i wlan0 reload"]
+    assert plan.disconnects
+
+    plan = plan_reconfigure(radio, {'channel': 36, 'hw_mode': 'a', 'ssid': 'PisoWiFi-5G'})
+    assert actions(plan) == ['write_hostapd_config', 'restart_hostapd']
+    assert plan.summary()['changes']['channel'] == [6, 36]
+
+@pytest.mark.parametrize('settings', [
+    {'channel': 36},
+    {'ssid': ''},
+    {'ssid': 'x' * 33},
+    {'max_clients': 0},
+    {'dhcp_start': '192.168.4.50'},
+    {'dhcp_start': '192.168.4.50', 'dhcp_end': '192.168.5.10'},
+    {'dhcp_start': '192.168.4.50', 'dhcp_end': '192.168.4.20'},
+    {'password': 'secret'},
+])
+def test_invalid_settings_are_rejected(radio, settings):
+    with pytest.raises(ValueError):
+        plan_reconfigure(radio, settings)
+
+
+@pytest.fixture
+def controller(radio):
+    controller = NetworkController.__new__(NetworkController)
+    controller.logger = logging.getLogger('test')
+    controller.radios = [radio]
+    controller.ssid = radio.ssid
+    controller.dnsmasq_conf = '/etc/dnsmasq.conf'
+    controller.reconfigure_lock = threading.Lock()
+    controller.commands = []
+    controller.written = []
+    controller.replies = {}
+
+    def execute(command, ignore_errors=False):
+        controller.commands.append(command)
+        reply = controller.replies.get(command.split()[3] if command.startswith('hostapd_cli') else command, 'OK\n')
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    controller._execute_command = execute
+    controller._write_hostapd_config = lambda radio: controller.written.append(('hostapd', radio.ssid, radio.channel))
+    controller._write_dnsmasq_config = lambda radios: controller.written.append(('dnsmasq', radios[0].dhcp_range()))
+    return controller
+
+def test_dry_run_touches_nothing(controller, radio):
+    result = controller.reconfigure_radio('wlan0', {'ssid': 'New'}, dry_run=True)
+    assert result['dry_run'] and not result['applied']
+    assert controller.commands == [] and controller.written == []
+    assert radio.ssid == 'PisoWiFi'
+
+def test_apply_updates_the_running_radio(controller, radio):
+    result = controller.reconfigure_radio('wlan0', {'ssid': 'New', 'max_clients': '40'})
+    assert result['applied']
+    assert [step['result'] for step in result['steps']] == ['ok'] * 5
+    assert radio.ssid == controller.ssid == 'New' and radio.max_clients == 40
+    assert "systemctl restart dnsmasq" in controller.commands
+
+def test_refused_channel_switch_falls_back_to_restart(controller, radio):
+    controller.replies['chan_switch'] = 'FAIL\n'
+    result = controller.reconfigure_radio('wlan0', {'channel': 1})
+    assert result['applied'] and result['steps'][1]['result'] == 'fallback'
+    assert controller.commands[-1] == "hostapd -B -P /run/hostapd-wlan0.pid /etc/hostapd/hostapd-wlan0.conf"
+    assert radio.channel == 1
+
+def test_failure_stops_and_restores_config_files(controller, radio):
+    controller.replies['set'] = 'FAIL\n'
+    result = controller.reconfigure_radio('wlan0', {'max_clients': 64})
+    assert not result['applied']
+    assert [step['result'] for step in result['steps']] == ['ok', 'failed', 'skipped', 'skipped']
+    assert controller.written[-2:] == [('hostapd', 'PisoWiFi', 6), ('dnsmasq', ('192.168.4.10', '192.168.4.73'))]
+    assert radio.max_clients == 32
+
+def test_unknown_radio(controller):
+    with pytest.raises(ValueError):
+        controller.reconfigure_radio('wlan9', {'ssid': 'New'})
+
+def test_unreachable_hostapd_is_reported_not_restarted(controller, radio):
+    controller.replies['chan_switch'] = "Failed to connect to hostapd - wpa_ctrl_open: No such file or directory\n"
+    result = controller.reconfigure_radio('wlan0', {'channel': 1})
+    step = result['steps'][1]
+    assert not result['applied'] and step['result'] == 'failed'
+    assert 'control socket' in step['error']
+    assert not any(command.startswith('kill') for command in controller.commands)
+    assert not result['disconnects_clients']
+
+def test_fallback_restart_is_reported_as_disconnecting(controller):
+    controller.replies['chan_switch'] = 'FAIL\n'
+    result = controller.reconfigure_radio('wlan0', {'channel': 1})
+    assert result['disconnects_clients'] and result['steps'][1]['disconnects']
+
+def test_generated_config_enables_the_control_interface(radio):
+    config = radio.hostapd_config().splitlines()
+    assert 'ctrl_interface=/var/run/hostapd' in config
+    assert 'ctrl_interface_group=0' in config
@@ -0,0 +1,131 @@
+import pytest
+from radios import Radio
+from nft_backend import NftBackend
+from network_controller import NetworkController
+from conntrack import ConnLimits, ConntrackMonitor
+
+MAC = "00:11:22:33:44:55"
+OTHER_MAC = "66:77:88:99:AA:BB"
+
+CONNTRACK_LIST = """\
+tcp      6 431999 ESTABLISHED src=192.168.4.10 dst=93.184.216.34 sport=51000 dport=443 src=93.184.216.34 dst=10.0.0.2 sport=443 dport=51000 [ASSURED] mark=0 use=1
+tcp      6 431999 ESTABLISHED src=192.168.4.10 dst=93.184.216.34 sport=51001 dport=443 src=93.184.216.34 dst=10.0.0.2 sport=443 dport=51001 [ASSURED] mark=0 use=1
+udp      17 29 src=192.168.4.11 dst=8.8.8.8 sport=5353 dport=53 src=8.8.8.8 dst=10.0.0.2 sport=53 dport=5353 mark=0 use=1
+tcp      6 60 TIME_WAIT src=10.0.0.2 dst=1.1.1.1 sport=40000 dport=443 src=1.1.1.1 dst=10.0.0.2 sport=443 dport=40000 mark=0 use=1
+"""
+
+@pytest.fixture
+def limits():
+    return ConnLimits({'default': (200, 20), 'premium': (500, 50), 'throttled': (50, 5)})
+
+def test_limits_from_env(monkeypatch):
+    monkeypatch.setenv('CONN_LIMITS', 'default:200:20, premium:500:50')
+    monkeypatch.setenv('CONN_THROTTLED_LIMIT', '30')
+    limits = ConnLimits.from_env()
+    assert limits.limits == {'default': (200, 20), 'premium': (500, 50), 'throttled': (30, 5)}
+
+    monkeypatch.delenv('CONN_LIMITS')
+    assert not ConnLimits.from_env()
+
+def test_unknown_plans_fall_back_to_default(limits):
+    assert limits.plan_for('premium') == 'premium'
+    assert limits.plan_for('basic') == 'default'
+    assert ConnLimits({'premium': (500, 50)}).plan_for('basic') is None
+
+def test_iptables_rules_cap_connections_and_rate(limits):
+    assert limits.iptables_rules(MAC, 'premium') == [
+        f"-I FORWARD 1 -m mac --mac-source {MAC} -m conntrack --ctstate NEW "
+        "-m connlimit --connlimit-above 500 --connlimit-mask 32 -j DROP",
+        f"-I FORWARD 1 -m mac --mac-source {MAC} -m conntrack --ctstate NEW "
+        "-m hashlimit --hashlimit-above 50/sec --hashlimit-burst 100 --hashlimit-mode srcip "
+        "--hashlimit-name pw_premium -j DROP",
+    ]
+    assert all(rule.startswith('-D FORWARD -m mac') for rule in limits.iptables_rules(MAC, 'premium', '-D'))
+
+def test_access_batch_swaps_limit_rules(limits):
+    lines, updates = NetworkController.build_access_batch(
+        {MAC: 'allowed', OTHER_MAC: 'blocked'}, {OTHER_MAC: 'allowed'}, conn_limits=limits,
+        installed={OTHER_MAC: 'premium'}, wanted={MAC: 'default'})
+
+    assert updates == {MAC: 'allowed', OTHER_MAC: 'blocked'}
+    mangle = lines[lines.index('*mangle') + 1:-1]
+    assert mangle == (limits.iptables_rules(MAC, 'default') +
+                      limits.iptables_rules(OTHER_MAC, 'premium', '-D'))
+
+def test_access_batch_without_limits_has_no_mangle_section():
+    lines, _ = NetworkController.build_access_batch({MAC: 'allowed'}, {})
+    assert '*mangle' not in lines
+
+def test_nft_ruleset_jumps_to_plan_chains(limits):
+    backend = NftBackend([Radio('wlan0', '192.168.4.1', 'PisoWiFi')], 'wlan1', None, conn_limits=limits)
+    ruleset = backend.ruleset({MAC: 'allowed'}, {}, {MAC: 'premium'})
+
+    assert '\tchain limit_premium {' in ruleset
+    assert '\t\tadd @conns_premium { ip saddr ct count over 500 } drop' in ruleset
+    assert f'\t\telements = {{ {MAC} : jump limit_premium }}' in ruleset
+    vmap = ruleset.index('\t\tiifname { "wlan0" } ct state new ether saddr vmap @mac_limits')
+    assert vmap > ruleset.index('\t\tct state established,related accept')
+    assert vmap < ruleset.index('\t\tiifname { "wlan0" } ether saddr vmap @mac_verdict')
+
+def test_nft_access_script_moves_limit_elements(limits):
+    backend = NftBackend([Radio('wlan0', '192.168.4.1', 'PisoWiFi')], 'wlan1', None, conn_limits=limits)
+    lines, _ = backend.access_script({MAC: 'allowed', OTHER_MAC: 'blocked'}, {OTHER_MAC: 'allowed'},
+                                     installed={OTHER_MAC: 'default'}, wanted={MAC: 'premium'})
+
+    assert f'add element inet pisowifi mac_limits {{ {MAC.lower()} : jump limit_premium }}' in lines
+    assert f'delete element inet pisowifi mac_limits {{ {OTHER_MAC.lower()} }}' in lines
+
+def test_count_by_client_only_counts_clients():
+    counts = ConntrackMonitor.count_by_client(CONNTRACK_LIST, lambda ip: ip.startswith('192.168.4.'))
+    assert counts == {'192.168.4.10': 2, '192.168.4.11': 1}
+
+
+class FakeController:
+    def __init__(self):
+        self.radios = [Radio('wlan0', '192.168.4.1', 'PisoWiFi')]
+        self.plans = {}
+
+    def _execute_command(self, command, ignore_errors=False):
+        assert command == "conntrack -L"
+        return CONNTRACK_LIST
+
+    def _read_dhcp_leases(self):
+        return {MAC: {'ip': '192.168.4.10'}, OTHER_MAC: {'ip': '192.168.4.11'}}
+
+    def set_connection_plan(self, mac_address, plan=None):
+        self.plans[mac_address] = plan
+        return True
+
+@pytest.fixture
+def monitor(tmp_path):
+    monitor = ConntrackMonitor(FakeController(), throttle=True)
+    monitor.COUNT_PATH = str(tmp_path / 'count')
+    monitor.MAX_PATH = str(tmp_path / 'max')
+    (tmp_path / 'max').write_text('1000\n')
+    monitor.set_count = lambda count: (tmp_path / 'count').write_text(f'{count}\n')
+    return monitor
+
+def test_low_pressure_skips_the_entry_scan(monitor):
+    monitor.network_controller._execute_command = None
+    monitor.set_count(100)
+    sample = monitor.sample()
+    assert sample['ratio'] == 0.1
+    assert sample['top'] == []
+
+def test_heaviest_client_is_throttled_then_restored(monitor):
+    monitor.set_count(950)
+    sample = monitor.sample()
+    assert sample['top'] == [{'ip': '192.168.4.10', 'connections': 2}, {'ip': '192.168.4.11', 'connections': 1}]
+    assert monitor.network_controller.plans == {MAC: 'throttled'}
+
+    # Still under pressure: the next heaviest client follows
+    monitor.sample()
+    assert monitor.network_controller.plans == {MAC: 'throttled', OTHER_MAC: 'throttled'}
+
+    # Between the ratios nothing changes; below the warning ratio everyone is restored
+    monitor.set_count(850)
+    monitor.sample()
+    assert sorted(monitor.throttled) == [MAC, OTHER_MAC]
+    monitor.set_count(500)
+    assert monitor.sample()['throttled'] == []
+    assert monitor.network_controller.plans == {MAC: None, OTHER_MAC: None}
@@ -0,0 +1,58 @@
+import sqlite3
+import pytest
+from user_manager import UserManager
+from credit_ingest import CreditIngestor, RateTable, PulseSimulator
+
+MAC = "00:11:22:33:44:55"
+
+@pytest.fixture
+def user_manager(tmp_path):
+    return UserManager(db_path=str(tmp_path / 'piso_wifi.db'))
+
+def count_transactions(user_manager):
+    conn = sqlite3.connect(user_manager.db_path)
+    count = conn.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+    conn.close()
+    return count
+
+def test_rate_table_applies_bundles_then_base_rate():
+    rate_table = RateTable({5: 30, 10: 65}, minutes_per_peso=5)
+    assert rate_table.minutes_for(1) == 5
+    assert rate_table.minutes_for(5) == 30
+    assert rate_table.minutes_for(17) == 65 + 30 + 10
+
+def test_burst_is_grouped_into_one_transaction(user_manager):
+    credited = []
+    ingestor = CreditIngestor(user_manager, RateTable({5: 30}), on_credited=lambda *args: credited.append(args))
+
+    for n in range(5):
+        assert ingestor.submit(MAC, 1, f"pulse-{n}") == ('accepted', f"pulse-{n}")
+    assert ingestor.flush() == {MAC: (5, 30)}
+
+    assert user_manager.check_balance(MAC) == 30
+    assert count_transactions(user_manager) == 1
+    assert credited == [(MAC, 5, 30)]
+
+def test_retried_keys_are_not_double_counted(user_manager):
+    ingestor = CreditIngestor(user_manager, RateTable())
+    ingestor.submit(MAC, 1, 'pulse-1')
+    assert ingestor.submit(MAC, 1, 'pulse-1')[0] == 'duplicate'
+    ingestor.flush()
+
+    # Rejected from memory after the flush...
+    assert ingestor.submit(MAC, 1, 'pulse-1')[0] == 'duplicate'
+
+    # ...and by the database for a fresh ingestor (e.g. after a restart)
+    restarted = CreditIngestor(user_manager, RateTable())
+    restarted.submit(MAC, 1, 'pulse-1')
+    assert restarted.flush() == {}
+    assert user_manager.check_balance(MAC) == 1
+
+def test_simulated_pulses_with_retries(user_manager):
+    ingestor = CreditIngestor(user_manager, RateTable(), window=0.01)
+    ingestor.start()
+    sent = PulseSimulator(ingestor.submit, MAC, retry_rate=0.5).run(20, interval=0)
+    ingestor.stop()
+
+    assert sent >= 20
+    assert user_manager.check_balance(MAC) == 20
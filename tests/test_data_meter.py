@@ -0,0 +1,116 @@
+import sqlite3
+import pytest
+from user_manager import UserManager, BYTES_PER_MB
+from admission import AdmissionIndex
+from credit_ingest import RateTable
+from data_meter import DataMeter
+from network_controller import NetworkController
+from stations import Mac
+
+MAC = "00:11:22:33:44:55"
+OTHER_MAC = "66:77:88:99:AA:BB"
+STATION = Mac(MAC)
+
+TC_STATS = """\
+class htb 1:1 root rate 100Mbit ceil 100Mbit burst 15Kb cburst 1600b
+ Sent 9000000 bytes 7000 pkt (dropped 0, overlimits 0 requeues 0)
+ backlog 0b 0p requeues 0
+class htb 1:513 parent 1:1 leaf 513: prio 0 rate 1024Kbit ceil 1024Kbit burst 15Kb cburst 1599b
+ Sent 524288 bytes 400 pkt (dropped 0, overlimits 0 requeues 0)
+ backlog 0b 0p requeues 0
+filter parent ffff: protocol ip pref 1 u32 chain 0
+filter parent ffff: protocol ip pref 1 u32 chain 0 fh 800: ht divisor 1
+filter parent ffff: protocol ip pref 1 u32 chain 0 fh 800::800 order 2048 key ht 800 bkt 0 flowid :1 not_in_hw
+  match c0a8040a/ffffffff at 12
+	action order 1:  police 0x1 rate 512Kbit burst 15Kb mtu 2Kb action drop overhead 0b
+	ref 1 bind 1
+
+	Action statistics:
+	Sent 65536 bytes 120 pkt (dropped 0, overlimits 0 requeues 0)
+	backlog 0b 0p requeues 0
+"""
+
+@pytest.fixture
+def user_manager(tmp_path):
+    return UserManager(db_path=str(tmp_path / 'piso_wifi.db'), billing_mode='data')
+
+class FakeNetworkController:
+    def __init__(self):
+        self.counters = {}
+
+    def read_usage_counters(self):
+        return dict(self.counters)
+
+def test_parse_tc_usage():
+    classes, uploads = NetworkController.parse_tc_usage(TC_STATS)
+    assert classes == {'1': 9000000, '513': 524288}
+    assert uploads == {'192.168.4.10': 65536}
+    # tc prints the decimal class ids it was given unchanged
+    assert str(NetworkController.class_id_for("00:11:22:33:44:55")) == '513'
+
+def test_credits_buy_megabytes(user_manager, monkeypatch):
+    monkeypatch.setenv('BILLING_MODE', 'data')
+    monkeypatch.setenv('DATA_RATE_TABLE', '5:100')
+    monkeypatch.setenv('RATE_PESOS_PER_MB', '0.5')
+    assert RateTable.from_env().minutes_for(7) == 104
+
+    user_manager.add_time(MAC, 5, 100)
+    assert user_manager.check_balance(MAC) == 100 * BYTES_PER_MB
+    assert user_manager.get_users([MAC])[MAC]['time_balance'] == 0
+    assert user_manager.get_active_users()[0]['mac_address'] == MAC
+
+    conn = sqlite3.connect(user_manager.db_path)
+    assert conn.execute('SELECT amount, minutes, data_bytes FROM transactions').fetchall() == [(5, 0, 100 * BYTES_PER_MB)]
+
+def test_admission_uses_the_data_balance(user_manager):
+    admission = AdmissionIndex(user_manager, None)
+    admission.load()
+    user_manager.add_listener(admission.refresh)
+    user_manager.add_time(MAC, 5, 1)
+    assert admission.lookup(MAC)[0] == BYTES_PER_MB
+
+def test_deduct_data_logs_bytes_and_stops_at_zero(user_manager):
+    user_manager.add_time(MAC, 5, 1)
+    assert user_manager.deduct_data({MAC: 1000, OTHER_MAC: 5}) == {MAC: BYTES_PER_MB - 1000}
+    assert user_manager.deduct_data({MAC: 2 * BYTES_PER_MB}) == {MAC: 0}
+
+    conn = sqlite3.connect(user_manager.db_path)
+    rows = conn.execute('SELECT bytes_deducted, balance_before, balance_after, deduction_type FROM time_logs').fetchall()
+    # Only what was left is logged as deducted, like deduct_time
+    assert rows == [(1000, BYTES_PER_MB, BYTES_PER_MB - 1000, 'data'),
+                    (BYTES_PER_MB - 1000, BYTES_PER_MB - 1000, 0, 'data')]
+
+def test_meter_batches_usage_until_flush(user_manager):
+    user_manager.add_time(MAC, 5, 10)
+    controller = FakeNetworkController()
+    meter = DataMeter(user_manager, controller, flush_interval=60)
+    meter.last_flush = 0
+    balances = {STATION: 10 * BYTES_PER_MB}
+
+    controller.counters = {STATION: (1000, 100)}
+    assert meter.meter(balances, now=5) == {}      # baseline
+    controller.counters = {STATION: (5000, 600)}
+    assert meter.meter(balances, now=10) == {}     # pending, not yet written
+    assert meter.pending == {STATION: 4500}
+    controller.counters = {STATION: (6000, 600)}
+    assert meter.meter(balances, now=60) == {STATION: 10 * BYTES_PER_MB - 5500}
+    assert meter.pending == {}
+
+def test_meter_flushes_exhausted_devices_immediately(user_manager):
+    user_manager.add_time(MAC, 5, 1)
+    controller = FakeNetworkController()
+    meter = DataMeter(user_manager, controller, flush_interval=60)
+    meter.last_flush = 0
+
+    controller.counters = {STATION: (0, 0)}
+    meter.meter({STATION: BYTES_PER_MB}, now=1)
+    controller.counters = {STATION: (BYTES_PER_MB, 10)}
+    assert meter.meter({STATION: BYTES_PER_MB}, now=2) == {STATION: 0}
+
+def test_counter_reset_counts_from_zero(user_manager):
+    controller = FakeNetworkController()
+    meter = DataMeter(user_manager, controller)
+    controller.counters = {STATION: (5000, 500)}
+    meter.sample()
+    controller.counters = {STATION: (300, 700)}
+    assert meter.sample() == {STATION: 500}
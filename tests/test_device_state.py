@@ -0,0 +1,55 @@
+import pytest
+from device_state import DeviceState
+from event_bus import EventBus
+
+def device(mac, balance=10):
+    return {'mac_address': mac, 'ip': '192.168.4.2', 'time_balance': balance}
+
+@pytest.fixture
+def device_state():
+    return DeviceState()
+
+def test_replace_bumps_version_only_on_change(device_state):
+    assert device_state.replace([device("AA:AA:AA:AA:AA:01")]) == 1
+    assert device_state.replace([device("AA:AA:AA:AA:AA:01")]) == 1
+    assert device_state.replace([device("AA:AA:AA:AA:AA:01", balance=9)]) == 2
+
+def test_delta_returns_changed_and_removed(device_state):
+    device_state.replace([device("AA:AA:AA:AA:AA:01"), device("AA:AA:AA:AA:AA:02")])
+    since = device_state.get_version()
+
+    device_state.replace([device("AA:AA:AA:AA:AA:01", balance=5)])
+    version, devices, removed, full = device_state.query(since)
+    assert not full
+    assert [d['mac_address'] for d in devices] == ["AA:AA:AA:AA:AA:01"]
+    assert removed == ["AA:AA:AA:AA:AA:02"]
+    assert version == since + 2
+
+def test_update_device_merges_fields(device_state):
+    device_state.replace([device("AA:AA:AA:AA:AA:01")])
+    assert device_state.update_device("AA:AA:AA:AA:AA:01", plan='premium') == True
+    assert device_state.update_device("AA:AA:AA:AA:AA:99", plan='premium') == False
+    _, devices, _, _ = device_state.query()
+    assert devices[0]['plan'] == 'premium'
+
+def test_stale_since_falls_back_to_full(device_state):
+    device_state.MAX_TOMBSTONES = 1
+    device_state.replace([device("AA:AA:AA:AA:AA:01"), device("AA:AA:AA:AA:AA:02")])
+    device_state.replace([])
+    _, devices, removed, full = device_state.query(0)
+    assert full
+    assert devices == [] and removed == []
+
+def test_changes_are_published_to_subscribers():
+    event_bus = EventBus()
+    subscription = event_bus.subscribe()
+    device_state = DeviceState(event_bus)
+
+    device_state.replace([device("AA:AA:AA:AA:AA:01")])
+    device_state.update_device("AA:AA:AA:AA:AA:01", blocked=True)
+    device_state.replace([])
+
+    events = [subscription.get_nowait() for _ in range(3)]
+    assert [e[0] for e in events] == ['connect', 'update', 'disconnect']
+    assert [e[2] for e in events] == [1, 2, 3]
+    assert events[1][1]['blocked'] == True
@@ -0,0 +1,78 @@
+import time
+import logging
+import pytest
+from diagnostics import DiagnosticsCollector, run_commands
+from network_controller import NetworkController
+
+def slow_command(command, ignore_errors=False):
+    time.sleep(0.2)
+    return f"output of {command}"
+
+def test_run_commands_runs_concurrently():
+    started = time.monotonic()
+    results = run_commands(slow_command, {'a': 'cmd a', 'b': 'cmd b', 'c': 'cmd c'})
+    assert results == {'a': 'output of cmd a', 'b': 'output of cmd b', 'c': 'output of cmd c'}
+    assert time.monotonic() - started < 0.5
+
+def test_run_commands_reports_errors():
+    def failing(command, ignore_errors=False):
+        raise RuntimeError("boom")
+    assert "boom" in run_commands(failing, {'a': 'cmd'})['a']
+
+def test_snapshot_is_cached_within_ttl():
+    calls = []
+    def command(cmd, ignore_errors=False):
+        calls.append(cmd)
+        return "ok"
+
+    collector = DiagnosticsCollector(command, {'a': 'cmd'}, ttl=60)
+    first = collector.get_snapshot()
+    second = collector.get_snapshot()
+    assert first['results'] == {'a': 'ok'}
+    assert second['age_seconds'] is not None
+    assert len(calls) == 1
+
+def test_stale_snapshot_is_served_while_refreshing():
+    collector = DiagnosticsCollector(slow_command, {'a': 'cmd'}, ttl=0)
+    collector.get_snapshot()
+
+    started = time.monotonic()
+    snapshot = collector.get_snapshot()
+    assert time.monotonic() - started < 0.1
+    assert snapshot['refreshing'] == True
+    assert snapshot['results'] == {'a': 'output of cmd'}
+
+def test_failure_dumps_read_the_cached_snapshot(caplog):
+    calls = []
+    def command(cmd, ignore_errors=False):
+        calls.append(cmd)
+        return f"output of {cmd}"
+
+    controller = NetworkController.__new__(NetworkController)
+    controller.logger = logging.getLogger('network_controller')
+    controller.diagnostics = DiagnosticsCollector(command, {'hostapd_status': 'systemctl status hostapd'}, ttl=60)
+    controller.debug_dump_interval = 0
+    controller._last_debug_dump = None
+    controller._execute_command = lambda *args, **kwargs: pytest.fail("dump ran a command directly")
+
+    with caplog.at_level(logging.ERROR, logger='network_controller'):
+        controller._dump_debug_info()
+        controller._dump_debug_info()
+
+    dumps = [r.getMessage() for r in caplog.records if 'Debug Information' in r.getMessage()]
+    assert len(dumps) == 2
+    assert 'output of systemctl status hostapd' in dumps[0]
+    assert calls == ['systemctl status hostapd']
+
+def test_failure_dumps_are_rate_limited(caplog):
+    controller = NetworkController.__new__(NetworkController)
+    controller.logger = logging.getLogger('network_controller')
+    controller.diagnostics = DiagnosticsCollector(lambda cmd, ignore_errors=False: "ok", {'a': 'cmd'}, ttl=60)
+    controller.debug_dump_interval = 300
+    controller._last_debug_dump = None
+
+    with caplog.at_level(logging.ERROR, logger='network_controller'):
+        controller._dump_debug_info()
+        controller._dump_debug_info()
+
+    assert len([r for r in caplog.records if 'Debug Information' in r.getMessage()]) == 1
@@ -0,0 +1,91 @@
+import pytest
+from eviction import StationEvictor
+from stations import Mac, Station
+
+MAC = Mac("00:11:22:33:44:55")
+OTHER_MAC = Mac("66:77:88:99:AA:BB")
+
+class FakeNetworkController:
+    def __init__(self):
+        self.blocked = set()
+        self.deauthenticated = []
+        self.refuse = False
+
+    def is_blocked(self, mac_address):
+        return mac_address in self.blocked
+
+    def deauthenticate(self, mac_address, interface=None):
+        if self.refuse:
+            return False
+        self.deauthenticated.append((mac_address, interface))
+        return True
+
+@pytest.fixture
+def controller():
+    return FakeNetworkController()
+
+@pytest.fixture
+def evictor(controller):
+    return StationEvictor(controller, grace=30, idle_timeout=600, backoff=60, max_backoff=300)
+
+def station(mac=MAC, inactive_ms=0):
+    return Station(mac, 'wlan0', inactive_ms=inactive_ms)
+
+def test_blocked_station_is_evicted_after_the_grace_window(evictor, controller):
+    controller.blocked.add(MAC)
+    evictor.blocked(MAC, now=100)
+    evictor.blocked(MAC, now=110)   # blocked again every tick; the window doesn't move
+    assert evictor.evict([station()], now=125) == {}
+    assert evictor.evict([station()], now=130) == {MAC: 'expired'}
+    assert controller.deauthenticated == [(MAC, 'wlan0')]
+    assert evictor.pending == {}
+
+def test_paying_in_the_grace_window_cancels_eviction(evictor, controller):
+    controller.blocked.add(MAC)
+    evictor.blocked(MAC, now=100)
+    controller.blocked.discard(MAC)
+    assert evictor.evict([station()], now=200) == {}
+    assert evictor.pending == {}
+
+def test_idle_stations_are_evicted(evictor, controller):
+    stations = [station(MAC, inactive_ms=599999), station(OTHER_MAC, inactive_ms=600000), Station(Mac(1), 'wlan1')]
+    assert evictor.evict(stations, now=0) == {OTHER_MAC: 'idle'}
+
+def test_repeat_offenders_back_off(evictor, controller):
+    idle = [station(inactive_ms=10 ** 7)]
+    assert evictor.evict(idle, now=0) == {MAC: 'idle'}
+    assert evictor.evict(idle, now=59) == {}
+    assert evictor.evict(idle, now=60) == {MAC: 'idle'}
+    # Second strike: twice the wait
+    assert evictor.holdoff(MAC, 100) == 80
+    assert evictor.evict(idle, now=179) == {}
+    assert evictor.evict(idle, now=180) == {MAC: 'idle'}
+    assert evictor.strikes[MAC] == (3, 180)
+    # Capped at max_backoff, and forgotten after that long without an eviction
+    assert evictor.holdoff(MAC, 180) == 240
+    evictor.evict([], now=480)
+    assert MAC not in evictor.strikes
+
+def test_refused_deauthentication_is_retried(evictor, controller):
+    controller.refuse = True
+    idle = [station(inactive_ms=10 ** 7)]
+    assert evictor.evict(idle, now=0) == {}
+    controller.refuse = False
+    assert evictor.evict(idle, now=5) == {MAC: 'idle'}
+    assert evictor.strikes[MAC] == (1, 5)
+
+def test_controller_deauthenticates_through_hostapd_cli():
+    import logging
+    from network_controller import NetworkController
+    controller = NetworkController.__new__(NetworkController)
+    controller.logger = logging.getLogger('test')
+    controller.station_interface = {MAC: 'wlan2'}
+    controller.ap_interface = 'wlan0'
+    commands = []
+    replies = iter(["OK\n", "FAIL\n", "Failed to connect to hostapd - wpa_ctrl_open: No such file or directory\n"])
+    controller._execute_command = lambda command, ignore_errors=False: commands.append(command) or next(replies)
+
+    assert controller.deauthenticate("00-11-22-33-44-55")
+    assert commands == ["hostapd_cli -i wlan2 deauthenticate 00:11:22:33:44:55"]
+    assert not controller.deauthenticate(MAC)
+    assert not controller.deauthenticate(MAC)
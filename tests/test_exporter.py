@@ -0,0 +1,65 @@
+import csv
+import io
+import gzip
+import json
+import sqlite3
+import pytest
+from user_manager import UserManager, BYTES_PER_MB
+from exporter import Exporter, gzip_stream
+
+MAC = "00:11:22:33:44:55"
+OTHER_MAC = "66:77:88:99:AA:BB"
+
+@pytest.fixture
+def db_path(tmp_path):
+    user_manager = UserManager(db_path=str(tmp_path / 'piso_wifi.db'))
+    for n in range(5):
+        user_manager.add_time(MAC, n + 1, n + 1)
+    user_manager.add_time(OTHER_MAC, 10, 10)
+    return user_manager.db_path
+
+def test_csv_export_spans_chunks(db_path):
+    exporter = Exporter(db_path, chunk_size=2)
+    chunks = list(exporter.stream('transactions'))
+    assert len(chunks) > 1
+
+    rows = list(csv.DictReader(io.StringIO(''.join(chunks))))
+    assert [int(row['id']) for row in rows] == [1, 2, 3, 4, 5, 6]
+    assert rows[-1]['mac_address'] == OTHER_MAC
+
+def test_ndjson_export_filters_by_mac(db_path):
+    exporter = Exporter(db_path, chunk_size=2)
+    lines = ''.join(exporter.stream('transactions', 'ndjson', mac_address=OTHER_MAC.lower())).splitlines()
+    assert [json.loads(line)['amount'] for line in lines] == [10]
+
+def test_date_range_filter(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE transactions SET created_at = '2000-01-01 12:00:00' WHERE id <= 2")
+    conn.commit()
+    conn.close()
+
+    exporter = Exporter(db_path)
+    assert [row[0] for row in exporter.rows('transactions', start='2000-01-01', end='2000-01-01')] == [1, 2]
+    assert [row[0] for row in exporter.rows('transactions', start='2001-01-01')] == [3, 4, 5, 6]
+
+def test_invalid_table_is_rejected(db_path):
+    with pytest.raises(ValueError):
+        Exporter(db_path).build_query('credit_requests')
+
+def test_gzip_stream_round_trips(db_path):
+    text = ''.join(Exporter(db_path).stream('users'))
+    compressed = b''.join(gzip_stream(Exporter(db_path).stream('users')))
+    assert gzip.decompress(compressed).decode() == text
+
+def test_data_mode_exports_carry_bytes(tmp_path):
+    user_manager = UserManager(db_path=str(tmp_path / 'piso_wifi.db'), billing_mode='data')
+    user_manager.add_time(MAC, 5, 1)
+    user_manager.deduct_data({MAC: 1000})
+    exporter = Exporter(user_manager.db_path)
+
+    transaction = json.loads(''.join(exporter.stream('transactions', 'ndjson')))
+    assert transaction['data_bytes'] == BYTES_PER_MB
+    log = json.loads(''.join(exporter.stream('time_logs', 'ndjson')))
+    assert log['bytes_deducted'] == 1000
+    user = json.loads(''.join(exporter.stream('users', 'ndjson')))
+    assert user['data_balance'] == BYTES_PER_MB - 1000
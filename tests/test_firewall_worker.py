@@ -0,0 +1,65 @@
+import threading
+import pytest
+from firewall_worker import FirewallWorker
+
+MAC = "00:11:22:33:44:55"
+OTHER_MAC = "66:77:88:99:AA:BB"
+
+class FakeNetworkController:
+    def __init__(self):
+        self.batches = []
+        self.shaping = []
+        self.lock = threading.Lock()
+
+    def _apply_access(self, changes):
+        with self.lock:
+            self.batches.append(dict(changes))
+        return {mac: True for mac in changes}
+
+    def _apply_shaping(self, mac_address, download_kbps=None, upload_kbps=None, ip_address=None):
+        self.shaping.append((mac_address, download_kbps, upload_kbps, ip_address))
+        return True
+
+@pytest.fixture
+def controller():
+    return FakeNetworkController()
+
+@pytest.fixture
+def worker(controller):
+    worker = FirewallWorker(controller, window=0.2)
+    worker.start()
+    yield worker
+    worker.stop()
+
+def test_latest_state_per_mac_wins(worker, controller):
+    futures = [
+        worker.set_access(MAC, 'blocked'),
+        worker.set_access(OTHER_MAC, 'blocked'),
+        worker.set_access(MAC, 'allowed'),
+    ]
+    assert [future.result(timeout=5) for future in futures] == [True, True, True]
+    # One batch, with only the last request for MAC applied
+    assert controller.batches == [{OTHER_MAC: 'blocked', MAC: 'allowed'}]
+
+def test_shaping_is_coalesced(worker, controller):
+    worker.set_shaping(MAC)
+    future = worker.set_shaping(MAC, 2048, 1024, '192.168.4.10')
+    assert future.result(timeout=5) is True
+    assert controller.shaping == [(MAC, 2048, 1024, '192.168.4.10')]
+
+def test_calls_run_in_order_with_access_changes(worker, controller):
+    order = []
+    worker.set_access(MAC, 'blocked')
+    future = worker.call(lambda: order.append(len(controller.batches)) or 'done')
+    worker.set_access(OTHER_MAC, 'allowed')
+
+    assert future.result(timeout=5) == 'done'
+    worker.set_access(OTHER_MAC, 'allowed').result(timeout=5)
+    # The call saw the first access batch applied and ran before the second
+    assert order == [1]
+    assert controller.batches[:2] == [{MAC: 'blocked'}, {OTHER_MAC: 'allowed'}]
+
+def test_not_started_applies_inline(controller):
+    worker = FirewallWorker(controller)
+    assert worker.set_access(MAC, 'blocked').result(timeout=0) is True
+    assert controller.batches == [{MAC: 'blocked'}]
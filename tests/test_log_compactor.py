@@ -0,0 +1,90 @@
+import time
+import sqlite3
+import pytest
+from user_manager import UserManager
+from log_compactor import LogCompactor
+
+MAC = "00:11:22:33:44:55"
+
+@pytest.fixture(autouse=True)
+def utc(monkeypatch):
+    # Rollup periods are local time; pin the zone so expected labels are stable
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'piso_wifi.db')
+    UserManager(db_path=path)
+    return path
+
+def insert_logs(db_path, rows):
+    conn = sqlite3.connect(db_path)
+    conn.executemany('''
+        INSERT INTO time_logs (user_id, mac_address, minutes_deducted, deducted_at)
+        VALUES (1, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    conn.close()
+
+def query(db_path, sql):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute(sql).fetchall()
+    conn.close()
+    return rows
+
+def test_rollup_aggregates_by_hour_and_day(db_path):
+    insert_logs(db_path, [
+        (MAC, 1, '2024-01-01 10:05:00'),
+        (MAC, 1, '2024-01-01 10:06:00'),
+        (MAC, 2, '2024-01-01 11:00:00'),
+    ])
+    compactor = LogCompactor(db_path, batch_size=2, retention_days=36500, hourly_retention_days=36500)
+    compactor.run_once()
+
+    assert query(db_path, 'SELECT hour, minutes_deducted, deductions FROM time_logs_hourly ORDER BY hour') == [
+        ('2024-01-01 10:00:00', 2, 2),
+        ('2024-01-01 11:00:00', 2, 1),
+    ]
+    assert query(db_path, 'SELECT day, minutes_deducted, deductions FROM time_logs_daily') == [
+        ('2024-01-01', 4, 3),
+    ]
+
+def test_rollup_is_incremental(db_path):
+    compactor = LogCompactor(db_path)
+    insert_logs(db_path, [(MAC, 1, '2024-01-01 10:05:00')])
+    compactor.run_once()
+    insert_logs(db_path, [(MAC, 1, '2024-01-01 10:06:00')])
+    compactor.run_once()
+    compactor.run_once()
+
+    assert query(db_path, 'SELECT minutes_deducted, deductions FROM time_logs_daily') == [(2, 2)]
+
+def test_only_rolled_up_rows_past_retention_are_pruned(db_path):
+    insert_logs(db_path, [(MAC, 1, '2000-01-01 10:00:00')])
+    compactor = LogCompactor(db_path, retention_days=30, hourly_retention_days=36500)
+    compactor.run_once()
+    insert_logs(db_path, [(MAC, 1, '2000-01-01 11:00:00'), (MAC, 1, '2999-01-01 10:00:00')])
+
+    # The second old row is rolled up first, then pruned on the same pass
+    rolled_up, pruned = compactor.run_once()
+    assert (rolled_up, pruned) == (2, 1)
+    assert query(db_path, 'SELECT deducted_at FROM time_logs') == [('2999-01-01 10:00:00',)]
+    assert query(db_path, 'SELECT SUM(deductions) FROM time_logs_daily') == [(3,)]
+
+def test_rollup_keeps_data_bytes_after_pruning(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.executemany('''
+        INSERT INTO time_logs (user_id, mac_address, minutes_deducted, bytes_deducted, deducted_at, deduction_type)
+        VALUES (1, ?, 0, ?, ?, 'data')
+    ''', [(MAC, 1000, '2000-01-01 10:00:00'), (MAC, 500, '2000-01-01 10:30:00')])
+    conn.commit()
+    conn.close()
+    LogCompactor(db_path, retention_days=30, hourly_retention_days=36500).run_once()
+
+    assert query(db_path, 'SELECT COUNT(*) FROM time_logs') == [(0,)]
+    assert query(db_path, 'SELECT hour, bytes_deducted FROM time_logs_hourly') == [('2000-01-01 10:00:00', 1500)]
+    assert query(db_path, 'SELECT day, bytes_deducted, deductions FROM time_logs_daily') == [('2000-01-01', 1500, 2)]
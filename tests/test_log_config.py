@@ -0,0 +1,53 @@
+import logging
+import pytest
+from log_config import RateLimitFilter, RingBufferHandler, StructuredMessage, log_event
+
+def make_record(msg, lineno=1, event_key=None):
+    record = logging.LogRecord('test', logging.INFO, __file__, lineno, msg, None, None)
+    if event_key:
+        record.event_key = event_key
+    return record
+
+def test_rate_limit_suppresses_after_burst():
+    rate_limit = RateLimitFilter(interval=60, burst=2)
+    results = [rate_limit.filter(make_record(f"tick {i}")) for i in range(5)]
+    assert results == [True, True, False, False, False]
+
+    # A different call site has its own budget
+    assert rate_limit.filter(make_record("other", lineno=2)) == True
+
+def test_rate_limit_reports_suppressed_count():
+    rate_limit = RateLimitFilter(interval=0, burst=1)
+    rate_limit.windows['event'] = [0, 1, 3]
+    record = make_record("hello", event_key='event')
+    assert rate_limit.filter(record) == True
+    assert "suppressed 3 similar messages" in record.getMessage()
+
+def test_ring_buffer_keeps_latest_records():
+    ring_buffer = RingBufferHandler(capacity=3)
+    for i in range(5):
+        ring_buffer.handle(make_record(f"line {i}"))
+    lines = ring_buffer.dump()
+    assert len(lines) == 3
+    assert lines[-1].endswith("line 4")
+    assert len(ring_buffer.dump(limit=1)) == 1
+
+def test_structured_message_formats_fields():
+    message = StructuredMessage('deducted', {'mac': 'AA:BB', 'error': 'no such device'})
+    assert str(message) == "deducted mac=AA:BB error='no such device'"
+
+def test_rate_limit_budget_is_per_device():
+    rate_limit = RateLimitFilter(interval=60, burst=1)
+    logger = logging.getLogger('test.rate_limit')
+    logger.setLevel(logging.INFO)
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    handler.addFilter(rate_limit)
+    logger.addHandler(handler)
+    try:
+        for mac in ('AA:AA:AA:AA:AA:AA', 'AA:AA:AA:AA:AA:AA', 'BB:BB:BB:BB:BB:BB'):
+            log_event(logger, logging.INFO, 'credited', mac=mac, minutes=5)
+    finally:
+        logger.removeHandler(handler)
+    assert [record.msg.fields['mac'] for record in records] == ['AA:AA:AA:AA:AA:AA', 'BB:BB:BB:BB:BB:BB']
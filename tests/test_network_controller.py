@@ -24,4 +24,4 @@ def test_get_connected_devices(network_controller):
         mock_run.return_value.returncode = 0
         devices = network_controller.get_connected_devices()
         assert len(devices) == 1
-        assert "00:11:22:33:44:55" in devices[0] 
\ No newline at end of file
+        assert devices[0].mac_address == "00:11:22:33:44:55" 
\ No newline at end of file
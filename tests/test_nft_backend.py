@@ -0,0 +1,100 @@
+import os
+import shutil
+import subprocess
+import pytest
+from radios import Radio
+from nft_backend import NftBackend
+
+MAC = "00:11:22:33:44:55"
+OTHER_MAC = "66:77:88:99:AA:BB"
+GOLDEN = os.path.join(os.path.dirname(__file__), 'data', 'nft_ruleset.nft')
+GOLDEN_FLOWTABLE = os.path.join(os.path.dirname(__file__), 'data', 'nft_ruleset_flowtable.nft')
+
+@pytest.fixture
+def backend():
+    radios = [Radio('wlan0', '192.168.4.1', 'PisoWiFi'), Radio('wlan2', '192.168.5.1', 'PisoWiFi', hw_mode='a')]
+    commands = []
+    backend = NftBackend(radios, 'wlan1', commands.append, captive_portal=True, portal_port=8081)
+    backend.commands = commands
+    return backend
+
+def test_ruleset_matches_golden_file(backend):
+    ruleset = backend.ruleset({MAC: 'allowed', OTHER_MAC: 'blocked'}, {'192.168.4.10': 36})
+    with open(GOLDEN) as f:
+        assert '\n'.join(ruleset) + '\n' == f.read()
+
+def test_flowtable_ruleset_matches_golden_file(backend):
+    backend.flowtable = True
+    ruleset = backend.ruleset({MAC: 'allowed', OTHER_MAC: 'blocked'}, {})
+    with open(GOLDEN_FLOWTABLE) as f:
+        assert '\n'.join(ruleset) + '\n' == f.read()
+
+def test_flowtable_offloads_paid_clients_before_the_established_accept(backend):
+    backend.flowtable = True
+    ruleset = backend.ruleset({MAC: 'allowed'}, {})
+    offload = next(i for i, line in enumerate(ruleset) if 'flow add @fastpath' in line)
+    assert 'ether saddr @paid' in ruleset[offload]
+    assert offload < ruleset.index('\t\tct state established,related accept')
+    assert not any('meta mark set' in line for line in ruleset)
+
+def test_empty_maps_have_no_elements(backend):
+    ruleset = backend.ruleset({}, {})
+    assert not any('elements' in line for line in ruleset)
+
+@pytest.mark.skipif(not shutil.which('nft') or os.geteuid() != 0, reason="needs nft and root")
+@pytest.mark.parametrize('path', [GOLDEN, GOLDEN_FLOWTABLE])
+def test_golden_files_pass_nft_check(path):
+    subprocess.run(['nft', '-c', '-f', path], check=True)
+
+def test_access_changes_are_element_updates(backend):
+    lines, updates = backend.access_script(
+        {MAC: 'allowed', OTHER_MAC: 'blocked', "AA:AA:AA:AA:AA:AA": 'blocked'},
+        {MAC: 'blocked', OTHER_MAC: 'allowed', "AA:AA:AA:AA:AA:AA": 'blocked'})
+
+    assert updates == {MAC: 'allowed', OTHER_MAC: 'blocked'}
+    assert lines == [
+        'delete element inet pisowifi mac_verdict { 00:11:22:33:44:55 }',
+        'add element inet pisowifi mac_verdict { 00:11:22:33:44:55 : accept }',
+        'add element inet pisowifi paid { 00:11:22:33:44:55 }',
+        'delete element inet pisowifi mac_verdict { 66:77:88:99:aa:bb }',
+        'delete element inet pisowifi paid { 66:77:88:99:aa:bb }',
+        'add element inet pisowifi mac_verdict { 66:77:88:99:aa:bb : drop }',
+    ]
+
+def test_mark_moves_with_the_client_address(backend):
+    assert backend.mark_script('192.168.4.11', 36, old_ip='192.168.4.10') == [
+        'delete element inet pisowifi ip_mark { 192.168.4.10 }',
+        'add element inet pisowifi ip_mark { 192.168.4.11 : 36 }',
+    ]
+    assert backend.mark_script(None, None, old_ip='192.168.4.11') == [
+        'delete element inet pisowifi ip_mark { 192.168.4.11 }'
+    ]
+
+def test_apply_runs_one_transaction(backend):
+    backend.apply(['add element inet pisowifi paid { 00:11:22:33:44:55 }'])
+    backend.apply([])
+    assert len(backend.commands) == 1
+    assert backend.commands[0].startswith('nft -f ')
+
+def test_flowtable_shaping_leaves_iptables_alone(backend):
+    import logging
+    from network_controller import NetworkController
+    from stations import Mac
+    backend.flowtable = True
+    controller = NetworkController.__new__(NetworkController)
+    controller.logger = logging.getLogger('test')
+    controller.radios = backend.radios
+    controller.nft = backend
+    controller.flowtable = True
+    controller.use_marks = False
+    controller.shaped = {}
+    controller.shaped_limits = {}
+    commands = []
+    arp = "Address HWtype HWaddress Flags Mask Iface\n192.168.4.10 ether 00:11:22:33:44:55 C wlan0\n"
+    controller._execute_command = lambda command, ignore_errors=False: commands.append(command) or (arp if command == "arp -n" else "")
+
+    assert controller._apply_shaping(Mac(MAC), 2048, 512)
+    assert any(command.startswith("tc class add dev wlan0") for command in commands)
+    assert controller._apply_shaping(Mac(MAC))
+    assert any(command.startswith("tc class del dev wlan0") for command in commands)
+    assert not any(command.startswith('iptables') for command in commands)
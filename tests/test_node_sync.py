@@ -0,0 +1,163 @@
+import sqlite3
+import threading
+import pytest
+from user_manager import UserManager
+from node_sync import NodeSync, make_server
+
+MAC = "00:11:22:33:44:55"
+OTHER_MAC = "66:77:88:99:AA:BB"
+
+class Node:
+    """A unit with its own database, serving /api/sync/pull on a loopback port"""
+
+    def __init__(self, path, name):
+        self.user_manager = UserManager(db_path=str(path / f'{name}.db'), ledger=True)
+        self.sync = NodeSync(self.user_manager.db_path, user_manager=self.user_manager, batch_size=3)
+        self.server = make_server(self.sync)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def balance(self, mac_address):
+        return self.user_manager.check_balance(mac_address)
+
+@pytest.fixture
+def nodes(tmp_path):
+    units = [Node(tmp_path, name) for name in ('a', 'b', 'c')]
+    # A chain: a <-> b <-> c, so a and c only meet through b
+    units[0].sync.peers = [units[1].url]
+    units[1].sync.peers = [units[0].url, units[2].url]
+    units[2].sync.peers = [units[1].url]
+    yield units
+    for unit in units:
+        unit.server.shutdown()
+        unit.server.server_close()
+
+def sync_all(nodes, rounds=2):
+    for _ in range(rounds):
+        for node in nodes:
+            node.sync.sync_once()
+
+def test_roaming_balance_follows_the_device(nodes):
+    a, b, c = nodes
+    a.user_manager.add_time(MAC, 10, 50)
+    sync_all(nodes)
+    assert c.balance(MAC) == 50
+
+    c.user_manager.deduct_time(MAC, 20)
+    sync_all(nodes)
+    assert [node.balance(MAC) for node in nodes] == [30, 30, 30]
+
+def test_concurrent_credits_and_deductions_converge(nodes):
+    a, b, c = nodes
+    a.user_manager.add_time(MAC, 5, 30)
+    sync_all(nodes)
+
+    # While the units can't see each other, the device is credited and metered on several of them
+    a.user_manager.add_time(MAC, 5, 30)
+    b.user_manager.deduct_time(MAC, 10)
+    c.user_manager.add_time(MAC, 2, 12)
+    c.user_manager.add_time(OTHER_MAC, 1, 6)
+    for minute in range(5):
+        a.user_manager.deduct_time(MAC, 1)
+
+    sync_all(nodes)
+    assert [node.balance(MAC) for node in nodes] == [57, 57, 57]
+    assert [node.balance(OTHER_MAC) for node in nodes] == [6, 6, 6]
+    assert a.sync.version_vector() == b.sync.version_vector() == c.sync.version_vector()
+
+def test_repeated_and_overlapping_pulls_are_idempotent(nodes):
+    a, b, c = nodes
+    for minutes in range(1, 8):
+        a.user_manager.add_time(MAC, minutes, minutes)
+    sync_all(nodes, rounds=3)
+    events, more = a.sync.events_since({})
+    assert b.sync.merge(events) == {}
+    assert [node.balance(MAC) for node in nodes] == [28, 28, 28]
+
+def test_merge_skips_events_after_a_gap(tmp_path):
+    user_manager = UserManager(db_path=str(tmp_path / 'piso_wifi.db'))
+    node_sync = NodeSync(user_manager.db_path)
+    applied = node_sync.merge([
+        ['peer', 1, MAC, 'credit', 10, 5, '2026-01-01 00:00:00'],
+        ['peer', 3, MAC, 'credit', 10, 5, '2026-01-01 00:00:00'],
+    ])
+    assert applied == {MAC: 10}
+    assert node_sync.version_vector()['peer'] == 1
+
+def test_existing_balances_become_opening_events(tmp_path):
+    db_path = str(tmp_path / 'piso_wifi.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, mac_address TEXT UNIQUE, time_balance REAL DEFAULT 0)')
+    conn.execute('INSERT INTO users (mac_address, time_balance) VALUES (?, 42)', (MAC,))
+    conn.commit()
+    conn.close()
+
+    node_sync = NodeSync(UserManager(db_path=db_path, ledger=True).db_path)
+    events, more = node_sync.events_since({})
+    assert [(event[2], event[3], event[4]) for event in events] == [(MAC, 'opening', 42)]
+
+def test_sync_refuses_to_start_in_data_mode(tmp_path, caplog):
+    user_manager = UserManager(db_path=str(tmp_path / 'data.db'), billing_mode='data')
+    sync = NodeSync(user_manager.db_path, peers=['http://127.0.0.1:9'], user_manager=user_manager)
+    sync.start()
+    assert sync.thread is None and not sync.running
+    assert 'BILLING_MODE=data' in caplog.text
+
+def ledger_rows(user_manager):
+    conn = sqlite3.connect(user_manager.db_path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM balance_events').fetchone()[0]
+    finally:
+        conn.close()
+
+def test_no_ledger_without_peers_until_sync_is_turned_on(tmp_path):
+    db_path = str(tmp_path / 'piso_wifi.db')
+    user_manager = UserManager(db_path=db_path, ledger=False)
+    user_manager.add_time(MAC, 10, 30)
+    for minute in range(5):
+        user_manager.deduct_time(MAC, 1)
+    assert ledger_rows(user_manager) == 0
+
+    # Turning sync on records what the ledger is missing as one opening event
+    node_sync = NodeSync(UserManager(db_path=db_path, ledger=True).db_path)
+    events, more = node_sync.events_since({})
+    assert [(event[2], event[3], event[4]) for event in events] == [(MAC, 'opening', 25)]
+    UserManager(db_path=db_path, ledger=True)
+    assert len(node_sync.events_since({})[0]) == 1
+
+def test_events_every_peer_holds_are_compacted(nodes, tmp_path):
+    a, b, c = nodes
+    a.user_manager.add_time(MAC, 10, 50)
+    sync_all(nodes)
+    for minute in range(10):
+        b.user_manager.deduct_time(MAC, 1)
+    c.user_manager.add_time(OTHER_MAC, 2, 12)
+    # Acknowledgements travel with the pulls, so it takes a round after the events arrive
+    sync_all(nodes, rounds=3)
+
+    folded = [node.sync.compact() for node in nodes]
+    assert all(folded) and [ledger_rows(node.user_manager) for node in nodes] == [0, 0, 0]
+    assert [node.balance(MAC) for node in nodes] == [40, 40, 40]
+
+    # A unit joining later gets the snapshots, then the events after them
+    a.user_manager.deduct_time(MAC, 5)
+    d = Node(tmp_path, 'd')
+    try:
+        d.sync.peers = [a.url]
+        d.sync.sync_once()
+        assert d.balance(MAC) == 35 and d.balance(OTHER_MAC) == 12
+        vector = d.sync.version_vector()
+        del vector[d.sync.node_id]
+        assert vector == a.sync.version_vector()
+    finally:
+        d.server.shutdown()
+        d.server.server_close()
+
+def test_compaction_waits_for_every_configured_peer(nodes):
+    a, b, c = nodes
+    a.user_manager.add_time(MAC, 10, 50)
+    a.sync.peers.append('http://127.0.0.1:9')   # never answers
+    sync_all(nodes, rounds=3)
+    assert a.sync.compact() == 0
+    assert ledger_rows(a.user_manager) == 1
@@ -0,0 +1,64 @@
+import socket
+import pytest
+from portal_responder import PortalResponder
+from network_controller import NetworkController
+
+MAC = "00:11:22:33:44:55"
+OTHER_MAC = "66:77:88:99:AA:BB"
+
+@pytest.fixture
+def responder():
+    responder = PortalResponder(port=0, portal_port=5000, host='127.0.0.1')
+    responder.start()
+    yield responder
+    responder.stop()
+
+def fetch(port, request):
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(request)
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return b''.join(chunks).decode()
+            chunks.append(chunk)
+
+def test_probes_are_redirected_to_the_portal(responder):
+    for path in ('/generate_204', '/hotspot-detect.html', '/connecttest.txt?x=1'):
+        response = fetch(responder.port, f"GET {path} HTTP/1.1\r\nHost: probe.example\r\n\r\n".encode())
+        assert response.startswith('HTTP/1.1 302 Found\r\n')
+        assert 'Location: http://127.0.0.1:5000/redeem?ip=127.0.0.1\r\n' in response
+    assert responder.stats['probes'] == 3
+
+def test_other_pages_are_redirected_too(responder):
+    response = fetch(responder.port, b"GET /news HTTP/1.1\r\nHost: example.com\r\n\r\n")
+    assert 'Location: http://127.0.0.1:5000/redeem?ip=127.0.0.1\r\n' in response
+    assert responder.stats == {'requests': 1, 'probes': 0, 'errors': 0}
+
+def test_redirect_identifies_the_client_to_the_customer_page():
+    from stations import Mac
+    responder = PortalResponder(port=0, portal_port=5000, host='127.0.0.1',
+                                mac_lookup=lambda ip: Mac(MAC) if ip == '127.0.0.1' else None)
+    responder.start()
+    try:
+        response = fetch(responder.port, b"GET /generate_204 HTTP/1.1\r\nHost: probe.example\r\n\r\n")
+    finally:
+        responder.stop()
+    assert 'Location: http://127.0.0.1:5000/redeem?ip=127.0.0.1&mac_address=00%3A11%3A22%3A33%3A44%3A55\r\n' in response
+    assert 'href="http://127.0.0.1:5000/redeem?ip=127.0.0.1&amp;mac_address=' in response
+
+def test_paid_macs_bypass_the_portal():
+    lines, updates = NetworkController.build_access_batch(
+        {MAC: 'allowed', OTHER_MAC: 'blocked'}, {OTHER_MAC: 'allowed'}, captive_portal=True)
+
+    assert updates == {MAC: 'allowed', OTHER_MAC: 'blocked'}
+    assert lines[lines.index('*nat'):] == [
+        '*nat',
+        f'-I PORTAL 1 -m mac --mac-source {MAC} -j RETURN',
+        f'-D PORTAL -m mac --mac-source {OTHER_MAC} -j RETURN',
+        'COMMIT'
+    ]
+
+def test_no_nat_changes_without_captive_portal():
+    lines, _ = NetworkController.build_access_batch({MAC: 'allowed'}, {})
+    assert '*nat' not in lines
@@ -0,0 +1,92 @@
+import time
+import threading
+import pytest
+from profiling import Profiler, collapse_stack
+
+def busy(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        sum(range(100))
+
+def slow_step(seconds):
+    busy(seconds)
+
+@pytest.fixture
+def profiler():
+    profiler = Profiler(slow_tick=0.1, slow_request=0.1, sample_interval=0.002)
+    profiler.start()
+    yield profiler
+    profiler.stop()
+
+def test_cprofile_covers_the_next_n_sections(profiler):
+    session = profiler.arm('tick', 2)
+    for _ in range(3):
+        with profiler.section('tick', 'check'):
+            slow_step(0.01)
+
+    summary = session.summary()
+    assert summary['done'] and summary['profiled'] == 2
+    assert 'slow_step' in session.pstats_text()
+    assert any(line.startswith('test_profiling.py:busy ') for line in session.collapsed().splitlines())
+
+def test_other_targets_are_not_profiled(profiler):
+    session = profiler.arm('request', 1)
+    with profiler.section('tick', 'check'):
+        pass
+    assert session.summary()['profiled'] == 0
+
+def test_sampling_collects_collapsed_stacks(profiler):
+    session = profiler.arm('request', 1, mode='sample')
+    with profiler.section('request', 'index'):
+        slow_step(0.05)
+
+    assert session.done
+    stacks = session.collapsed().splitlines()
+    assert stacks
+    assert 'test_profiling.py:slow_step;test_profiling.py:busy' in stacks[0]
+
+def test_concurrent_sections_share_one_cprofile(profiler):
+    session = profiler.arm('request', 2)
+    started = threading.Event()
+
+    def other():
+        with profiler.section('request', 'other'):
+            started.set()
+            busy(0.05)
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    started.wait()
+    with profiler.section('request', 'index'):
+        pass
+    thread.join()
+    with profiler.section('request', 'index'):
+        pass
+
+    assert session.summary()['skipped'] == 1
+    assert session.done
+
+def test_watchdog_captures_a_slow_section_once(profiler):
+    with profiler.section('tick', '_check_and_deduct_time'):
+        slow_step(0.3)
+    with profiler.section('request', 'index'):
+        pass
+
+    assert len(profiler.slow) == 1
+    snapshot = profiler.slow[0]
+    assert snapshot['kind'] == 'tick' and snapshot['seconds'] >= 0.1
+    assert 'slow_step' in snapshot['stack']
+
+def test_arm_validates_parameters(profiler):
+    with pytest.raises(ValueError):
+        profiler.arm('tick', 0)
+    with pytest.raises(ValueError):
+        profiler.arm('cron', 1)
+    with pytest.raises(ValueError):
+        profiler.arm('tick', 1, mode='perf')
+
+def test_collapse_stack_runs_outermost_first():
+    def inner():
+        import sys
+        return collapse_stack(sys._getframe())
+    assert inner().endswith('test_profiling.py:test_collapse_stack_runs_outermost_first;test_profiling.py:inner')
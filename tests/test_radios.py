@@ -0,0 +1,67 @@
+import pytest
+from radios import Radio, radios_from_env
+from network_controller import NetworkController
+from stations import Mac
+
+@pytest.fixture
+def clean_env(monkeypatch):
+    for name in ('RADIOS', 'WIFI_INTERFACE', 'AP_IP', 'AP_SSID', 'DHCP_RANGE_START', 'DHCP_RANGE_END',
+                 'MAX_CLIENTS_PER_RADIO', 'RADIO_WLAN2_HW_MODE', 'RADIO_WLAN2_MAX_CLIENTS'):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+def test_single_radio_from_legacy_settings(clean_env):
+    clean_env.setenv('WIFI_INTERFACE', 'wlan0')
+    clean_env.setenv('AP_IP', '192.168.4.1')
+    radios = radios_from_env()
+    assert [(radio.interface, radio.ip) for radio in radios] == [('wlan0', '192.168.4.1')]
+
+def test_radios_get_own_subnets_and_limits(clean_env):
+    clean_env.setenv('RADIOS', 'wlan0,wlan2')
+    clean_env.setenv('RADIO_WLAN2_HW_MODE', 'a')
+    clean_env.setenv('RADIO_WLAN2_MAX_CLIENTS', '50')
+    wlan0, wlan2 = radios_from_env()
+
+    assert wlan2.ip == '192.168.5.1'
+    assert wlan2.channel == 36
+    assert 'max_num_sta=50' in wlan2.hostapd_config()
+    assert 'ieee80211ac=1' in wlan2.hostapd_config()
+    assert 'ieee80211ac=1' not in wlan0.hostapd_config()
+    assert 'dhcp-range=set:wlan2,192.168.5.10,192.168.5.109,255.255.255.0,24h' in wlan2.dnsmasq_scope()
+
+def test_dhcp_pool_stays_inside_subnet():
+    radio = Radio('wlan0', '192.168.4.1', 'PisoWiFi', max_clients=500)
+    assert radio.dhcp_range() == ('192.168.4.10', '192.168.4.254')
+    assert radio.contains('192.168.4.77')
+    assert not radio.contains('192.168.5.77')
+
+def test_parse_station_dump():
+    output = (
+        "Station aa:bb:cc:dd:ee:ff (on wlan0)\n"
+        "\tinactive time:\t10 ms\n"
+        "\tsignal:  \t-45 [-47, -48] dBm\n"
+        "Station 11:22:33:44:55:66 (on wlan0)\n"
+        "\tinactive time:\t20 ms\n"
+    )
+    assert NetworkController.parse_station_dump(output) == [
+        (Mac('AA:BB:CC:DD:EE:FF'), '-45', 10),
+        (Mac('11:22:33:44:55:66'), None, 20)
+    ]
+
+def test_hostapd_config_exposes_the_control_interface():
+    config = Radio('wlan0', '192.168.4.1', 'PisoWiFi').hostapd_config().splitlines()
+    # hostapd_cli (live reconfiguration, station eviction) needs this socket
+    assert 'ctrl_interface=/var/run/hostapd' in config
+    assert 'ctrl_interface_group=0' in config
+
+def test_pool_smaller_than_the_client_limit_is_logged(clean_env, caplog):
+    clean_env.setenv('DHCP_RANGE_START', '192.168.4.2')
+    clean_env.setenv('DHCP_RANGE_END', '192.168.4.20')
+    radio, = radios_from_env()
+    assert radio.pool_size() == 19
+    assert 'has 19 addresses for up to 32 clients' in caplog.text
+
+    caplog.clear()
+    clean_env.setenv('DHCP_RANGE_END', '192.168.4.80')
+    radios_from_env()
+    assert caplog.text == ''
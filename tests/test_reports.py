@@ -0,0 +1,92 @@
+import sqlite3
+import pytest
+from datetime import date
+from user_manager import UserManager, BYTES_PER_MB
+from reports import ReportManager
+
+MAC = "00:11:22:33:44:55"
+OTHER_MAC = "66:77:88:99:AA:BB"
+
+@pytest.fixture
+def user_manager(tmp_path):
+    return UserManager(db_path=str(tmp_path / 'piso_wifi.db'))
+
+@pytest.fixture
+def reports(user_manager):
+    return ReportManager(user_manager.db_path)
+
+def today():
+    conn = sqlite3.connect(':memory:')
+    day = conn.execute("SELECT date('now', 'localtime')").fetchone()[0]
+    conn.close()
+    return day
+
+def test_credits_and_usage_update_summaries(user_manager, reports):
+    user_manager.add_time(MAC, 10, 10)
+    user_manager.add_time(MAC, 5, 5)
+    user_manager.add_time(OTHER_MAC, 20, 20)
+    user_manager.deduct_time(MAC, 3)
+    user_manager.deduct_time(MAC, 2)
+
+    report = reports.summary(today(), today())
+    assert report['revenue'] == [
+        {'day': today(), 'plan': 'default', 'amount': 35, 'minutes': 35, 'data_bytes': 0, 'transactions': 3,
+         'devices': 2}
+    ]
+    assert report['usage'] == [
+        {'day': today(), 'plan': 'default', 'minutes_used': 5, 'bytes_used': 0, 'devices': 1}
+    ]
+    assert report['totals']['paying_devices'] == 2
+    assert report['totals']['active_devices'] == 1
+
+def test_rebuild_matches_incremental_summaries(user_manager, reports):
+    user_manager.add_time(MAC, 10, 10)
+    user_manager.add_time(OTHER_MAC, 20, 20)
+    user_manager.deduct_time(OTHER_MAC, 4)
+    incremental = reports.summary(today(), today())
+
+    conn = sqlite3.connect(user_manager.db_path)
+    conn.execute('DELETE FROM daily_revenue')
+    conn.execute('DELETE FROM daily_usage')
+    conn.commit()
+    conn.close()
+
+    assert reports.rebuild() == (1, 1)
+    assert reports.summary(today(), today()) == incremental
+
+def test_period_range():
+    assert ReportManager.period_range('today', date(2024, 3, 10)) == ('2024-03-10', '2024-03-10')
+    assert ReportManager.period_range('week', date(2024, 3, 10)) == ('2024-03-04', '2024-03-10')
+    with pytest.raises(ValueError):
+        ReportManager.period_range('year')
+
+def test_usage_counts_only_what_was_left_to_deduct(user_manager, reports):
+    user_manager.add_time(MAC, 5, 5)
+    user_manager.deduct_time(MAC, 3)
+    user_manager.deduct_time(MAC, 3)   # only 2 minutes left
+    user_manager.deduct_time(MAC, 3)   # nothing left
+
+    assert reports.summary(today(), today())['usage'] == [
+        {'day': today(), 'plan': 'default', 'minutes_used': 5, 'bytes_used': 0, 'devices': 1}
+    ]
+
+def test_data_credits_and_usage_are_reported_in_bytes(tmp_path):
+    user_manager = UserManager(db_path=str(tmp_path / 'piso_wifi.db'), billing_mode='data')
+    reports = ReportManager(user_manager.db_path)
+    user_manager.add_time(MAC, 5, 2)
+    user_manager.deduct_data({MAC: BYTES_PER_MB})
+    user_manager.deduct_data({MAC: 2 * BYTES_PER_MB})   # only 1 MB left
+
+    report = reports.summary(today(), today())
+    assert report['totals']['bytes_sold'] == 2 * BYTES_PER_MB
+    assert report['totals']['bytes_used'] == 2 * BYTES_PER_MB
+    assert report['totals']['active_devices'] == 1
+
+    conn = sqlite3.connect(user_manager.db_path)
+    conn.execute('DELETE FROM daily_revenue')
+    conn.execute('DELETE FROM daily_usage')
+    conn.commit()
+    conn.close()
+
+    reports.rebuild()
+    assert reports.summary(today(), today()) == report
@@ -0,0 +1,153 @@
+import re
+import logging
+import pytest
+from user_manager import UserManager
+from network_controller import NetworkController
+from stations import Mac
+
+@pytest.fixture
+def user_manager(tmp_path):
+    return UserManager(db_path=str(tmp_path / 'piso_wifi.db'))
+
+def test_get_active_users_skips_empty_balances(user_manager):
+    user_manager.add_time("00:11:22:33:44:55", 10, 10)
+    user_manager.add_time("66:77:88:99:AA:BB", 5, 5)
+    user_manager.deduct_time("66:77:88:99:AA:BB", 5)
+
+    assert user_manager.get_active_users() == [
+        {'mac_address': "00:11:22:33:44:55", 'download_limit': 1024, 'upload_limit': 512}
+    ]
+
+def test_restore_batches_allow_all_and_shape_leased():
+    users = [
+        {'mac_address': "00:11:22:33:44:55", 'download_limit': 2048, 'upload_limit': 1024},
+        {'mac_address': "66:77:88:99:AA:BB", 'download_limit': 2048, 'upload_limit': 1024}
+    ]
+    leases = {Mac("00:11:22:33:44:55"): {'ip': '192.168.4.10'}}
+    iptables_lines, tc_lines = NetworkController.build_restore_batches(users, leases, lambda ip: 'wlan0')
+
+    assert iptables_lines == [
+        '*filter',
+        '-I FORWARD 1 -m mac --mac-source 00:11:22:33:44:55 -j ACCEPT',
+        '-I FORWARD 1 -m mac --mac-source 66:77:88:99:AA:BB -j ACCEPT',
+        'COMMIT'
+    ]
+    class_id = NetworkController.class_id_for("00:11:22:33:44:55")
+    assert len(tc_lines) == 5
+    assert tc_lines[0] == (f"class replace dev wlan0 parent 1:1 classid 1:{class_id} "
+                           f"htb rate 2048kbit ceil 2048kbit burst 15k")
+    assert all('192.168.4.10' in line for line in tc_lines[2:])
+
+def test_restore_batches_classify_by_mark_for_nftables():
+    users = [{'mac_address': "00:11:22:33:44:55", 'download_limit': 2048, 'upload_limit': 1024}]
+    leases = {Mac("00:11:22:33:44:55"): {'ip': '192.168.4.10'}}
+    _, tc_lines = NetworkController.build_restore_batches(users, leases, lambda ip: 'wlan0', use_marks=True)
+
+    class_id = NetworkController.class_id_for("00:11:22:33:44:55")
+    assert tc_lines[2] == f"filter replace dev wlan0 parent 1: protocol ip prio 1 handle {class_id} fw flowid 1:{class_id}"
+    assert not any('match ip dst' in line for line in tc_lines)
+
+class FakeTc:
+    """The u32 filters and htb classes a tc -batch leaves behind, deleted the way the kernel does"""
+
+    FILTER = re.compile(r"filter (add|replace|del) dev (\S+) parent (\S+) protocol ip prio 1(?: handle (\S+))?")
+
+    def __init__(self):
+        self.filters = {}   # (dev, parent, handle) -> line
+        self.classes = {}   # (dev, classid) -> line
+
+    def run(self, lines):
+        for line in lines:
+            line = line[3:] if line.startswith('tc ') else line
+            words = line.split()
+            if words[0] == 'class':
+                key = (words[3], words[words.index('classid') + 1])
+                if words[1] == 'del':
+                    self.classes.pop(key, None)
+                else:
+                    self.classes[key] = line
+                continue
+            match = self.FILTER.match(line)
+            if not match:
+                continue
+            verb, dev, parent, handle = match.groups()
+            if verb != 'del':
+                self.filters[(dev, parent, handle)] = line
+            elif handle:
+                self.filters.pop((dev, parent, handle), None)
+            else:
+                # Without a handle tc drops every filter at that prio
+                for key in [key for key in self.filters if key[:2] == (dev, parent)]:
+                    del self.filters[key]
+        return ''
+
+    def lines_for(self, ip_address):
+        return sorted(line for line in self.filters.values() if f" {ip_address} " in line)
+
+@pytest.fixture
+def shaping_controller():
+    controller = NetworkController.__new__(NetworkController)
+    controller.use_marks = False
+    controller.nft = None
+    controller.shaped = {}
+    controller.shaped_limits = {}
+    controller.station_interface = {}
+    controller.ap_interface = 'wlan0'
+    controller.logger = logging.getLogger('test')
+    controller.tc = FakeTc()
+    controller.arp = {}
+    controller._interface_for_ip = lambda ip: 'wlan2' if ip.startswith('192.168.5.') else 'wlan0'
+    controller._apply_batch = lambda command, lines: controller.tc.run(lines)
+
+    def execute(command, ignore_errors=False):
+        if command == "arp -n":
+            return ''.join(f"{ip} ether {mac} C wlan0\n" for mac, ip in controller.arp.items())
+        return controller.tc.run([command]) if command.startswith('tc ') else ''
+
+    controller._execute_command = execute
+    return controller
+
+def test_reshaping_one_client_leaves_the_others_filters(shaping_controller):
+    mac, other = Mac("00:11:22:33:44:55"), Mac("66:77:88:99:AA:BB")
+    tc = shaping_controller.tc
+    assert shaping_controller._apply_shaping(other, 2048, 1024, '192.168.4.20')
+    assert shaping_controller._apply_shaping(mac, 2048, 1024, '192.168.4.10')
+    others = tc.lines_for('192.168.4.20')
+    assert len(others) == 3
+
+    # Same address and limits: nothing to do
+    assert shaping_controller._apply_shaping(mac, 2048, 1024, '192.168.4.10') and len(tc.filters) == 6
+
+    # New limits: the filters are replaced in place, not duplicated
+    assert shaping_controller._apply_shaping(mac, 4096, 2048, '192.168.4.10')
+    assert len(tc.filters) == 6
+    assert any('police rate 2048kbit' in line for line in tc.lines_for('192.168.4.10'))
+    assert 'htb rate 4096kbit' in tc.classes[('wlan0', f"1:{NetworkController.class_id_for(mac)}")]
+
+    # New address: nothing keeps matching the old one
+    assert shaping_controller._apply_shaping(mac, 4096, 2048, '192.168.4.11')
+    assert tc.lines_for('192.168.4.10') == [] and len(tc.lines_for('192.168.4.11')) == 3
+
+    # Moving to another radio clears the old one
+    assert shaping_controller._apply_shaping(mac, 4096, 2048, '192.168.5.11')
+    assert not any(key[0] == 'wlan0' for key in tc.filters if key[2] in NetworkController.u32_handles(mac))
+    assert ('wlan0', f"1:{NetworkController.class_id_for(mac)}") not in tc.classes
+
+    # Unshaping goes rule by rule and still spares the other client
+    shaping_controller.arp[mac] = '192.168.5.11'
+    assert shaping_controller._apply_shaping(mac)
+    assert tc.lines_for('192.168.5.11') == []
+    assert tc.lines_for('192.168.4.20') == others
+
+def test_failed_init_stops_the_firewall_worker(monkeypatch):
+    import threading
+    monkeypatch.setattr(NetworkController, '_verify_requirements', lambda self: None)
+    monkeypatch.setattr(NetworkController, '_dump_debug_info', lambda self: None)
+
+    def fail(self):
+        raise RuntimeError("hostapd missing")
+
+    monkeypatch.setattr(NetworkController, '_configure_ap', fail)
+    with pytest.raises(RuntimeError):
+        NetworkController()
+    assert not any(thread.name == 'firewall-worker' for thread in threading.enumerate())
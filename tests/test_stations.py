@@ -0,0 +1,65 @@
+import json
+import pytest
+from stations import Mac, Station, to_mac
+from admission import AdmissionIndex
+from nft_backend import NftBackend
+from network_controller import NetworkController
+from radios import Radio
+
+MAC = "AA:BB:CC:DD:EE:FF"
+
+def test_spellings_share_one_key():
+    spellings = ["aa:bb:cc:dd:ee:ff", "AA-BB-CC-DD-EE-FF", "aabb.ccdd.eeff", "aabbccddeeff", 0xAABBCCDDEEFF]
+    assert {Mac(spelling) for spelling in spellings} == {Mac(MAC)}
+    assert Mac(MAC) == 0xAABBCCDDEEFF
+    assert {Mac(MAC): 'allowed'}.get(Mac("aa:bb:cc:dd:ee:ff")) == 'allowed'
+
+def test_formats_as_colon_text():
+    mac = Mac(0x0A0B0C0D0E0F)
+    assert str(mac) == f"{mac}" == "0A:0B:0C:0D:0E:0F"
+    assert str(Mac(0)) == "00:00:00:00:00:00"
+    assert f"--mac-source {Mac(MAC.lower())} -j DROP" == f"--mac-source {MAC} -j DROP"
+    assert repr(Mac(MAC)) == f"Mac('{MAC}')"
+
+@pytest.mark.parametrize('value', ["", "AA:BB:CC:DD:EE", "AA:BB:CC:DD:EE:GG", "0xAABBCCDDEEFF", 1 << 48, -1, None])
+def test_rejects_invalid(value):
+    assert to_mac(value) is None
+    if value is not None:
+        with pytest.raises(ValueError):
+            Mac(value)
+
+def test_station_to_dict_is_the_device_view():
+    station = Station("aa:bb:cc:dd:ee:ff", 'wlan0', '192.168.4.10', 'phone', '-45')
+    assert station.mac_address == MAC
+    assert station.to_dict() == {'mac_address': MAC, 'ip': '192.168.4.10', 'hostname': 'phone',
+                                 'interface': 'wlan0', 'connected': True, 'signal': '-45 dBm'}
+    assert Station(MAC, 'wlan1').to_dict()['ip'] == 'Unknown'
+    json.dumps(station.to_dict())
+    with pytest.raises(AttributeError):
+        station.extra = 1
+
+def test_class_id_is_unchanged_for_text_and_int():
+    assert NetworkController.class_id_for("00:11:22:33:44:55") == 0x4455 % 1000 + 20
+    assert NetworkController.class_id_for(Mac("00:11:22:33:44:55")) == 0x4455 % 1000 + 20
+
+def test_rules_spell_mac_keys_as_text():
+    lines, updates = NetworkController.build_access_batch({Mac(MAC): 'blocked'}, {})
+    assert lines == ['*filter', f"-I FORWARD 1 -m mac --mac-source {MAC} -j DROP", 'COMMIT']
+    assert updates == {Mac(MAC): 'blocked'}
+
+    nft = NftBackend([Radio('wlan0', '192.168.4.1', 'PisoWiFi')], 'wlan1', None)
+    lines, _ = nft.access_script({Mac(MAC): 'allowed'}, {Mac(MAC): 'blocked'})
+    assert f"add element inet pisowifi mac_verdict {{ {MAC.lower()} : accept }}" in lines
+
+class FakeUsers:
+    balance_column = 'time_balance'
+
+    def get_all_users(self):
+        return {'aa:bb:cc:dd:ee:ff': {'time_balance': 30, 'plan': 'premium', 'download_limit': 8096,
+                                      'upload_limit': 8096},
+                'not-a-mac': {'time_balance': 5, 'plan': 'default', 'download_limit': 1, 'upload_limit': 1}}
+
+def test_admission_lookup_ignores_mac_spelling():
+    admission = AdmissionIndex(FakeUsers(), None)
+    assert admission.load() == 1
+    assert admission.lookup(MAC) == admission.lookup(Mac(MAC)) == (30, 'premium', 8096, 8096)
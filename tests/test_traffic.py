@@ -0,0 +1,89 @@
+from network_controller import NetworkController
+from stations import Mac
+from traffic import TrafficAccounting, RingSeries, DeviceTraffic, RESOLUTIONS, sparkline
+
+MAC = Mac("00:11:22:33:44:55")
+OTHER_MAC = Mac("66:77:88:99:AA:BB")
+
+def test_ring_series_wraps_and_clears_skipped_buckets():
+    ring = RingSeries(5, 4)
+    ring.add(0, (100, 10, 1, 1))
+    ring.add(3, (100, 10, 1, 1))
+    ring.add(5, (50, 5, 1, 1))
+    assert ring.points(5, 2) == [[0, 200, 20, 2, 2], [5, 50, 5, 1, 1]]
+
+    # Jumping past the whole ring forgets everything older than four buckets
+    ring.add(40, (7, 0, 1, 0))
+    assert ring.points(40, 4) == [[25, 0, 0, 0, 0], [30, 0, 0, 0, 0], [35, 0, 0, 0, 0], [40, 7, 0, 1, 0]]
+
+    # Late samples for buckets that fell off the ring are dropped
+    ring.add(10, (999, 0, 0, 0))
+    assert sum(ring.data) == 8
+
+def test_memory_per_device_is_fixed():
+    device = DeviceTraffic()
+    storage = device.totals.itemsize * len(device.totals) + sum(
+        ring.data.itemsize * len(ring.data) for ring in device.series.values())
+    assert storage == DeviceTraffic.memory_bytes()
+    assert set(device.series) == set(RESOLUTIONS)
+
+def test_counters_become_deltas():
+    traffic = TrafficAccounting()
+    traffic.record({MAC: (1000, 100, 10, 5)}, timestamp=100)
+    traffic.record({MAC: (3000, 400, 30, 9)}, timestamp=105)
+    traffic.record({MAC: (3500, 400, 35, 9)}, timestamp=110)
+
+    series = traffic.series(MAC, '5s', 3, timestamp=110)
+    assert series['points'] == [[100, 0, 0, 0, 0], [105, 2000, 300, 20, 4], [110, 500, 0, 5, 0]]
+    assert series['totals'] == {'down_bytes': 2500, 'up_bytes': 300, 'down_packets': 25, 'up_packets': 4}
+    assert traffic.series(MAC, '1m', 1, timestamp=110)['points'] == [[60, 2500, 300, 25, 4]]
+
+def test_counter_reset_counts_from_zero():
+    traffic = TrafficAccounting()
+    traffic.record({MAC: (5000, 500, 50, 5)}, timestamp=0)
+    traffic.record({MAC: (800, 80, 8, 1)}, timestamp=5)
+    assert traffic.series(MAC, timestamp=5)['totals']['down_bytes'] == 800
+
+    # A station that left and came back starts from a new baseline
+    traffic.record({}, timestamp=10)
+    traffic.record({MAC: (100, 10, 1, 1)}, timestamp=15)
+    traffic.record({MAC: (300, 10, 3, 1)}, timestamp=20)
+    assert traffic.series(MAC, timestamp=20)['totals']['down_bytes'] == 1000
+
+def test_least_recently_seen_devices_are_evicted():
+    traffic = TrafficAccounting(max_devices=1)
+    for timestamp in (0, 5):
+        traffic.record({MAC: (timestamp, 0, 0, 0)}, timestamp=timestamp)
+    for timestamp in (10, 15):
+        traffic.record({OTHER_MAC: (timestamp, 0, 0, 0)}, timestamp=timestamp)
+    assert traffic.series(MAC) is None
+    assert list(traffic.summary('5s', 2, timestamp=15)) == ['66:77:88:99:AA:BB']
+
+def test_summary_reports_kbps():
+    traffic = TrafficAccounting()
+    traffic.record({MAC: (0, 0, 0, 0)}, timestamp=0)
+    traffic.record({MAC: (625000, 6250, 0, 0)}, timestamp=5)
+    assert traffic.summary('5s', 2, timestamp=5)['00:11:22:33:44:55']['down'] == [0, 1000.0]
+    assert traffic.summary('5s', 2, timestamp=5)['00:11:22:33:44:55']['up'] == [0, 10.0]
+    # Lookups take any spelling of the MAC
+    assert traffic.series('00-11-22-33-44-55', timestamp=5)['totals']['down_bytes'] == 625000
+
+def test_parse_station_counters():
+    output = (
+        "Station aa:bb:cc:dd:ee:ff (on wlan0)\n"
+        "\tinactive time:\t10 ms\n"
+        "\trx bytes:\t1200\n"
+        "\trx packets:\t12\n"
+        "\ttx bytes:\t56000\n"
+        "\ttx packets:\t40\n"
+        "Station 11:22:33:44:55:66 (on wlan0)\n"
+        "\trx bytes:\t7\n"
+    )
+    assert NetworkController.parse_station_counters(output) == {
+        Mac('AA:BB:CC:DD:EE:FF'): (56000, 1200, 40, 12),
+        Mac('11:22:33:44:55:66'): (0, 7, 0, 0)
+    }
+
+def test_sparkline_scales_to_box():
+    assert sparkline([0, 5, 10], width=10, height=10) == "0.0,10.0 5.0,5.0 10.0,0.0"
+    assert sparkline([]) == ''
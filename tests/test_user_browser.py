@@ -0,0 +1,79 @@
+import sqlite3
+import pytest
+from user_manager import UserManager
+from user_browser import UserBrowser
+
+@pytest.fixture
+def user_manager(tmp_path):
+    user_manager = UserManager(db_path=str(tmp_path / 'piso_wifi.db'))
+    for n in range(5):
+        user_manager.add_time(f"AA:BB:CC:DD:EE:0{n}", 10, 10)
+    user_manager.add_time("11:22:33:44:55:66", 10, 10)
+    user_manager.update_hostnames({
+        "AA:BB:CC:DD:EE:00": "alice-phone",
+        "AA:BB:CC:DD:EE:01": "Alice-Laptop",
+        "AA:BB:CC:DD:EE:02": "bob-phone"
+    })
+    return user_manager
+
+@pytest.fixture
+def browser(user_manager):
+    return UserBrowser(user_manager.db_path)
+
+def test_keyset_pages_cover_all_users_once(browser):
+    seen = []
+    cursor = None
+    while True:
+        users, cursor = browser.list_users(after=cursor, limit=2)
+        seen += [user['mac_address'] for user in users]
+        if cursor is None:
+            break
+    assert seen == sorted(seen)
+    assert len(seen) == len(set(seen)) == 6
+
+def test_mac_prefix_search(browser):
+    users, _ = browser.list_users('aa:bb:cc:dd:ee:0')
+    assert len(users) == 5
+    users, _ = browser.list_users('11:22')
+    assert [user['mac_address'] for user in users] == ["11:22:33:44:55:66"]
+
+def test_hostname_prefix_search_is_case_insensitive(browser):
+    users, cursor = browser.list_users('ALICE', limit=1)
+    assert [user['hostname'] for user in users] == ['Alice-Laptop']
+    users, cursor = browser.list_users('ALICE', after=cursor, limit=1)
+    assert [user['hostname'] for user in users] == ['alice-phone']
+    assert cursor is None
+
+def test_history_pages_newest_first(user_manager, browser):
+    mac = "AA:BB:CC:DD:EE:00"
+    for minutes in (1, 2, 3):
+        user_manager.deduct_time(mac, minutes)
+    user = browser.get_user(mac.lower())
+
+    logs, cursor = browser.get_time_logs(mac, limit=2)
+    assert [log['minutes_deducted'] for log in logs] == [3, 2]
+    logs, cursor = browser.get_time_logs(mac, before=cursor, limit=2)
+    assert [log['minutes_deducted'] for log in logs] == [1]
+    assert cursor is None
+
+    transactions, _ = browser.get_transactions(user['id'])
+    assert [t['amount'] for t in transactions] == [10]
+
+def test_hostname_pages_seek_past_the_cursor(user_manager, browser):
+    seen = []
+    cursor = None
+    while True:
+        users, cursor = browser.list_users(field='hostname', after=cursor, limit=1)
+        seen += [user['hostname'] for user in users]
+        if cursor is None:
+            break
+    assert seen == ['Alice-Laptop', 'alice-phone', 'bob-phone']
+    assert len(seen) == 3
+
+    sql, params = UserBrowser.list_users_sql('', 'hostname', 'alice-phone|AA:BB:CC:DD:EE:00', 50)
+    conn = sqlite3.connect(user_manager.db_path)
+    try:
+        plan = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+    finally:
+        conn.close()
+    assert [row[3] for row in plan] == ['SEARCH users USING INDEX idx_users_hostname (hostname>?)']
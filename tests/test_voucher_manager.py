@@ -0,0 +1,31 @@
+import pytest
+from user_manager import UserManager
+from voucher_manager import VoucherManager
+
+MAC = "00:11:22:33:44:55"
+
+@pytest.fixture
+def voucher_manager(tmp_path):
+    return VoucherManager(UserManager(db_path=str(tmp_path / 'piso_wifi.db')))
+
+def test_generate_unique_codes(voucher_manager):
+    batch_id, codes = voucher_manager.generate(500, minutes=30, amount=5)
+    assert batch_id
+    assert len(codes) == len(set(codes)) == 500
+
+def test_redeem_credits_device_once(voucher_manager):
+    _, codes = voucher_manager.generate(2, minutes=30, amount=5)
+
+    assert voucher_manager.redeem(codes[0], MAC) == (5, 30)
+    assert voucher_manager.user_manager.check_balance(MAC) == 30
+
+    # Codes can't be redeemed twice, even by another device
+    assert voucher_manager.redeem(codes[0], "11:22:33:44:55:66") is None
+
+    # Codes are matched regardless of case and dashes
+    assert voucher_manager.redeem(codes[1].lower().replace('-', ''), MAC) == (5, 30)
+    assert voucher_manager.user_manager.check_balance(MAC) == 60
+
+def test_unknown_code_is_rejected(voucher_manager):
+    assert voucher_manager.redeem("AAAAA-BBBBB", MAC) is None
+    assert voucher_manager.user_manager.check_balance(MAC) == 0
@@ -2,19 +2,33 @@ import threading
 import time
 from datetime import datetime
 import logging
+from log_config import log_event
 from user_manager import UserManager
 from network_controller import NetworkController
+from device_state import DeviceState
+from profiling import Profiler
 
 class TimeManager:
-    def __init__(self, check_interval=5):
-        self.user_manager = UserManager()
-        self.network_controller = NetworkController()
+    def __init__(self, check_interval=5, user_manager=None, network_controller=None, event_bus=None,
+                 data_meter=None, profiler=None, evictor=None):
+        # Share the app's instances when given so state is not duplicated
+        self.user_manager = user_manager or UserManager()
+        self.network_controller = network_controller or NetworkController()
+        self.device_state = DeviceState(event_bus)
         self.check_interval = check_interval
         self.running = False
         self.thread = None
         self.logger = logging.getLogger(__name__)
-        self.last_deduction = {}
+        self.last_deduction = {}   # Mac -> time of the last deduction
         self.last_check = 0
+        # Hostnames already written to the users table, so they're saved only on change
+        self.saved_hostnames = {}  # Mac -> hostname
+        # Bills by bytes instead of minutes when set (BILLING_MODE=data)
+        self.data_meter = data_meter
+        # Each tick is a profiler section (on-demand profiles, slow tick watchdog)
+        self.profiler = profiler or Profiler()
+        # Deauthenticates blocked and idle stations when set (STATION_EVICTION=1)
+        self.evictor = evictor
         
     def start(self):
         self.running = True
@@ -31,10 +45,11 @@ class TimeManager:
         """Main loop for time management"""
         while self.running:
             try:
-                self._check_and_deduct_time()
+                with self.profiler.section('tick', '_check_and_deduct_time'):
+                    self._check_and_deduct_time()
                 time.sleep(self.check_interval)
             except Exception as e:
-                self.logger.error(f"Error in time manager run loop: {e}")
+                log_event(self.logger, logging.ERROR, 'time_manager_loop_failed', error=e)
                 time.sleep(1)  # Prevent tight loop on error
 
     def _check_and_deduct_time(self):
@@ -47,41 +62,117 @@ class TimeManager:
                 return
             self.last_check = current_time
             
-            connected_devices = self.network_controller.get_connected_devices()
+            stations = self.network_controller.get_connected_devices()
+            # Users are keyed by the MAC text stored in the database
+            users = self.user_manager.get_users(station.mac_address for station in stations)
+            snapshot = []
+            # Data billing: devices with data left, metered after the loop
+            metered = {}
             
-            for device in connected_devices:
-                mac = device['mac_address']
+            for station in stations:
+                mac = station.mac
+                entry = self._device_entry(station, users.get(station.mac_address))
+                snapshot.append(entry)
                 try:
-                    current_balance = self.user_manager.check_balance(mac)
-                    self.logger.debug(f"Current balance for {mac}: {current_balance}")
+                    current_balance = entry[self.user_manager.balance_column]
+                    log_event(self.logger, logging.DEBUG, 'balance', mac=mac, balance=current_balance)
 
                     if current_balance <= 0:
-                        self.logger.info(f"Balance zero for {mac}, blocking...")
-                        self.network_controller.block_mac(mac)
+                        log_event(self.logger, logging.INFO, 'balance_zero', mac=mac)
+                        self._block(mac)
+                        entry['blocked'] = True
                         if mac in self.last_deduction:
                             del self.last_deduction[mac]
                     else:
+                        if entry['blocked']:
+                            # Balance came back (credit, voucher) while the device stayed connected
+                            log_event(self.logger, logging.INFO, 'balance_restored', mac=mac)
+                            if self.network_controller.unblock_mac(mac):
+                                entry['blocked'] = False
+
+                        if self.data_meter:
+                            metered[mac] = entry
+                            continue
+
                         last_time = self.last_deduction.get(mac, current_time - 60)
                         elapsed_minutes = (current_time - last_time) / 60.0
 
                         if elapsed_minutes >= 1.0:
                             minutes_to_deduct = int(elapsed_minutes)
-                            if self.user_manager.deduct_time(mac, minutes_to_deduct):
+                            if self.user_manager.deduct_time(station.mac_address, minutes_to_deduct):
                                 self.last_deduction[mac] = current_time
-                                new_balance = self.user_manager.check_balance(mac)
-                                self.logger.info(f"Deducted {minutes_to_deduct} minute(s) from {mac}, remaining balance: {new_balance}")
+                                new_balance = self.user_manager.check_balance(station.mac_address)
+                                entry['time_balance'] = new_balance
+                                log_event(self.logger, logging.DEBUG, 'deducted', mac=mac,
+                                          minutes=minutes_to_deduct, balance=new_balance)
                                 
                                 if new_balance <= 0:
                                     self.logger.info(f"Balance depleted for {mac}, blocking...")
-                                    self.network_controller.block_mac(mac)
+                                    self._block(mac)
+                                    entry['blocked'] = True
 
                 except Exception as e:
-                    self.logger.error(f"Error checking balance for {mac}: {e}")
+                    log_event(self.logger, logging.ERROR, 'balance_check_failed', mac=mac, error=e)
+
+            if self.data_meter:
+                self._meter_data(metered)
+            if self.evictor:
+                self.evictor.evict(stations)
+            
+            self.device_state.replace(snapshot)
+            self._save_hostnames(stations, users)
 
             # Clean up disconnected devices
-            disconnected = set(self.last_deduction.keys()) - {d['mac_address'] for d in connected_devices}
+            disconnected = set(self.last_deduction) - {station.mac for station in stations}
             for mac in disconnected:
                 del self.last_deduction[mac]
 
         except Exception as e:
-            self.logger.error(f"Error in check_and_deduct_time: {e}")
\ No newline at end of file
+            log_event(self.logger, logging.ERROR, 'check_and_deduct_failed', error=e)
+
+    def _block(self, mac):
+        """Cut off a device that ran out of balance (and start its eviction grace window)"""
+        self.network_controller.block_mac(mac)
+        if self.evictor:
+            self.evictor.blocked(mac)
+
+    def _meter_data(self, metered):
+        """Deduct the bytes connected devices used and block those that ran out"""
+        balances = self.data_meter.meter({mac: entry['data_balance'] for mac, entry in metered.items()})
+        for mac, new_balance in balances.items():
+            entry = metered.get(mac)
+            if entry is None:
+                continue
+            entry['data_balance'] = new_balance
+            if new_balance <= 0:
+                log_event(self.logger, logging.INFO, 'data_exhausted', mac=mac)
+                self._block(mac)
+                entry['blocked'] = True
+
+    def _save_hostnames(self, stations, users):
+        """Persist new or changed hostnames of known users for the admin browser"""
+        changed = {}
+        for station in stations:
+            hostname = station.hostname
+            if hostname and hostname != 'Unknown' and self.saved_hostnames.get(station.mac) != hostname \
+                    and station.mac_address in users:
+                changed[station.mac] = hostname
+        if changed and self.user_manager.update_hostnames({str(mac): hostname for mac, hostname in changed.items()}):
+            self.saved_hostnames.update(changed)
+
+    def _device_entry(self, station, user):
+        """Build the API/dashboard view of a device from its station and user info"""
+        entry = station.to_dict()
+        entry['blocked'] = self.network_controller.is_blocked(station.mac)
+        if user:
+            entry.update(user)
+        else:
+            entry.update({
+                'time_balance': 0,
+                'data_balance': 0,
+                'plan': 'default',
+                'download_limit': self.network_controller.DEFAULT_DOWNLOAD_SPEED,
+                'upload_limit': self.network_controller.DEFAULT_UPLOAD_SPEED,
+                'upgrade_requested': False
+            })
+        return entry
\ No newline at end of file
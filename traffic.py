@@ -0,0 +1,176 @@
+import os
+import time
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from log_config import log_event
+from stations import to_mac
+
+# Per-bucket counters, from the client's point of view (the AP's tx is the client's download)
+FIELDS = ('down_bytes', 'up_bytes', 'down_packets', 'up_packets')
+
+# name -> (seconds per bucket, buckets kept): 15 minutes, 6 hours and 7 days
+RESOLUTIONS = OrderedDict([
+    ('5s', (5, 180)),
+    ('1m', (60, 360)),
+    ('1h', (3600, 168)),
+])
+
+class RingSeries:
+    """Fixed-size time series of FIELDS per bucket, stored in one flat array.
+
+    Bucket n (timestamp // step) lives in slot n % size. `head` is the newest
+    bucket written; moving it forward zeroes the slots being reused, so reads
+    never see data older than `size` buckets.
+    """
+
+    __slots__ = ('step', 'size', 'head', 'data')
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.head = None
+        self.data = array('Q', bytes(8 * size * len(FIELDS)))
+
+    def add(self, timestamp, values):
+        bucket = int(timestamp // self.step)
+        if self.head is None:
+            self.head = bucket
+        elif bucket > self.head:
+            for stale in range(max(self.head + 1, bucket - self.size + 1), bucket + 1):
+                offset = (stale % self.size) * len(FIELDS)
+                for i in range(len(FIELDS)):
+                    self.data[offset + i] = 0
+            self.head = bucket
+        elif bucket <= self.head - self.size:
+            return
+        offset = (bucket % self.size) * len(FIELDS)
+        for i, value in enumerate(values):
+            self.data[offset + i] += value
+
+    def points(self, timestamp, count):
+        """[bucket start, *FIELDS] for the `count` buckets up to `timestamp`, oldest first"""
+        end = int(timestamp // self.step)
+        result = []
+        for bucket in range(end - min(count, self.size) + 1, end + 1):
+            if self.head is None or bucket > self.head or bucket <= self.head - self.size:
+                values = [0] * len(FIELDS)
+            else:
+                offset = (bucket % self.size) * len(FIELDS)
+                values = list(self.data[offset:offset + len(FIELDS)])
+            result.append([bucket * self.step] + values)
+        return result
+
+
+class DeviceTraffic:
+    """A device's series at every resolution plus running totals"""
+
+    __slots__ = ('series', 'totals', 'last_seen')
+
+    def __init__(self):
+        self.series = {name: RingSeries(step, size) for name, (step, size) in RESOLUTIONS.items()}
+        self.totals = array('Q', bytes(8 * len(FIELDS)))
+        self.last_seen = 0
+
+    def add(self, timestamp, values):
+        for ring in self.series.values():
+            ring.add(timestamp, values)
+        for i, value in enumerate(values):
+            self.totals[i] += value
+        self.last_seen = timestamp
+
+    @staticmethod
+    def memory_bytes():
+        """Bytes of counter storage per device, the same for every device"""
+        slots = sum(size for step, size in RESOLUTIONS.values()) + 1
+        return slots * len(FIELDS) * 8
+
+
+class TrafficAccounting:
+    """Per-device byte and packet counts, kept as ring-buffer time series.
+
+    Fed from the station dump the controller already runs every tick (see
+    NetworkController.traffic_handler): the cumulative per-station counters
+    are turned into deltas and added to 5 second, 1 minute and 1 hour series.
+    Memory is DeviceTraffic.memory_bytes() per device, for at most
+    `max_devices` devices; the least recently seen are dropped first.
+    """
+
+    def __init__(self, max_devices=512):
+        self.max_devices = max_devices
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.devices = OrderedDict()  # Mac -> DeviceTraffic, least recently seen first
+        self.counters = {}            # Mac -> last cumulative counters from the dump
+
+    @classmethod
+    def from_env(cls):
+        return cls(max_devices=int(os.getenv('TRAFFIC_MAX_DEVICES', '512')))
+
+    def record(self, counters, timestamp=None):
+        """Add one sample of cumulative counters, {Mac: (down_bytes, up_bytes, down_packets, up_packets)}"""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            for mac_address, values in counters.items():
+                previous = self.counters.get(mac_address)
+                self.counters[mac_address] = values
+                if previous is None:
+                    # Counters run since association; the first sample is only a baseline
+                    continue
+                if any(value < last for value, last in zip(values, previous)):
+                    # Counters restarted (reassociation or driver wrap)
+                    deltas = values
+                else:
+                    deltas = [value - last for value, last in zip(values, previous)]
+                device = self.devices.get(mac_address)
+                if device is None:
+                    device = self.devices[mac_address] = DeviceTraffic()
+                    if len(self.devices) > self.max_devices:
+                        evicted, _ = self.devices.popitem(last=False)
+                        log_event(self.logger, logging.DEBUG, 'traffic_evicted', mac=evicted)
+                device.add(timestamp, deltas)
+                self.devices.move_to_end(mac_address)
+
+            # Stations that left start from a fresh baseline if they come back
+            for mac_address in set(self.counters) - set(counters):
+                del self.counters[mac_address]
+
+    def series(self, mac_address, resolution='5s', points=60, timestamp=None):
+        """{'step', 'fields', 'points', 'totals'} for one device, or None if it has no traffic recorded"""
+        step, size = RESOLUTIONS[resolution]
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            device = self.devices.get(to_mac(mac_address))
+            if device is None:
+                return None
+            return {
+                'step': step,
+                'fields': ['time'] + list(FIELDS),
+                'points': device.series[resolution].points(timestamp, points),
+                'totals': dict(zip(FIELDS, device.totals)),
+            }
+
+    def summary(self, resolution='5s', points=60, timestamp=None):
+        """{mac: {'down', 'up', 'totals'}}: download/upload kbps per bucket for every device"""
+        step, size = RESOLUTIONS[resolution]
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            result = {}
+            for mac_address, device in self.devices.items():
+                buckets = device.series[resolution].points(timestamp, points)
+                result[str(mac_address)] = {
+                    'down': [round(point[1] * 8 / 1000 / step, 1) for point in buckets],
+                    'up': [round(point[2] * 8 / 1000 / step, 1) for point in buckets],
+                    'totals': dict(zip(FIELDS, device.totals)),
+                }
+            return result
+
+
+def sparkline(values, width=120, height=24):
+    """SVG polyline points for `values` scaled into a width x height box"""
+    if not values:
+        return ''
+    peak = max(values) or 1
+    step = width / max(len(values) - 1, 1)
+    return ' '.join(f"{i * step:.1f},{height - value / peak * height:.1f}" for i, value in enumerate(values))
@@ -0,0 +1,170 @@
+import re
+import sqlite3
+import logging
+
+MAC_PREFIX = re.compile(r'^[0-9A-Fa-f]{1,2}(:[0-9A-Fa-f]{0,2})*$')
+
+def _prefix_upper_bound(prefix):
+    """Smallest string greater than every string starting with `prefix`"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class UserBrowser:
+    """Read-only admin views over users and their history.
+
+    Every list is keyset paginated (the page cursor is the sort key of the last
+    row shown) and every filter is an index range, so a page costs the same at
+    row 100 as at row 100,000.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.logger = logging.getLogger(__name__)
+
+    def _connect(self):
+        return sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, timeout=30)
+
+    @staticmethod
+    def search_field(query):
+        """Guess whether a search is a MAC prefix or a hostname prefix"""
+        return 'mac' if MAC_PREFIX.match(query) else 'hostname'
+
+    def list_users(self, query=None, field=None, after=None, limit=50):
+        """One page of users; returns (users, next_cursor or None).
+
+        With a hostname search, pages are ordered by hostname and the cursor is
+        "hostname|mac"; otherwise they're ordered by MAC and the cursor is the MAC.
+        """
+        query = (query or '').strip()
+        field = field or (self.search_field(query) if query else 'mac')
+        sql, params = self.list_users_sql(query, field, after, limit)
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute(sql, params)
+            rows = c.fetchall()
+        finally:
+            conn.close()
+
+        users = [
+            {'mac_address': r[0], 'hostname': r[1], 'time_balance': r[2], 'status': r[3],
+             'plan': r[4], 'last_deduction': r[5], 'created_at': r[6]}
+            for r in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = users[-1]
+            next_cursor = f"{last['hostname']}|{last['mac_address']}" if field == 'hostname' else last['mac_address']
+        return users, next_cursor
+
+    @staticmethod
+    def list_users_sql(query, field, after, limit):
+        """(sql, params) fetching one page for list_users, plus one row to tell whether there's more"""
+        conditions = []
+        params = []
+
+        if field == 'hostname':
+            order = 'hostname COLLATE NOCASE, mac_address'
+            if query:
+                # Range form of a case-insensitive LIKE 'query%', served by idx_users_hostname
+                # (NOCASE folds to lower case, so the bound is computed on the lowered prefix)
+                prefix = query.lower()
+                conditions.append('hostname >= ? COLLATE NOCASE AND hostname < ? COLLATE NOCASE')
+                params += [prefix, _prefix_upper_bound(prefix)]
+            else:
+                conditions.append('hostname IS NOT NULL')
+            if after:
+                # Spelled out rather than as a row value, which SQLite only scans for; the
+                # leading >= gives the planner a range to seek to
+                hostname, _, mac = after.rpartition('|')
+                conditions.append('hostname >= ? COLLATE NOCASE AND '
+                                  '(hostname > ? COLLATE NOCASE OR (hostname = ? COLLATE NOCASE AND mac_address > ?))')
+                params += [hostname, hostname, hostname, mac]
+        else:
+            order = 'mac_address'
+            if query:
+                prefix = query.upper()
+                conditions.append('mac_address >= ? AND mac_address < ?')
+                params += [prefix, _prefix_upper_bound(prefix)]
+            if after:
+                conditions.append('mac_address > ?')
+                params.append(after)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return f'''
+            SELECT mac_address, hostname, time_balance, status, plan, last_deduction, created_at
+            FROM users {where} ORDER BY {order} LIMIT ?
+        ''', params + [limit + 1]
+
+    def get_user(self, mac_address):
+        """A user's record, or None"""
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute('''
+                SELECT id, mac_address, hostname, time_balance, status, plan, download_limit,
+                       upload_limit, upgrade_requested, created_at, last_deduction
+                FROM users WHERE mac_address = ?
+            ''', (mac_address.upper(),))
+            row = c.fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+        keys = ['id', 'mac_address', 'hostname', 'time_balance', 'status', 'plan', 'download_limit',
+                'upload_limit', 'upgrade_requested', 'created_at', 'last_deduction']
+        return dict(zip(keys, row))
+
+    def _history_page(self, sql, key, params, before, limit, keys):
+        """Newest-first page of (timestamp, id)-ordered history; cursor is "timestamp|id" """
+        conditions = ''
+        if before:
+            timestamp, _, row_id = before.rpartition('|')
+            conditions = f'AND ({key}, id) < (?, ?)'
+            params = params + [timestamp, int(row_id)]
+
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute(sql.format(conditions=conditions), params + [limit + 1])
+            rows = [dict(zip(keys, row)) for row in c.fetchall()]
+        finally:
+            conn.close()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1][key]}|{rows[-1]['id']}"
+        return rows, next_cursor
+
+    def get_transactions(self, user_id, before=None, limit=50):
+        """Newest-first transactions of a user via idx_transactions_user_created"""
+        return self._history_page('''
+            SELECT id, amount, minutes, created_at FROM transactions
+            WHERE user_id = ? {conditions}
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', 'created_at', [user_id], before, limit, ['id', 'amount', 'minutes', 'created_at'])
+
+    def get_time_logs(self, mac_address, before=None, limit=50):
+        """Newest-first deductions of a device via idx_time_logs_mac_deducted"""
+        return self._history_page('''
+            SELECT id, minutes_deducted, balance_before, balance_after, deducted_at, deduction_type
+            FROM time_logs
+            WHERE mac_address = ? {conditions}
+            ORDER BY deducted_at DESC, id DESC LIMIT ?
+        ''', 'deducted_at', [mac_address.upper()], before, limit,
+            ['id', 'minutes_deducted', 'balance_before', 'balance_after', 'deducted_at', 'deduction_type'])
+
+    def get_plan_changes(self, mac_address, limit=20):
+        """Most recent plan changes of a device"""
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute('''
+                SELECT old_plan, new_plan, changed_at FROM plan_changes
+                WHERE mac_address = ? ORDER BY id DESC LIMIT ?
+            ''', (mac_address.upper(), limit))
+            return [{'old_plan': r[0], 'new_plan': r[1], 'changed_at': r[2]} for r in c.fetchall()]
+        finally:
+            conn.close()
@@ -2,14 +2,30 @@ import sqlite3
 import os
 from datetime import datetime
 import logging
+from reports import init_report_tables, record_credit, record_usage
+from node_sync import init_sync_tables, record_balance_event
+
+BYTES_PER_MB = 1024 * 1024
 
 class UserManager:
-    def __init__(self):
-        self.db_path = 'config/piso_wifi.db'
+    def __init__(self, db_path='config/piso_wifi.db', billing_mode=None, ledger=None):
+        self.db_path = db_path
         self.logger = logging.getLogger(__name__)
         
+        # 'time' sells and meters minutes; 'data' sells megabytes and meters bytes (data_balance)
+        self.billing_mode = billing_mode or os.getenv('BILLING_MODE', 'time')
+        self.balance_column = 'data_balance' if self.billing_mode == 'data' else 'time_balance'
+        
+        # Balance events for node sync are only recorded when there are peers to replicate them to
+        if ledger is None:
+            ledger = self.billing_mode == 'time' and bool(os.getenv('SYNC_PEERS', '').strip())
+        self.ledger = ledger
+        
+        # Called with a list of MACs after each committed change to their rows
+        self.listeners = []
+        
         # Ensure config directory exists
-        os.makedirs('config', exist_ok=True)
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
         
         # Initialize database on startup
         self._init_db()
@@ -19,6 +35,9 @@ class UserManager:
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
         try:
+            # WAL lets readers (reports, exports, compaction) run alongside metering writes
+            c.execute('PRAGMA journal_mode=WAL')
+            
             # Users table with bandwidth fields and plan
             c.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -62,6 +81,56 @@ class UserManager:
                 )
             ''')
             
+            # History lookups by device and by user
+            c.execute('CREATE INDEX IF NOT EXISTS idx_time_logs_mac_deducted ON time_logs (mac_address, deducted_at)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_at)')
+            
+            # Idempotency keys of ingested credits (coin acceptors, payment bridges)
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS credit_requests (
+                    idempotency_key TEXT PRIMARY KEY,
+                    mac_address TEXT,
+                    amount REAL,
+                    transaction_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Columns added after the first release
+            c.execute('PRAGMA table_info(users)')
+            columns = {row[1] for row in c.fetchall()}
+            if 'hostname' not in columns:
+                c.execute('ALTER TABLE users ADD COLUMN hostname TEXT')
+            if 'data_balance' not in columns:
+                c.execute('ALTER TABLE users ADD COLUMN data_balance INTEGER DEFAULT 0')
+            c.execute('PRAGMA table_info(transactions)')
+            if 'data_bytes' not in {row[1] for row in c.fetchall()}:
+                c.execute('ALTER TABLE transactions ADD COLUMN data_bytes INTEGER DEFAULT 0')
+            c.execute('PRAGMA table_info(time_logs)')
+            if 'bytes_deducted' not in {row[1] for row in c.fetchall()}:
+                c.execute('ALTER TABLE time_logs ADD COLUMN bytes_deducted INTEGER DEFAULT 0')
+            
+            # Prefix search in the admin user browser (MACs are stored upper-case)
+            c.execute('CREATE INDEX IF NOT EXISTS idx_users_hostname ON users (hostname COLLATE NOCASE, mac_address)')
+            
+            # Plan changes made by the admin, for the per-user history
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS plan_changes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    mac_address TEXT,
+                    old_plan TEXT,
+                    new_plan TEXT,
+                    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_plan_changes_mac ON plan_changes (mac_address)')
+            
+            # Per-day revenue/usage summaries, maintained by the write paths below
+            init_report_tables(c)
+            
+            # Replicated balance ledger for multi-unit venues (see node_sync.py)
+            init_sync_tables(c, os.getenv('NODE_ID'), ledger=self.ledger)
+            
             conn.commit()
         except Exception as e:
             self.logger.error(f"Error initializing database: {e}")
@@ -70,32 +139,78 @@ class UserManager:
         finally:
             conn.close()
     
+    def add_listener(self, listener):
+        """Register `listener(mac_addresses)`, called after user rows change"""
+        self.listeners.append(listener)
+    
+    def notify_changed(self, mac_addresses):
+        """Tell listeners these users changed (call after commit, also for writes made outside this class)"""
+        mac_addresses = list(mac_addresses)
+        if not mac_addresses:
+            return
+        for listener in self.listeners:
+            try:
+                listener(mac_addresses)
+            except Exception as e:
+                self.logger.error(f"Error in user change listener: {e}")
+    
+    def _credit_user(self, c, mac_address, amount, minutes):
+        """Add minutes and record the transaction on an open cursor; returns the transaction id.
+
+        In data billing mode `minutes` are the megabytes the rate table sold.
+        """
+        if self.billing_mode == 'data':
+            return self._credit_data(c, mac_address, amount, int(minutes * BYTES_PER_MB))
+        
+        # Check if user exists
+        c.execute('SELECT id, time_balance FROM users WHERE mac_address = ?', (mac_address,))
+        user = c.fetchone()
+        
+        if user is None:
+            # Create new user
+            c.execute('INSERT INTO users (mac_address, time_balance, status) VALUES (?, ?, ?)',
+                     (mac_address, minutes, 'active'))
+            user_id = c.lastrowid
+        else:
+            user_id, current_balance = user
+            # Update existing user's balance
+            c.execute('UPDATE users SET time_balance = time_balance + ?, status = ? WHERE id = ?',
+                     (minutes, 'active', user_id))
+        
+        # Record transaction
+        c.execute('''INSERT INTO transactions (user_id, amount, minutes)
+                    VALUES (?, ?, ?)''', (user_id, amount, minutes))
+        transaction_id = c.lastrowid
+        record_credit(c, mac_address, amount, minutes)
+        if self.ledger:
+            record_balance_event(c, mac_address, 'credit', minutes, amount)
+        return transaction_id
+    
+    def _credit_data(self, c, mac_address, amount, data_bytes):
+        """Add bytes to a user's data balance and record the transaction on an open cursor"""
+        c.execute('''
+            INSERT INTO users (mac_address, data_balance, status) VALUES (?, ?, 'active')
+            ON CONFLICT(mac_address) DO UPDATE SET
+                data_balance = data_balance + excluded.data_balance,
+                status = 'active'
+        ''', (mac_address, data_bytes))
+        c.execute('SELECT id FROM users WHERE mac_address = ?', (mac_address,))
+        user_id = c.fetchone()[0]
+        c.execute('INSERT INTO transactions (user_id, amount, minutes, data_bytes) VALUES (?, ?, 0, ?)',
+                  (user_id, amount, data_bytes))
+        transaction_id = c.lastrowid
+        record_credit(c, mac_address, amount, 0, data_bytes)
+        return transaction_id
+    
     def add_time(self, mac_address, amount, minutes):
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
         
         try:
-            # Check if user exists
-            c.execute('SELECT id, time_balance FROM users WHERE mac_address = ?', (mac_address,))
-            user = c.fetchone()
-            
-            if user is None:
-                # Create new user
-                c.execute('INSERT INTO users (mac_address, time_balance, status) VALUES (?, ?, ?)',
-                         (mac_address, minutes, 'active'))
-                user_id = c.lastrowid
-            else:
-                user_id, current_balance = user
-                # Update existing user's balance
-                c.execute('UPDATE users SET time_balance = time_balance + ?, status = ? WHERE id = ?',
-                         (minutes, 'active', user_id))
-            
-            # Record transaction
-            c.execute('''INSERT INTO transactions (user_id, amount, minutes)
-                        VALUES (?, ?, ?)''', (user_id, amount, minutes))
-            
+            self._credit_user(c, mac_address, amount, minutes)
             conn.commit()
             self.logger.info(f"Added {minutes} minutes for MAC {mac_address}")
+            self.notify_changed([mac_address])
             return True
             
         except Exception as e:
@@ -105,12 +220,75 @@ class UserManager:
         finally:
             conn.close()
     
+    def apply_credits(self, credits, minutes_for):
+        """Apply a burst of idempotent credits in a single transaction.
+
+        `credits` is a list of (idempotency_key, mac_address, amount). Keys that
+        were already applied are skipped. The remaining amounts are summed per
+        MAC and priced once with `minutes_for(amount)`, so each MAC gets one
+        balance update and one transaction row per burst.
+
+        Returns {mac_address: (amount, minutes)} for the MACs actually credited.
+        Database errors are raised so the caller can retry the whole burst.
+        """
+        if not credits:
+            return {}
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        
+        try:
+            # Take the write lock up front so concurrent bursts can't both pass the key check
+            c.execute('BEGIN IMMEDIATE')
+            
+            keys = [key for key, _, _ in credits]
+            seen = set()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                c.execute(f'SELECT idempotency_key FROM credit_requests WHERE idempotency_key IN ({placeholders})', chunk)
+                seen.update(row[0] for row in c.fetchall())
+            
+            amounts = {}
+            fresh = []
+            for key, mac_address, amount in credits:
+                if key in seen:
+                    continue
+                seen.add(key)
+                fresh.append((key, mac_address, amount))
+                amounts[mac_address] = amounts.get(mac_address, 0) + amount
+            
+            credited = {}
+            transaction_ids = {}
+            for mac_address, amount in amounts.items():
+                minutes = minutes_for(amount)
+                transaction_ids[mac_address] = self._credit_user(c, mac_address, amount, minutes)
+                credited[mac_address] = (amount, minutes)
+            
+            c.executemany('''
+                INSERT INTO credit_requests (idempotency_key, mac_address, amount, transaction_id)
+                VALUES (?, ?, ?, ?)
+            ''', [(key, mac, amount, transaction_ids[mac]) for key, mac, amount in fresh])
+            
+            conn.commit()
+            skipped = len(credits) - len(fresh)
+            self.logger.info(f"Applied {len(fresh)} credits for {len(credited)} devices ({skipped} duplicates skipped)")
+            self.notify_changed(credited)
+            return credited
+            
+        except Exception as e:
+            self.logger.error(f"Error applying credits: {e}")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
     def check_balance(self, mac_address):
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
         
         try:
-            c.execute('SELECT time_balance FROM users WHERE mac_address = ?', (mac_address,))
+            c.execute(f'SELECT {self.balance_column} FROM users WHERE mac_address = ?', (mac_address,))
             result = c.fetchone()
             return result[0] if result else 0
         except Exception as e:
@@ -119,6 +297,110 @@ class UserManager:
         finally:
             conn.close()
     
+    def get_users(self, mac_addresses):
+        """Fetch balance and plan info for several MACs in one query"""
+        mac_addresses = list(mac_addresses)
+        if not mac_addresses:
+            return {}
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        
+        try:
+            users = {}
+            # Stay below SQLite's host parameter limit
+            for i in range(0, len(mac_addresses), 500):
+                chunk = mac_addresses[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                c.execute(f'''
+                    SELECT mac_address, time_balance, plan, download_limit, upload_limit, upgrade_requested,
+                           data_balance
+                    FROM users WHERE mac_address IN ({placeholders})
+                ''', chunk)
+                for mac, balance, plan, download, upload, upgrade, data_balance in c.fetchall():
+                    users[mac] = {
+                        'time_balance': balance,
+                        'data_balance': data_balance,
+                        'plan': plan,
+                        'download_limit': download,
+                        'upload_limit': upload,
+                        'upgrade_requested': bool(upgrade)
+                    }
+            return users
+        except Exception as e:
+            self.logger.error(f"Error fetching users: {e}")
+            return {}
+        finally:
+            conn.close()
+    
+    def get_all_users(self):
+        """Balance and plan info of every user, keyed by MAC (same shape as get_users)"""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        
+        try:
+            c.execute('''
+                SELECT mac_address, time_balance, plan, download_limit, upload_limit, upgrade_requested,
+                       data_balance
+                FROM users
+            ''')
+            return {
+                mac: {
+                    'time_balance': balance,
+                    'data_balance': data_balance,
+                    'plan': plan,
+                    'download_limit': download,
+                    'upload_limit': upload,
+                    'upgrade_requested': bool(upgrade)
+                }
+                for mac, balance, plan, download, upload, upgrade, data_balance in c.fetchall()
+            }
+        except Exception as e:
+            self.logger.error(f"Error fetching users: {e}")
+            return {}
+        finally:
+            conn.close()
+    
+    def get_active_users(self):
+        """All users with time (or data) left and their bandwidth limits, in one query"""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        
+        try:
+            c.execute(f'''
+                SELECT mac_address, download_limit, upload_limit
+                FROM users WHERE {self.balance_column} > 0
+            ''')
+            return [
+                {'mac_address': mac, 'download_limit': download, 'upload_limit': upload}
+                for mac, download, upload in c.fetchall()
+            ]
+        except Exception as e:
+            self.logger.error(f"Error fetching active users: {e}")
+            return []
+        finally:
+            conn.close()
+    
+    def update_hostnames(self, hostnames):
+        """Store the last seen hostname for each MAC ({mac_address: hostname})"""
+        if not hostnames:
+            return True
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        
+        try:
+            c.executemany('UPDATE users SET hostname = ? WHERE mac_address = ?',
+                          [(hostname, mac) for mac, hostname in hostnames.items()])
+            conn.commit()
+            return True
+        except Exception as e:
+            self.logger.error(f"Error updating hostnames: {e}")
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
+    
     def deduct_time(self, mac_address, minutes, manual=False):
         """Deduct time from user's balance and handle zero balance"""
         conn = sqlite3.connect(self.db_path)
@@ -134,7 +416,10 @@ class UserManager:
                 return False
                 
             user_id, current_balance = result
-            new_balance = max(0, current_balance - minutes)
+            # Stop at zero, but never raise a balance that merged deductions left negative
+            new_balance = max(min(current_balance, 0), current_balance - minutes)
+            # What actually came off the balance (less than asked for near zero)
+            deducted = current_balance - new_balance
             
             # Update balance and status
             c.execute('''
@@ -159,10 +444,14 @@ class UserManager:
                     deducted_at,
                     deduction_type
                 ) VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
-            ''', (user_id, mac_address, minutes, current_balance, new_balance, 'manual' if manual else 'auto'))
+            ''', (user_id, mac_address, deducted, current_balance, new_balance, 'manual' if manual else 'auto'))
+            record_usage(c, mac_address, deducted)
+            if self.ledger and new_balance != current_balance:
+                record_balance_event(c, mac_address, 'deduct', new_balance - current_balance)
             
             conn.commit()
-            self.logger.info(f"Deducted {minutes} minutes from {mac_address}. Balance: {current_balance} -> {new_balance}")
+            self.logger.debug(f"Deducted {minutes} minutes from {mac_address}. Balance: {current_balance} -> {new_balance}")
+            self.notify_changed([mac_address])
             
             return True
             
@@ -173,6 +462,59 @@ class UserManager:
         finally:
             conn.close()
     
+    def deduct_data(self, usage):
+        """Deduct metered bytes ({mac_address: bytes}) in one transaction.
+
+        Each device gets one time_logs row (deduction_type 'data', balances in
+        bytes). Returns {mac_address: new data balance} for known devices, or
+        None if the write failed.
+        """
+        usage = {mac: used for mac, used in usage.items() if used > 0}
+        if not usage:
+            return {}
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            balances = {}
+            for mac_address, used in usage.items():
+                c.execute('SELECT id, data_balance FROM users WHERE mac_address = ?', (mac_address,))
+                result = c.fetchone()
+                if not result:
+                    continue
+                user_id, current_balance = result
+                # Stop at zero, like deduct_time
+                new_balance = max(min(current_balance, 0), current_balance - used)
+                deducted = current_balance - new_balance
+                c.execute('''
+                    UPDATE users
+                    SET data_balance = ?,
+                        status = CASE WHEN ? <= 0 THEN 'inactive' ELSE 'active' END,
+                        last_deduction = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (new_balance, new_balance, user_id))
+                c.execute('''
+                    INSERT INTO time_logs (user_id, mac_address, minutes_deducted, bytes_deducted,
+                                           balance_before, balance_after, deducted_at, deduction_type)
+                    VALUES (?, ?, 0, ?, ?, ?, CURRENT_TIMESTAMP, 'data')
+                ''', (user_id, mac_address, deducted, current_balance, new_balance))
+                record_usage(c, mac_address, 0, deducted)
+                balances[mac_address] = new_balance
+            
+            conn.commit()
+            self.logger.debug(f"Deducted data from {len(balances)} devices ({sum(usage.values())} bytes)")
+            self.notify_changed(balances)
+            return balances
+            
+        except Exception as e:
+            self.logger.error(f"Error deducting data: {e}")
+            conn.rollback()
+            return None
+        finally:
+            conn.close()
+    
     def check_health(self):
         """Check if database is accessible"""
         try:
@@ -199,6 +541,7 @@ class UserManager:
             ''', (download_kbps, upload_kbps, mac_address))
             
             conn.commit()
+            self.notify_changed([mac_address])
             return True
         except Exception as e:
             self.logger.error(f"Error setting bandwidth: {e}")
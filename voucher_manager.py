@@ -0,0 +1,138 @@
+import sqlite3
+import hashlib
+import secrets
+import logging
+import uuid
+
+class VoucherManager:
+    """Printed time codes that customers redeem for credit on their device.
+
+    Only a hash of each code is stored, as the primary key of a WITHOUT ROWID
+    table, so redemption is one primary-key lookup plus a conditional update.
+    """
+
+    # No 0/O or 1/I, which are easily confused on paper
+    CODE_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+    CODE_LENGTH = 10
+
+    def __init__(self, user_manager):
+        self.user_manager = user_manager
+        self.db_path = user_manager.db_path
+        self.logger = logging.getLogger(__name__)
+        self._init_db()
+
+    def _init_db(self):
+        """Initialize voucher tables"""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        try:
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS vouchers (
+                    code_hash BLOB PRIMARY KEY,
+                    batch_id TEXT,
+                    amount REAL,
+                    minutes REAL,
+                    status TEXT DEFAULT 'unused',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    redeemed_at TIMESTAMP,
+                    redeemed_by TEXT
+                ) WITHOUT ROWID
+            ''')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_vouchers_batch ON vouchers (batch_id)')
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error initializing voucher table: {e}")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @classmethod
+    def normalize_code(cls, code):
+        return code.strip().upper().replace('-', '').replace(' ', '')
+
+    @classmethod
+    def hash_code(cls, code):
+        return hashlib.sha256(cls.normalize_code(code).encode()).digest()[:16]
+
+    def _new_code(self):
+        raw = ''.join(secrets.choice(self.CODE_ALPHABET) for _ in range(self.CODE_LENGTH))
+        half = self.CODE_LENGTH // 2
+        return f"{raw[:half]}-{raw[half:]}"
+
+    def generate(self, count, minutes, amount=0):
+        """Create `count` vouchers in one transaction; returns (batch_id, codes)"""
+        batch_id = uuid.uuid4().hex[:12]
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        try:
+            codes = {}  # code_hash -> code, for vouchers inserted in this batch
+            while len(codes) < count:
+                candidates = {}
+                while len(candidates) < count - len(codes):
+                    code = self._new_code()
+                    code_hash = self.hash_code(code)
+                    if code_hash not in codes:
+                        candidates[code_hash] = code
+
+                before = conn.total_changes
+                c.executemany(
+                    'INSERT OR IGNORE INTO vouchers (code_hash, batch_id, amount, minutes) VALUES (?, ?, ?, ?)',
+                    [(code_hash, batch_id, amount, minutes) for code_hash in candidates]
+                )
+                if conn.total_changes - before == len(candidates):
+                    codes.update(candidates)
+                    continue
+
+                # Some codes collided with existing vouchers; keep the ones that went in
+                for code_hash, code in candidates.items():
+                    c.execute('SELECT batch_id FROM vouchers WHERE code_hash = ?', (code_hash,))
+                    if c.fetchone()[0] == batch_id:
+                        codes[code_hash] = code
+
+            conn.commit()
+            self.logger.info(f"Generated {len(codes)} vouchers in batch {batch_id} ({minutes} minutes each)")
+            return batch_id, list(codes.values())
+        except Exception as e:
+            self.logger.error(f"Error generating vouchers: {e}")
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def redeem(self, code, mac_address):
+        """Redeem a voucher for a device; returns (amount, minutes) or None if invalid/used"""
+        code_hash = self.hash_code(code)
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        try:
+            # Claim the voucher; the status check makes double redemption impossible
+            c.execute('''
+                UPDATE vouchers
+                SET status = 'redeemed',
+                    redeemed_at = CURRENT_TIMESTAMP,
+                    redeemed_by = ?
+                WHERE code_hash = ? AND status = 'unused'
+            ''', (mac_address, code_hash))
+
+            if c.rowcount != 1:
+                conn.rollback()
+                self.logger.warning(f"Rejected voucher redemption for {mac_address}")
+                return None
+
+            c.execute('SELECT amount, minutes FROM vouchers WHERE code_hash = ?', (code_hash,))
+            amount, minutes = c.fetchone()
+            self.user_manager._credit_user(c, mac_address, amount, minutes)
+
+            conn.commit()
+            self.logger.info(f"Redeemed voucher for {mac_address}: {minutes} minutes")
+            self.user_manager.notify_changed([mac_address])
+            return amount, minutes
+        except Exception as e:
+            self.logger.error(f"Error redeeming voucher: {e}")
+            conn.rollback()
+            return None
+        finally:
+            conn.close()